@@ -35,6 +35,7 @@ class CurrentWeather:
         self.icon_cache = icon_cache
         self.icon = icon
         self.current_icon = None
+        self.revision = 0
         self.font1 = pygame.font.Font("Assets/Fonts/Jetbrains/JetBrainsMono-Bold.ttf", 42)
         self.font2 = pygame.font.Font("Assets/Fonts/Jetbrains/JetBrainsMono-Bold.ttf", 15)
         log.debug("New CurrentWeather object created")
@@ -116,19 +117,21 @@ class CurrentWeather:
         except Exception as e:
             # print(f"Current weather icon load error: {e}")
             self.current_icon = self.icon
+        self.revision += 1
 
     def draw_current(self, screen, location):
         """
         Draws the current weather data
         :param screen: The screen to draw the current weather data on
         :param location: The x, y location to draw the current weather data at
-        :return: None
+        :return: The screen area that was drawn
         """
         x, y = location
         # Load temp
-        screen.blit(self.current_icon, self.current_icon.get_rect(center=(x + 42.5, y + 40)))
-        screen.blit(self.big_info, (x + 75, y))
-        screen.blit(self.small_info, (x + 75, y + 52))
-        screen.blit(self.small_info2, (x + 75, y + 76))
+        area = screen.blit(self.current_icon, self.current_icon.get_rect(center=(x + 42.5, y + 40)))
+        area.union_ip(screen.blit(self.big_info, (x + 75, y)))
+        area.union_ip(screen.blit(self.small_info, (x + 75, y + 52)))
+        area.union_ip(screen.blit(self.small_info2, (x + 75, y + 76)))
         # if precipitation_text:
         #     screen.blit(precipitation_text, (50, 350))
+        return area
@@ -1,4 +1,5 @@
 import io
+import itertools
 import time
 
 import pint
@@ -109,26 +110,29 @@ class FocusedForecast:
         """
         Draws the detailed weather information to the screen
         :param screen: The screen to draw to
-        :return: None
+        :return: The screen area that was drawn
         """
         x = self.x
         y = self.y
+        area = screen.blit(self.time_info, (x + 85, y))
         for button in self.radar_buttons:
-            button.blit(screen)
-        screen.blit(self.time_info, (x + 85, y))
-        screen.blit(self.forecast.pic, self.forecast.pic.get_rect(center=(x + 42.5, y + 40)))
-        screen.blit(self.big_info, (x + 85, y + 25))
+            area.union_ip(button.blit(screen))
+        area.union_ip(screen.blit(self.forecast.pic, self.forecast.pic.get_rect(center=(x + 42.5, y + 40))))
+        area.union_ip(screen.blit(self.big_info, (x + 85, y + 25)))
         count = 0
         for line in self.lines:
-            screen.blit(line, (x + 40, y + (count * 27) + 76))
+            area.union_ip(screen.blit(line, (x + 40, y + (count * 27) + 76)))
             count += 1
 
         if self.open_since < time.time() - 30:
             self.forecast.focused = False
+        return area
 
 
 class ForecastEntry:
 
+    _serial = itertools.count()
+
     def __init__(self, screen, location, weather, delta_time, icon_cache, icon):
         """
         Creates a forecast entry for the weather information
@@ -141,6 +145,7 @@ class ForecastEntry:
         """
         self.x, self.y = location
         self.location = location
+        self.serial = next(ForecastEntry._serial)  # Unique per card so redraws can tell rebuilt cards apart
         self.focused = False
         self.focused_object = None
         self.weather = weather
@@ -248,11 +253,11 @@ class ForecastEntry:
         """
         Draws the forecast card to the screen.
         :param screen: The screen to draw the card to.
-        :return: None
+        :return: The screen area that was drawn
         """
         if self.focused:
             if not self.focused_object:
                 self.focused_object = FocusedForecast(self)
-            self.focused_object.draw(screen)
+            return self.focused_object.draw(screen)
         else:
-            screen.blit(self.surf, (self.x, self.y))
+            return screen.blit(self.surf, (self.x, self.y))
@@ -2,18 +2,21 @@ import geocoder
 import json
 import logging
 import os
-import threading
 import time
 import traceback
-import urllib.error
-from urllib.request import urlopen
-
-import dill
 
 from pyowm.owm import OWM
 
+from Utils import weatherCache
+from Utils.tileCache import TileCache
+from Utils.tileFetcher import TileFetcher
+
 api_file = "../APIKey.json"
-cache_location = "Caches/weather.cache"
+legacy_cache_location = "Caches/weather.cache"
+cache_directory = "Caches/weather"
+tile_directory = "Caches/radar_tiles"
+# The tiles the radar screen shows, nearest the middle first
+radar_viewport = [(16, 22), (15, 22), (17, 22), (16, 23), (15, 23), (17, 23)]
 
 
 class OpenWeatherWrapper:
@@ -63,44 +66,58 @@ class OpenWeatherWrapper:
         self.current_weather = None
         self.weather_forecast = None
         self.one_call = None
-        self.radar_buffer = {}
         self.log = logging.getLogger(__name__)
+        self.cache = weatherCache.WeatherCache(cache_directory)
+        self._cached_location = None
+        self.tiles = weatherCache.TileStore(tile_directory)
+        self.radar_tiles = TileCache(ttl=30 * 60)
+        self.tile_fetcher = TileFetcher(workers=4)
         self._read_cache()
         self.log.info(f"Weather Wrapper Initialized, GeoLocation is {self.location_address} {self.location_latlng}")
 
     def _read_cache(self):
         """
-        Reads the cache file and loads the data into the class
+        Loads each cached piece of weather data and the stored radar tiles, anything unreadable is just refetched
         :return: None
         """
-        if os.path.isfile(cache_location):
-            self.log.info("Loading weather cache")
-            with open(cache_location, 'rb') as inp:
-                try:
-                    cache: OpenWeatherWrapper = dill.load(inp)
-                    if self.location_address is None:
-                        self.location_address = cache.location_address
-                        self.location_latlng = cache.location_latlng
-                    else:
-                        if cache.location_latlng != self.location_latlng:
-                            self.log.warning("Cache location does not match current location, invalidating!")
-                            return
-                    self.current_weather = cache.current_weather
-                    self.one_call = cache.one_call
-                    self.radar_buffer = cache.radar_buffer
-                    self.weather_forecast = cache.weather_forecast
-                    self._last_current_refresh = cache._last_current_refresh
-                    self._last_forecast_refresh = cache._last_forecast_refresh
-                    self._last_radar_refresh = cache._last_radar_refresh
-                    self._last_future_refresh = cache._last_future_refresh
-                except EOFError:
-                    self.log.warning("Cache File Corrupted")
-                except Exception as e:
-                    self.log.warning(f"Failed to load cached weather because: {e}\nTraceback: {traceback.format_exc()}")
+        if os.path.isfile(legacy_cache_location):
+            self.log.info("Removing the old pickled weather cache")
+            os.remove(legacy_cache_location)
+        location = self.cache.load("location")
+        if location is not None:
+            _, location = location
+            self._cached_location = location
+            if self.location_address is None:
+                self.location_address = location["address"]
+                self.location_latlng = location["latlng"]
+            elif list(location["latlng"]) != list(self.location_latlng):
+                self.log.warning("Cache location does not match current location, invalidating!")
+                return
+        self.log.info("Loading weather cache")
+        entries = (("current", weatherCache.weather_from_dict, "current_weather", "_last_current_refresh"),
+                   ("one_call", weatherCache.one_call_from_dict, "one_call", "_last_forecast_refresh"),
+                   ("forecast", lambda data: [weatherCache.weather_from_dict(item) for item in data],
+                    "weather_forecast", "_last_future_refresh"))
+        for name, parse, attribute, refreshed in entries:
+            entry = self.cache.load(name)
+            if entry is None:
+                continue
+            saved_at, data = entry
+            try:
+                setattr(self, attribute, parse(data))
+                setattr(self, refreshed, saved_at)
+            except Exception as e:
+                self.log.warning(f"Failed to load cached {name} weather because: {e}")
+        for key, entry in self.tiles.items():
+            stored = self.tiles.get(key)
+            if stored is None:
+                continue
+            self.radar_tiles.put(TileCache.key(entry["layer"], 6, entry["x"], entry["y"], entry["future"],
+                                               entry["options"]), stored[1], entry["fetched_at"])
 
     def _load_pi_cache(self):
         """
-        Loads all the data from the host machine, in the form of a dill'd file
+        Loads all the data from the host machine
         :return: None
         """
         pass
@@ -117,15 +134,22 @@ class OpenWeatherWrapper:
         #     self._read_cache()
         #     self._last_cache_refresh = time.time()
 
-    def _save_cache(self):
+    def _save_cache(self, name, data):
         """
-        Saves the cache to the weather cache file
+        Saves one piece of weather data to the cache
+        :param name: The cache entry name
+        :param data: The JSON serializable data
         :return: None
         """
-        with open(cache_location, 'wb') as outp:
-            self.log.debug("Saving current weather to cache")
-            dill.dump(self, outp)
-            outp.close()
+        self.log.debug(f"Saving {name} weather to cache")
+        try:
+            location = {"address": self.location_address, "latlng": list(self.location_latlng)}
+            if location != self._cached_location:
+                self.cache.save("location", location)
+                self._cached_location = location
+            self.cache.save(name, data)
+        except Exception as e:
+            self.log.warning(f"Failed to save {name} weather to cache because: {e}")
 
     def update_current_weather(self):
         """
@@ -138,7 +162,7 @@ class OpenWeatherWrapper:
             self._last_current_refresh = time.time()
             try:
                 self.current_weather = self.mgr.weather_at_place(self.location_address).weather
-                self._save_cache()
+                self._save_cache("current", weatherCache.weather_to_dict(self.current_weather))
             except Exception as e:
                 self.log.warning(f"Unable to load weather: {e}")
                 return False
@@ -156,7 +180,7 @@ class OpenWeatherWrapper:
             self._last_forecast_refresh = time.time()
             try:
                 self.one_call = self.mgr.one_call(lat=self.location_latlng[0], lon=self.location_latlng[1])
-                self._save_cache()
+                self._save_cache("one_call", weatherCache.one_call_to_dict(self.one_call))
             except Exception as e:
                 self.log.warning(f"Unable to load forecast: {e}\nTraceback: {traceback.format_exc()}")
                 return False
@@ -174,114 +198,103 @@ class OpenWeatherWrapper:
             try:
                 self._last_future_refresh = time.time()
                 self.weather_forecast = self.mgr.forecast_at_place('Houghton,US', '1h', limit=None).weathers
-                self._save_cache()
+                self._save_cache("forecast", [weatherCache.weather_to_dict(item) for item in self.weather_forecast])
             except Exception as e:
                 self.log.warning(f"Unable to load future: {e}")
                 return False
             return True
         return None
 
-    def _load_future_radar_tile(self, location, layer_name, future, options=""):
+    def _store_radar_tile(self, key, data, fetched_at, date=0):
         """
-        Loads the radar tiles for a particular layer and future time
-        :param location: The X,Y location of the radar tile in the maps grid format Ex. (16, 22)
-        :param layer_name: The OWM layer name to load Ex. "WND" or "PR0"
-        :param future: The Unix time in seconds to load the tile for
-        :param options: Any additional options to pass to the OWM API
-        :return: The image of the radar tile in 256x256 PNG format
+        Called by the tile fetcher when a radar tile has downloaded
+        :param key: The tile key from TileCache.key
+        :param data: The tile in 256x256 PNG format
+        :param fetched_at: When the tile was downloaded
+        :param date: The Unix time the tile was requested for, 0 for the current time
+        :return: None
         """
-        x, y = location
-        date = int(time.time()) + future
-        print(f"Loading {location} {layer_name}+{options} {future}")
-        entry = [item for item in self.radar_buffer[future] if item[0] == location and item[2] == layer_name and item[4] == options]
-
-        if len(entry):
-            if entry[0][3][2] > time.time() - 30 * 60:
-                print(f"{location} in cache for {layer_name}:{future}")
-                self.radar_refresh_amount += 1
-                return
-            else:
-                print(f"{location} expired in cache for {layer_name}:{future} evicting cache")
-                self.radar_buffer[future] = []
-        url = f"https://maps.openweathermap.org/maps/2.0/weather/{layer_name}/6/{x}/{y}?date={int(date)}{options}&appid={self.api_key}"
-        try:
-            data = urlopen(url).read()
-            self.radar_buffer[future].append(((x, y), data, layer_name, (future, date, time.time()), options))
-            self.radar_refresh_amount += 1
-        except urllib.error.HTTPError as e:
-            print(f"Tile get HTTP Error({e}): {url}")
+        layer_name, zoom, x, y, future, options = key
+        self.radar_tiles.put(key, data, fetched_at)
+        self.tiles.put(self.tiles.key(*key), data, fetched_at, layer=layer_name, x=x, y=y, future=future, date=date,
+                       options=options)
+        if not self.tile_fetcher.pending():
+            self.tiles.flush()  # Write the index once per batch rather than once per tile
+        self.radar_refresh_amount += 1
 
-    def _load_radar_tile(self, tile_manager, location, layer_name):
+    def _queue_radar_tile(self, location, layer_name, future=None, options="", priority=0):
         """
-        Loads the radar tiles for a particular layer at the current time
-        :param tile_manager: The OWM tile manager to use to load the tiles
+        Queues a radar tile download unless a fresh copy is already loaded
         :param location: The X,Y location of the radar tile in the maps grid format Ex. (16, 22)
         :param layer_name: The OWM layer name to load Ex. "WND" or "PR0"
+        :param future: The time offset in seconds to load the tile for using the V2 API, None for a V1 layer
+        :param options: Any additional options to pass to the OWM API
+        :param priority: Lower is downloaded sooner
         :return: None
         """
         x, y = location
-        tile = tile_manager.get_tile(x=x, y=y, zoom=6).image.recent_data
-        self.radar_buffer[0].append(((x, y), tile, layer_name, (0, 0, time.time())))
-        self.radar_refresh_amount += 1
-
-    def _load_layer(self, layer: str):
-        """
-        Loads the all the layer tiles for a particular layer at the current time
-        :param layer: The OWM layer name to load Ex. "WND" or "PR0"
-        :return: None
-        """
-        tile_manager = self.owm.tile_manager(layer)
-        self._load_radar_tile(tile_manager, (15, 22), layer)
-        self._load_radar_tile(tile_manager, (16, 22), layer)
-        self._load_radar_tile(tile_manager, (17, 22), layer)
-        self._load_radar_tile(tile_manager, (15, 23), layer)
-        self._load_radar_tile(tile_manager, (16, 23), layer)
-        self._load_radar_tile(tile_manager, (17, 23), layer)
-        print(f"Loaded owm layer {layer}")
-        self._save_cache()
+        key = TileCache.key(layer_name, 6, x, y, future or 0, options)
+        if self.radar_tiles.is_fresh(key):
+            self.radar_refresh_amount += 1
+            return
+        if future is None:
+            date = 0
+            url = f"https://tile.openweathermap.org/map/{layer_name}/6/{x}/{y}.png?appid={self.api_key}"
+        else:
+            date = int(time.time()) + future
+            url = f"https://maps.openweathermap.org/maps/2.0/weather/{layer_name}/6/{x}/{y}?date={date}{options}&appid={self.api_key}"
+        self.tile_fetcher.fetch(key, url, lambda *args: self._store_radar_tile(*args, date=date), priority=priority,
+                                group="radar")
 
-    def _load_future_layers(self, layer: str, future: int, options=""):
+    def radar_tile(self, layer_name, location, future=0, options=""):
         """
-        Loads the all the layer tiles for a particular layer at the a particular future time
-        :param layer: The OWM layer name to load Ex. "WND" or "PR0"
-        :param future: The Unix time in seconds to load the tiles for Ex. 3600 for 1 hour
-        :param options: The additional options to pass to the OWM API
-        :return: None
+        Gets a loaded radar tile, falling back to the tile store for tiles pushed out of memory
+        An expired tile is still returned so the map has something to show until it is refreshed
+        :param layer_name: The OWM layer name Ex. "WND" or "PR0"
+        :param location: The X,Y location of the radar tile in the maps grid format Ex. (16, 22)
+        :param future: The time offset in seconds the tile was loaded for
+        :param options: The additional options the tile was loaded with
+        :return: The tile in 256x256 PNG format, or None if it hasn't been loaded
         """
-        print(f"Loading owm forecast layer {layer}")
-        if future not in self.radar_buffer:
-            self.radar_buffer[future] = []
-        self._load_future_radar_tile((15, 22), layer, future, options=options)
-        self._load_future_radar_tile((16, 22), layer, future, options=options)
-        self._load_future_radar_tile((17, 22), layer, future, options=options)
-        self._load_future_radar_tile((15, 23), layer, future, options=options)
-        self._load_future_radar_tile((16, 23), layer, future, options=options)
-        self._load_future_radar_tile((17, 23), layer, future, options=options)
-        print(f"Loaded owm forecast layer {layer}")
-        self._save_cache()
+        x, y = location
+        key = TileCache.key(layer_name, 6, x, y, future, options)
+        data = self.radar_tiles.get(key, allow_stale=True)
+        if data is None:
+            stored = self.tiles.get(self.tiles.key(*key))
+            if stored is not None:
+                entry, data = stored
+                self.radar_tiles.put(key, data, entry["fetched_at"])
+        return data
 
     def update_weather_map(self, v1_layers, v2_layers):
         """
-        Updates the weather map cache with the layers specified
+        Queues downloads for every tile of the layers specified that isn't already loaded
+        The tiles of the frame on screen are fetched first, starting from the middle of the map
         :param v1_layers: The list of OWM layer names to load for the current time using the V1 API, Ex. ["wind_new", "pressure_new"]
         :param v2_layers: The list of OWM layer names to load for the current time using the V2 API, Ex. [("WND", 3600, ""), ("PR0", 3600, "")])
         :return: None
         """
-        # v1_layers, v2_layers = layers
+        self.tiles.flush()  # In case the last batch ended with a failed or cancelled tile
         if self._last_radar_refresh < time.time() - self._radar_max_refresh * 60:
-            self.log.info("Clearing radar cache")
-            # self.radar_buffer = {}
+            self.log.info(f"Radar tile cache: {self.radar_tiles.stats()}, fetcher: {self.tile_fetcher.stats()}")
             self._last_radar_refresh = time.time()
 
-        if self._last_radar_refresh < time.time() - (self._radar_max_refresh / 2) * 60:
-            print("Refreshing current cloud cover layer")
-            # self.radar_buffer[0] = []
+        # The radar screen shows the offset of the first v2 layer
+        frame = v2_layers[0][1] if len(v2_layers) else 0
+        for index, location in enumerate(radar_viewport):
+            for layer in v1_layers:
+                rank = 0 if frame == 0 else 1
+                self._queue_radar_tile(location, layer, priority=rank * len(radar_viewport) + index)
+            for layer, delta, options in v2_layers:
+                rank = 0 if delta == frame else 1
+                self._queue_radar_tile(location, layer, delta, options, priority=rank * len(radar_viewport) + index)
 
-        for layer in v1_layers:
-            threading.Thread(target=self._load_layer, args=layer).start()
-
-        for layer, delta, args in v2_layers:
-            threading.Thread(target=self._load_future_layers, args=(layer, delta, args)).start()
+    def cancel_radar_tiles(self):
+        """
+        Drops the queued radar tile downloads, e.g. when the radar screen is closed
+        :return: How many downloads were dropped
+        """
+        return self.tile_fetcher.cancel("radar")
 
     @staticmethod
     def get_angle_arrow(degree):
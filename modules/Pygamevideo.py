@@ -1,9 +1,13 @@
+import collections
+import threading
 import time
 import pygame
 import numpy
 import cv2
 from ffpyplayer.player import MediaPlayer
 
+from Utils.frameConverter import FrameConverter
+
 __version__ = "2.0.2"
 
 
@@ -66,10 +70,13 @@ class Video:
     def __repr__(self):
         return f"<pygamevideo.Video(frame#{self.current_frame})>"
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, queue_size=3):
         """
         The constructor of the Pygame Video class.
+        Frames are read and converted on a decoder thread into a small queue of ready frames, so a slow read (e.g. an
+        HLS segment fetch) never holds up the thread that draws the video.
         :param filepath: The path of the video file or the URL of the m3u8 playlist.
+        :param queue_size: How many ready frames to hold, the oldest is dropped when the drawing falls behind.
         """
         if not filepath:
             raise ValueError("No Stream Source Provided")
@@ -94,6 +101,17 @@ class Video:
         self.volume = 1
         self.is_muted = False
 
+        self.queue_size = queue_size
+        self.ready_frames = collections.deque(maxlen=queue_size)  # Newest last
+        # Enough surfaces for a full queue, the one on screen and the one being written
+        self.converter = FrameConverter(slots=queue_size + 2)
+        self.condition = threading.Condition()
+        self._decoder = None  # Only the current decoder thread keeps running, an older one exits after its read
+        self._stream_owner = None  # The decoder thread reading self.stream, it releases the stream when it exits
+        self.anti_alias = False
+        self.decoded_frames = 0
+        self.skipped_frames = 0  # Ready frames replaced by a newer one before they were drawn
+
         self.stream = cv2.VideoCapture(self.filepath)
 
         # self.ff = MediaPlayer(self.filepath)
@@ -123,12 +141,25 @@ class Video:
     def release(self):
         """
         Releases the video stream and the underlying cv2.VideoCapture object back to the system.
+        If the decoder thread is in the middle of a read, it releases the capture once the read returns instead.
         :return: None
         """
-        self.stream.release()
+        with self.condition:
+            self._decoder = None
+            self.condition.notify_all()
+        if self._stream_owner is None or not self._stream_owner.is_alive():
+            self.stream.release()
         # self.ff.close_player()
         self.is_ready = False
 
+    def _start_decoder(self):
+        with self.condition:
+            self.ready_frames.clear()
+            self._decoder = threading.Thread(target=self._decode_loop, args=(self.stream,), daemon=True,
+                                             name=f"Video-{self.filepath}")
+            self._stream_owner = self._decoder
+            self._decoder.start()
+
     # Control methods
 
     def play(self, loop=False):
@@ -138,13 +169,14 @@ class Video:
         :return: None
         """
         if not self.is_playing:
-            if not self.is_ready: self.__init__(self.filepath)
+            if not self.is_ready: self.__init__(self.filepath, self.queue_size)
 
             self.is_playing = True
             self.is_looped = loop
 
             self.start_time = time.time()
             self.ostart_time = time.time()
+            self._start_decoder()
 
     def restart(self):
         """
@@ -162,6 +194,7 @@ class Video:
 
             self.start_time = time.time()
             self.ostart_time = time.time()
+            self._start_decoder()
 
     def stop(self):
         """
@@ -178,6 +211,8 @@ class Video:
             self.frame_surf = pygame.Surface((self.frame_width, self.frame_height))
 
             self.release()
+            with self.condition:
+                self.ready_frames.clear()
 
     def toggle_pause(self):
         """
@@ -202,6 +237,8 @@ class Video:
         :return: None
         """
         self.is_paused = False
+        with self.condition:
+            self.condition.notify_all()
 
     # Audio methods
 
@@ -322,6 +359,8 @@ class Video:
         """
         self.frame_width, self.frame_height = size
         self.frame_surf = pygame.Surface((self.frame_width, self.frame_height), pygame.HWSURFACE | pygame.ASYNCBLIT).convert()
+        with self.condition:
+            self.ready_frames.clear()  # Frames of the old size
 
         if not (self.frame_width > 0 and self.frame_height > 0):
             raise ValueError(f"Size must be positive")
@@ -335,6 +374,8 @@ class Video:
         """
         self.frame_width = width
         self.frame_surf = pygame.Surface((width, self.frame_height), pygame.HWSURFACE | pygame.ASYNCBLIT).convert()
+        with self.condition:
+            self.ready_frames.clear()  # Frames of the old size
 
         if self.frame_width <= 0:
             raise ValueError(f"Width must be positive")
@@ -348,6 +389,8 @@ class Video:
         """
         self.frame_height = height
         self.frame_surf = pygame.Surface((self.frame_width, height), pygame.HWSURFACE | pygame.ASYNCBLIT).convert()
+        with self.condition:
+            self.ready_frames.clear()  # Frames of the old size
 
         if self.frame_height <= 0:
             raise ValueError(f"Height must be positive")
@@ -362,50 +405,88 @@ class Video:
 
     # Process & draw video
 
+    def _decode_loop(self, stream):
+        """
+        The decoder thread, reads frames as they fall due, converts them to surfaces and queues them to be drawn.
+        :param stream: The cv2.VideoCapture to read from, released when the thread exits.
+        :return: None
+        """
+        try:
+            while True:
+                with self.condition:
+                    while self._decoder is threading.current_thread() and self.is_paused:
+                        self.condition.wait()
+                    if self._decoder is not threading.current_thread():
+                        return
+                fps = self.fps or 30
+                elapsed_frames = int((time.time() - self.start_time) * fps)
+
+                seeked_frames = int(stream.get(cv2.CAP_PROP_POS_FRAMES) + self.draw_frame + self.dropped_frames)
+                makeup_frames = elapsed_frames - seeked_frames
+
+                time_difference = round(stream.get(cv2.CAP_PROP_POS_MSEC) / 1000 - elapsed_frames / fps, 2)
+
+                self.last_frame_timestamp = stream.get(cv2.CAP_PROP_POS_MSEC) / 1000 + self.start_time - 30
+
+                if seeked_frames >= elapsed_frames:
+                    # Ahead of the clock, wait until the next frame is due
+                    time.sleep(max(0.0, (seeked_frames + 1) / fps - (time.time() - self.start_time)))
+                    continue
+
+                # In the event that we have fallen behind in processing the stream skip to the next Iframe
+                if time_difference < 0 and makeup_frames > 5 and self.last_segment < time.time() - 1:
+                    self.draw_frame += int(stream.get(cv2.CAP_PROP_POS_FRAMES))
+                    self.dropped_frames += makeup_frames
+                    stream.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Sets position to the next Iframe
+                    self.last_segment = time.time()
+                    continue
+
+                frame = None
+                for _ in range(min(makeup_frames, 5)):  # Set a max makeup amount to prevent process locking
+                    success, read = self.converter.read(stream)
+                    if not success:
+                        break
+                    frame = read
+                if type(frame) is not numpy.ndarray:
+                    time.sleep(1 / fps)  # Nothing to read yet, or the end of the video
+                    continue
+                self._frame = frame
+
+                size = (int(self.frame_width), int(self.frame_height))
+                with self.condition:
+                    busy = [self.frame_surf, *self.ready_frames]
+                surface = self.converter.convert(frame, size, self.anti_alias, busy)
+                if surface is None:
+                    continue
+                with self.condition:
+                    if self._decoder is not threading.current_thread():
+                        return
+                    if len(self.ready_frames) == self.ready_frames.maxlen:
+                        self.skipped_frames += 1
+                    self.ready_frames.append(surface)  # Drops the oldest when full
+                    self.decoded_frames += 1
+        finally:
+            stream.release()
+
     def update_frame(self, anti_alias=False):
         """
-        Grabs the next frame from the video and updates the frame surface.
-        :param anti_alias: A boolean indicating whether use smooth scaling.
+        Swaps in the newest frame the decoder thread has ready, frames older than it are dropped.
+        :param anti_alias: A boolean indicating whether use smooth scaling, applies from the next frame decoded.
         :return: The total time spent processing the frame.
         """
+        self.anti_alias = anti_alias
         if not self.is_playing:
             return 0
             # return self.frame_surf
         start_time = time.time()
-
-        elapsed_frames = int((time.time() - self.start_time) * self.fps)
-
-        seeked_frames = int(self.stream.get(cv2.CAP_PROP_POS_FRAMES) + self.draw_frame + self.dropped_frames)
-        makeup_frames = elapsed_frames - seeked_frames
-
-        time_difference = round(self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000 - elapsed_frames / self.fps, 2)
-
-        self.last_frame_timestamp = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000 + self.start_time - 30
-
-        if seeked_frames >= elapsed_frames:
-            return 0
-        
-        if not self.is_paused:
-            # In the event that we have fallen behind in processing the stream skip to the next Iframe
-            if time_difference < 0 and makeup_frames > 5 and self.last_segment < time.time() - 1:
-                self.draw_frame += int(self.stream.get(cv2.CAP_PROP_POS_FRAMES))
-                self.dropped_frames += makeup_frames
-                self.stream.set(cv2.CAP_PROP_POS_FRAMES, 0)  # Sets position to the next Iframe
-                self.last_segment = time.time()
-            else:
-                if makeup_frames > 5: makeup_frames = 5  # Set a max makeup amount to prevent process locking
-                for _ in range(makeup_frames):
-                    success, self._frame = self.stream.read()
-                    # time.sleep(1 / (self.fps * 1.1))
-            if type(self._frame) is not numpy.ndarray:
-                return 0
-            if anti_alias: frame = cv2.resize(self._frame, (int(self.frame_width), int(self.frame_height)), interpolation=cv2.INTER_AREA)
-            if not anti_alias: frame = cv2.resize(self._frame, (int(self.frame_width), int(self.frame_height)), interpolation=cv2.INTER_NEAREST)
-            # audio_frame, val = self.ff.get_frame()
-            try:
-                pygame.pixelcopy.array_to_surface(self.frame_surf, numpy.flip(numpy.rot90(frame[::-1])))
-            except ValueError:
+        with self.condition:
+            if not self.ready_frames:
                 return 0
+            surface = self.ready_frames.pop()
+            self.skipped_frames += len(self.ready_frames)
+            self.ready_frames.clear()
+        if surface.get_size() == (int(self.frame_width), int(self.frame_height)):
+            self.frame_surf = surface
 
         finish_time = time.time()
         total_time = (finish_time - start_time)
@@ -424,7 +505,7 @@ class Video:
 
     def stream_to(self, surface, pos, anti_alias=False):
         """
-        Loads the next frame from the video and draws it to the given surface.
+        Draws the newest frame the decoder thread has ready to the given surface.
         :param surface: The surface to draw to.
         :param pos: The position in X, Y coordinates to draw the frame.
         :param anti_alias: True if the frame should be anti-aliased with smooth scaling.
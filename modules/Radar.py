@@ -3,87 +3,78 @@ import json
 import logging
 import os
 import threading
-from os import listdir
-from os.path import isfile
+import time
 
 import pygame
 import datetime
 
 from urllib.request import urlopen
 
+from Utils.framePlayer import FramePlayer
+from Utils.playbackClock import Crossfader, PlaybackClock
+from Utils.radarArchive import RadarArchive
+
 pallet_one = (255, 206, 0)
 pallet_two = (255, 255, 255)
 pallet_three = (0, 0, 0)
 
-
-def update_cache(serial_bytes, name):
-    """
-    Updates the radar cache with the given bytes
-    :param serial_bytes: The bytes to save
-    :param name: The name of the file to save
-    :return: None
-    """
-    f = open(f"Caches/Radar_cache/KMQT_Frames/{name}.png", "wb")
-    f.write(serial_bytes)
-    f.close()
-
-
-def scale_tile(tile, scale):
-    """
-    Scales the given tile to the given scale
-    :param tile: The tile to scale
-    :param scale: The scale to scale to
-    :return: The scaled tile
-    """
-    return pygame.transform.scale(tile, (int(tile.get_width() * scale), int(tile.get_height() * scale)))
+# The OWM tiles the radar screen shows, (16, 22) is in the middle
+owm_tile_locations = [(16, 22), (15, 22), (17, 22), (16, 23), (15, 23), (17, 23)]
 
 
-def load_frame(name, timestamp):
+def load_frame(name, timestamp, frames):
     """
     Loads the radar frame from the radar station with the given name
     :param name: The name of the frame to load
     :param timestamp: The timestamp of the frame to save to cache
+    :param frames: The RadarArchive to save the frame to
     :return: None
     """
     image_str = urlopen(f"https://data.rainviewer.com/images/KMQT/{name}_0_source.png").read()
-    update_cache(image_str, f"KMQT_{timestamp}")
-    print(f"Loaded new frame [{name}] saved as [KMQT_{timestamp}.png]")
+    frames.add(timestamp, image_str)
+    print(f"Loaded new frame [{name}] saved as [{timestamp}]")
 
 
 class Radar:
 
-    def load_owm_tile(self, location):
+    def _layer_keys(self):
         """
-        Loads the tile from the OWM cache
+        Gets the tile keys of the layers on screen
+        :return: A list of (layer name, time offset, options) tuples in the order they are drawn
+        """
+        # The v1 layers are only loaded for the current time, so only show them when the frame is for now
+        frame = self.v2_layers[0][1] if len(self.v2_layers) else 0
+        keys = [(name, 0, "") for name in self.v1_layers] if frame == 0 else []
+        keys += [(name, delta, options) for name, delta, options in self.v2_layers if delta == frame]
+        return keys
+
+    def _decode_tile(self, key, data):
+        """
+        Decodes a tile, reusing the surface from the last time the same tile bytes were decoded
+        :param key: The tile's (location, layer name, time offset, options)
+        :param data: The tile in PNG format
+        :return: The decoded surface
+        """
+        cached = self.tile_surfaces.pop(key, None)
+        if cached is not None and cached[0] is data:
+            surface = cached[1]
+        else:
+            surface = pygame.image.load(io.BytesIO(data)).convert_alpha()
+        self.tile_surfaces[key] = (data, surface)
+        while len(self.tile_surfaces) > self.tile_surface_limit:
+            del self.tile_surfaces[next(iter(self.tile_surfaces))]
+        return surface
+
+    def load_owm_tile(self, location, layers):
+        """
+        Composites the loaded layers of a tile
         :param location: The location of the tile to load in the form of (x, y)
+        :param layers: A list of (layer key, tile bytes) to draw, bottom first
         :return: A pygame surface of the tile
         """
-        layers = []
         surf = pygame.Surface((256, 256), pygame.SRCALPHA | pygame.HWSURFACE | pygame.ASYNCBLIT)
-        for _, time in self.weather.radar_buffer.items():
-            # For every item in the radar buffer format the tile to the surf
-            if len(self.v2_layers):
-                # If there are v2 layers
-                name, delta, options = self.v2_layers[0]
-                if _ != delta:
-                    # If the delta is not the same as the current frame
-                    continue
-            else:
-                if _ != 0:
-                    break
-            for entry in time:
-                e_location, tile, layer_name, time, e_options = entry
-                if location == e_location and layer_name in self.v1_layers:
-                    image_file = io.BytesIO(tile)
-                    layers.append(pygame.image.load(image_file).convert_alpha())
-                for name, delta, options in self.v2_layers:
-                    if location == e_location and layer_name == name and _ == delta and e_options == options:
-                        image_file = io.BytesIO(tile)
-                        layers.append(pygame.image.load(image_file).convert_alpha())
-        for layer in layers:
-            # For every layer in the layers list blit the layer to the surf
-            surf.blit(layer, (0, 0))
-        del layers  # Delete the layers list to free up memory
+        for key, data in layers:
+            surf.blit(self._decode_tile((location,) + key, data), (0, 0))
         return surf.convert_alpha()
 
     def text(self, text):
@@ -96,29 +87,29 @@ class Radar:
 
     def format_owm_tiles(self, screen: pygame.Surface):
         """
-        Formats the OWM tiles to the screen
+        Formats the OWM tiles to the screen, only the tiles whose layers changed since the last call are redrawn
         :param screen: The screen to format the tiles to
         :return: None
         """
-        print("Reformatting tiles")
-        self.tile_surf = pygame.Surface((screen.get_width(), screen.get_height()), pygame.SRCALPHA | pygame.HWSURFACE | pygame.ASYNCBLIT)
-
-        self.tile_surf.blit(scale_tile(self.load_owm_tile((16, 22)), self.scale),
-                            self.tile.get_rect(center=(screen.get_width() / 2, screen.get_height() / 2)))
-        self.tile_surf.blit(scale_tile(self.load_owm_tile((15, 22)), self.scale), self.tile.get_rect(
-                center=((screen.get_width() / 2) - self.tile.get_rect().width, screen.get_height() / 2)))
-        self.tile_surf.blit(scale_tile(self.load_owm_tile((17, 22)), self.scale), self.tile.get_rect(
-                center=((screen.get_width() / 2) + self.tile.get_rect().width, screen.get_height() / 2)))
-        self.tile_surf.blit(scale_tile(self.load_owm_tile((16, 23)), self.scale), self.tile.get_rect(
-                center=(screen.get_width() / 2, screen.get_height() / 2 + self.tile.get_rect().height)))
-        self.tile_surf.blit(scale_tile(self.load_owm_tile((15, 23)), self.scale), self.tile.get_rect(
-                center=((screen.get_width() / 2) - self.tile.get_rect().width,
-                        screen.get_height() / 2 + self.tile.get_rect().height)))
-        self.tile_surf.blit(scale_tile(self.load_owm_tile((17, 23)), self.scale), self.tile.get_rect(
-                center=((screen.get_width() / 2) + self.tile.get_rect().width,
-                        screen.get_height() / 2 + self.tile.get_rect().height)))
-        self.tile_surf = self.tile_surf.convert_alpha()
+        if self.tile_surf is None or self.tile_surf.get_size() != screen.get_size():
+            self.tile_surf = pygame.Surface(screen.get_size(), pygame.SRCALPHA | pygame.HWSURFACE | pygame.ASYNCBLIT).convert_alpha()
+            self.tile_layers = {}
         self.radar_tiles_last_amount = self.weather.radar_refresh_amount
+        keys = self._layer_keys()
+        width, height = self.tile.get_size()
+        for location in owm_tile_locations:
+            layers = [(key, data) for key, data in ((key, self.weather.radar_tile(key[0], location, key[1], key[2]))
+                                                    for key in keys) if data is not None]
+            previous = self.tile_layers.get(location)
+            if previous is not None and len(previous) == len(layers) and \
+                    all(a[0] == b[0] and a[1] is b[1] for a, b in zip(previous, layers)):
+                continue  # Nothing new for this tile
+            self.tile_layers[location] = layers
+            rect = self.tile.get_rect(center=(screen.get_width() / 2 + (location[0] - 16) * width,
+                                              screen.get_height() / 2 + (location[1] - 22) * height))
+            self.tile_surf.fill((0, 0, 0, 0), rect)
+            if layers:
+                self.tile_surf.blit(scale_tile(self.load_owm_tile(location, layers), self.scale), rect)
 
     def __init__(self, log, weather):
         """
@@ -134,8 +125,12 @@ class Radar:
         self.current_frame_number = 0
         self.last_frame = None
         self.radar_display = True
-        self.playback_buffer = []
+        self.frames = RadarArchive("Caches/Radar_cache/KMQT_Archive/", legacy_directory="Caches/Radar_cache/KMQT_Frames/")
+        self.player = FramePlayer(self.frames)
         self.tile_surf = None
+        self.tile_layers = {}  # location -> the (layer key, tile bytes) drawn into tile_surf
+        self.tile_surfaces = {}  # (location, layer key) -> (tile bytes, decoded surface), oldest first
+        self.tile_surface_limit = 48
         self.v1_layers = []
         self.v2_layers = [("CL", 0, "")]
 
@@ -157,14 +152,28 @@ class Radar:
             self.radar_directory: dict = json.loads(urlopen(self.radar_directory_url).read())
         except Exception as e:
             print(f"Failed to load radar because {e}")
-        self.playing = False
+        self.clock = PlaybackClock()
+        self.crossfader = Crossfader()
+        self.last_draw = None
+
+    @property
+    def playing(self):
+        return self.clock.playing
+
+    @playing.setter
+    def playing(self, playing):
+        if playing == self.clock.playing:
+            return
+        if playing:
+            self.clock.play(self.frames[self.current_frame_number] if len(self.frames) else 0)
+        else:
+            self.clock.pause()
 
     def update_radar(self):
         """
         Updates the radar data
         :return: None
         """
-        self.playback_buffer = []
         self.last_frame = None
         print("Updating radar")
 
@@ -183,11 +192,10 @@ class Radar:
         for frame in self.radar_directory["products"][0]["scans"]:
             name = frame["name"].split("_2_map.png", 1)[0]
             timestamp = frame["timestamp"]
-            if not os.path.exists(os.path.join(f"Caches/Radar_cache/KMQT_Frames/KMQT_{timestamp}.png")):
-                thread = threading.Thread(target=load_frame, args=(name, timestamp))
+            if timestamp not in self.frames:
+                thread = threading.Thread(target=load_frame, args=(name, timestamp, self.frames))
                 thread.start()
                 print(f"Queued frame load for: {name}")
-            # self.playback_buffer.append((radar_raw, timestamp))
         # self.sort_and_load_frames()
 
     def sort_and_load_frames(self):
@@ -196,18 +204,11 @@ class Radar:
         :return: None
         """
 
-        threading.Thread(target=self.weather.update_weather_map, args=(self.v1_layers, self.v2_layers)).start()
+        self.weather.update_weather_map(self.v1_layers, self.v2_layers)
 
-        self.playback_buffer = [f for f in listdir("Caches/Radar_cache/KMQT_Frames/") if isfile(os.path.join("Caches/Radar_cache/KMQT_Frames/", f))]
+        self.player.start()
 
-        self.playback_buffer.sort(key=lambda sort_frame: int(sort_frame.split("_")[1].split(".")[0]))
-
-        while len(self.playback_buffer) > 376:
-            removed = self.playback_buffer.pop(0)
-            os.remove(os.path.join(f"Caches/Radar_cache/KMQT_Frames/{removed}"))
-            print(f"Removing 375th radar cache item [{removed}]")
-
-        self.current_frame_number = len(self.playback_buffer) - 1
+        self.current_frame_number = len(self.frames) - 1
 
     def play_pause(self):
         """
@@ -221,7 +222,7 @@ class Radar:
         Jumps to the current time
         :return: None
         """
-        self.current_frame_number = len(self.playback_buffer) - 1
+        self.current_frame_number = len(self.frames) - 1
         self.playing = False
 
     def draw(self, screen: pygame.Surface):
@@ -236,22 +237,28 @@ class Radar:
             self.format_owm_tiles(screen)
 
         if self.last_frame:
-            radar, last_timestamp = self.last_frame
+            _, last_timestamp = self.last_frame
         else:
             self.sort_and_load_frames()
             last_timestamp = 0
 
-        if (self.last_frame is not None or not self.playing) and self.current_frame_number > 0:
-            frame_file = self.playback_buffer[self.current_frame_number]
-            f = open(f"Caches/Radar_cache/KMQT_Frames/{frame_file}", "rb")
-            image_str = f.read()
-            f.close()
-            image_file = io.BytesIO(image_str)
-            radar = pygame.image.load(image_file).convert_alpha()
-            timestamp = int(frame_file.split("_")[1].split(".")[0])
-            self.last_frame = (radar, timestamp)
-        else:
-            radar, timestamp = self.last_frame
+        now = time.time()
+        stride, fraction = 1, 0
+        if self.playing:
+            # Playback follows the clock, so it runs at the same speed at any frame rate and skips frames it can't show
+            self.current_frame_number, fraction = self.clock.position(self.frames.timestamps, now)
+            if self.last_draw is not None:
+                stride = max(1, int(self.clock.frames_per_second(self.frames.timestamps) * (now - self.last_draw)))
+        self.last_draw = now
+        if not len(self.frames):
+            return
+        radar, timestamp = self.player.frame(self.current_frame_number, stride)
+        if fraction and stride == 1 and self.current_frame_number + 1 < len(self.frames):
+            # Drawing often enough to show every frame, so fade into the next one
+            following, following_timestamp = self.player.frame(self.current_frame_number + 1)
+            radar = self.crossfader.blend(timestamp, radar, following_timestamp, following, fraction)
+            self.player.seek(self.current_frame_number)
+        self.last_frame = (radar, timestamp)
 
         screen.blit(self.background_center, self.background_center.get_rect(center=(screen.get_width() / 2, screen.get_height() / 2)))
         screen.blit(self.background_left, self.background_left.get_rect(
@@ -276,13 +283,9 @@ class Radar:
             screen.blit(self.tile_surf, (0, 0))
 
         screen.blit(self.text(datetime.datetime.fromtimestamp(timestamp).
-                              strftime(f"Frame time: %Y-%m-%d %H:%M:%S | Frame: {self.current_frame_number}/{len(self.playback_buffer) - 1}"
+                              strftime(f"Frame time: %Y-%m-%d %H:%M:%S | Frame: {self.current_frame_number}/{len(self.frames) - 1}"
                                        f" | Overlays: v1{self.v1_layers} + v2{self.v2_layers}")), (0, 0))
         screen.blit(self.text(f"Frame delta: {datetime.timedelta(seconds=timestamp - last_timestamp)}"
                               f" Time delta: T-{(datetime.datetime.now() - datetime.datetime.fromtimestamp(timestamp))}"),
                     (0, 14))
 
-        if self.playing:
-            self.current_frame_number += 1
-            if self.current_frame_number > len(self.playback_buffer) - 1:
-                self.current_frame_number = -30
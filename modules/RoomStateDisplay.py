@@ -18,6 +18,25 @@ def celsius_to_fahrenheit(celsius):
         return 0
 
 
+def occupant_list(occupancy):
+    """
+    Get the occupants with their debounced presence from the presence timeline, falling back to the raw scan results
+    when the coordinator doesn't publish a timeline
+    :param occupancy: The room_occupancy_info state
+    :return: A list of occupant dicts with name, present, updated_at, stable and mac
+    """
+    devices = occupancy.get('occupants', {})
+    timeline = occupancy.get('timeline')
+    if not timeline:
+        return list(devices.values())
+    occupants = []
+    for mac, entry in timeline.items():
+        device = devices.get(mac, {})
+        occupants.append({"name": entry['name'], "present": entry['present'], "updated_at": entry['since'],
+                          "stable": device.get('stable'), "mac": mac})
+    return occupants
+
+
 class Occupancy_display:
 
     def __init__(self, coordinator):
@@ -33,10 +52,11 @@ class Occupancy_display:
         self.refresh()
 
     def refresh(self):
-        occupancy = self.coordinator.get_object_state("room_occupancy_info", True, True)
-        room_data: dict = self.coordinator.get_object_state("room_sensor_data_displayable", False)
-        temp = self.coordinator.get_object_state("temperature", False)
-        humid = self.coordinator.get_object_state("humidity", False)
+        room_state = self.coordinator.snapshot()
+        occupancy = room_state.get("room_occupancy_info")
+        room_data: dict = dict(room_state.get("room_sensor_data_displayable"))
+        temp = room_state.get("temperature")
+        humid = room_state.get("humidity")
         temp = round(celsius_to_fahrenheit(temp), 2) if temp != -9999 else "N/A"
         humid = round(humid, 2) if humid != -1 else "N/A"
         self.lines = []
@@ -57,8 +77,9 @@ class Occupancy_display:
         def sort(occupant):
             return occupant['updated_at']
 
-        present = [occupant for occupant in sorted(occupancy['occupants'].values(), key=sort) if occupant['present'] is True]
-        absent = [occupant for occupant in sorted(occupancy['occupants'].values(), key=sort, reverse=True) if occupant['present'] is False]
+        occupants = occupant_list(occupancy)
+        present = [occupant for occupant in sorted(occupants, key=sort) if occupant['present'] is True]
+        absent = [occupant for occupant in sorted(occupants, key=sort, reverse=True) if occupant['present'] is False]
         max_present_rjust = max([len(occupant['name']) for occupant in present] if len(present) > 0 else [0])
         max_absent_rjust = max([len(occupant['name']) for occupant in absent] if len(absent) > 0 else [0])
         self.lines.append(font2.render(f"------------Currently Present------------", True, pallet_one, pallet_three).convert())
@@ -81,7 +102,14 @@ class Occupancy_display:
             self.side_lines.append(font3.render(f"{value if value is not None else 'N/A'}", True, pallet_one, pallet_three).convert())
 
     def draw(self, screen: pygame.Surface, location):
+        """
+        Draw the occupancy and sensor information
+        :param screen: The screen to draw to
+        :param location: The X,Y location to draw at
+        :return: The screen area that was drawn
+        """
         x, y = location
+        area = pygame.Rect(x, y, screen.get_width() - x, screen.get_height() - 40 - y)
 
         if time.time() - self.last_update > 1:
             self.refresh()
@@ -121,3 +149,4 @@ class Occupancy_display:
                 count += 1
             shift += max_column_width + 10
             pygame.draw.line(screen, pallet_two, (x + 15 + shift, y), (x + 15 + shift, (screen.get_height() - 40)))
+        return area
@@ -1,11 +1,16 @@
+import contextlib
 import json
 import logging
 import os
+import select
 import threading
 import time
+import types
 
 import socket
 
+from . import coordinatorProtocol
+
 api_file = "../APIKey.json"
 temp_file = "Caches/Room_Coordination.json"
 
@@ -69,6 +74,9 @@ class CoordinatorClient:
             self.address = address
             self.port = port
             self.data = data
+            # The states the mirror starts with (from the states template), kept as placeholders when a full resync
+            # from the host doesn't have them
+            self.placeholders = dict(data)
             self.client_name = client_name
             self.auth = auth
             self.password = password
@@ -76,6 +84,261 @@ class CoordinatorClient:
             self.coordinator_available = False
             self.download_in_progress = False
             self.upload_in_progress = False
+            self.protocol = 2
+            # While on v1 after a failed v2 handshake, v2 is tried again from this time
+            self.v2_retry_at = 0
+            self.v2_backoff = 5
+            self.connection = coordinatorProtocol.Connection(address, port, client_name, auth)
+            # The local mirror of the host state is at this revision of this epoch
+            self.revision = 0
+            self.epoch = None
+            self.subscription = coordinatorProtocol.Connection(address, port, client_name, auth,
+                                                               timeout=coordinatorProtocol.SUBSCRIPTION_HEARTBEAT * 3)
+            self.subscribed = False
+            # The sync worker is the only thread that talks to the coordinator, everything else queues work for it
+            self.worker = None
+            self.run_worker = False
+            self.sync_lock = threading.Lock()
+            self.pending_uploads = {}
+            self.refresh_requested = True
+            self.wake_r, self.wake_w = socket.socketpair()
+            self.wake_w.setblocking(False)
+            self.published = types.MappingProxyType(dict(self.data))
+
+        def close(self):
+            """
+            Stop the sync worker and close the persistent connections to the coordinator
+            :return: None
+            """
+            self.run_worker = False
+            self._wake()
+            if self.worker is not None:
+                self.worker.join(5)
+            self.subscribed = False
+            self.connection.close()
+            self.subscription.close()
+
+        def snapshot(self):
+            """
+            Get an immutable view of the last synced state, safe to call from the render loop every frame
+            :return: A read only mapping of the state
+            """
+            return self.published
+
+        def publish(self):
+            """
+            Swap in a new snapshot of the local mirror for readers
+            :return: None
+            """
+            self.published = types.MappingProxyType(dict(self.data))
+
+        def request_refresh(self):
+            """
+            Ask the sync worker to bring the local mirror up to date, returns immediately
+            :return: None
+            """
+            with self.sync_lock:
+                self.refresh_requested = True
+            self._wake()
+
+        def queue_upload(self, changes):
+            """
+            Hand changed states to the sync worker to upload, returns immediately
+            :param changes: The changed states, later changes to the same state replace earlier ones still queued
+            :return: None
+            """
+            with self.sync_lock:
+                self.pending_uploads.update(changes)
+            self._wake()
+
+        def _wake(self):
+            try:
+                self.wake_w.send(b"\0")
+            except (BlockingIOError, OSError):
+                pass  # A wakeup is already pending
+
+        def apply_changes(self, changes):
+            """
+            Merge a state diff from the host into the local mirror
+            :param changes: The diff as returned by the host, a full resync replaces the mirror instead
+            :return: None
+            """
+            if changes.get("full"):
+                # The mirror is shared with readers, so it is changed key by key rather than cleared and refilled
+                for key in list(self.data):
+                    if key not in changes["data"]:
+                        if key in self.placeholders:
+                            self.data[key] = self.placeholders[key]
+                        else:
+                            del self.data[key]
+            for key, value in changes["data"].items():
+                self.data[key] = value
+            for key in changes.get("deleted", []):
+                self.data.pop(key, None)
+            self.revision = changes["revision"]
+            self.epoch = changes["epoch"]
+
+        def download_changes(self):
+            """
+            Bring the local mirror up to date by downloading only the states that changed since the last sync
+            :return: The local mirror of the state
+            """
+            if self.download_in_progress:
+                return self.data
+            self.download_in_progress = True
+            try:
+                response = self._request({"type": "download_changes", "since": self.revision, "epoch": self.epoch})
+                if response is None:
+                    self.download_in_progress = None
+                    return self.download_state()
+                if response.get("status") != "ok":
+                    raise NoCoordinatorData(response.get("status"))
+                self.apply_changes(response)
+            except Exception as e:
+                log.error(f"Error downloading state changes from coordinator webserver: {e}")
+                self.download_in_progress = None
+                self.coordinator_available = False
+                self.data['temperature'] = -9999
+                self.data['humidity'] = -1
+                return self.data
+            self.download_in_progress = None
+            self.coordinator_available = True
+            return self.data
+
+        def start(self):
+            """
+            Start the sync worker thread
+            :return: None
+            """
+            if self.worker is not None:
+                return
+            self.run_worker = True
+            self.worker = threading.Thread(target=self._sync, daemon=True)
+            self.worker.start()
+
+        def _sync(self):
+            """
+            Upload queued changes, refresh on request and keep a subscription to pushed changes open
+            :return: None
+            """
+            last_frame = 0
+            retry_at = 0
+            backoff = 1
+            subscription_id = None
+            while self.run_worker:
+                with self.sync_lock:
+                    uploads, self.pending_uploads = self.pending_uploads, {}
+                    refresh, self.refresh_requested = self.refresh_requested, False
+                if refresh and not self.subscribed:
+                    self.download_changes()
+                    self.publish()
+                if uploads:
+                    try:
+                        self.upload_state(uploads)
+                    except Exception as e:
+                        log.error(f"Failed to upload state: {e}")
+
+                if self.protocol == 2 and not self.subscription.is_open() and time.time() >= retry_at:
+                    try:
+                        subscription_id = self.subscription.send({"type": "subscribe", "since": self.revision,
+                                                                  "epoch": self.epoch})
+                        last_frame = time.time()
+                        self.v2_backoff = 5
+                    except (coordinatorProtocol.UnsupportedProtocol, coordinatorProtocol.HelloDropped) as e:
+                        # Subscriptions need v2, a v1 host is polled over one shot requests instead
+                        self._fall_back_to_v1(e)
+                        self.subscribed = False
+                    except Exception as e:
+                        log.warning(f"Failed to subscribe to coordinator state: {e}, retrying in {backoff} seconds")
+                        retry_at = time.time() + backoff
+                        backoff = min(backoff * 2, 30)
+
+                watched = [self.wake_r]
+                self._probe_v2()
+                if self.protocol == 2:
+                    timeout = max(0, retry_at - time.time())
+                else:
+                    timeout = max(0, self.v2_retry_at - time.time())
+                if self.subscription.is_open():
+                    watched.append(self.subscription.sock)
+                    timeout = coordinatorProtocol.SUBSCRIPTION_HEARTBEAT
+                readable, _, _ = select.select(watched, [], [], timeout)
+                if self.wake_r in readable:
+                    self.wake_r.recv(4096)
+                if not self.subscription.is_open():
+                    continue
+                try:
+                    if self.subscription.sock in readable:
+                        self._receive_pushes(subscription_id)
+                        last_frame = time.time()
+                        backoff = 1
+                        self.v2_backoff = 5
+                    elif last_frame + coordinatorProtocol.SUBSCRIPTION_HEARTBEAT * 3 < time.time():
+                        raise coordinatorProtocol.ProtocolError("No heartbeat from the coordinator")
+                except Exception as e:
+                    if self.run_worker:
+                        log.warning(f"Coordinator state subscription lost: {e}, retrying in {backoff} seconds")
+                    self.subscribed = False
+                    self.subscription.close()
+                    retry_at = time.time() + backoff
+                    backoff = min(backoff * 2, 30)
+
+        def _receive_pushes(self, subscription_id):
+            """
+            Apply every pushed diff that has arrived on the subscription
+            :param subscription_id: The request id of the subscribe request
+            :return: None
+            """
+            while True:
+                response_id, changes = self.subscription.receive()
+                if response_id == subscription_id:
+                    if changes.get("status") != "ok":
+                        raise NoCoordinatorData(changes.get("status"))
+                    if changes.get("type") != "heartbeat":
+                        self.apply_changes(changes)
+                        self.publish()
+                    self.subscribed = True
+                    self.coordinator_available = True
+                if not self.subscription.pending:
+                    return
+
+        def _request(self, message):
+            """
+            Send a request over the persistent connection, falling back to protocol v1 if the host doesn't speak v2
+            :param message: The request message
+            :return: The response message, or None if the host only speaks protocol v1
+            """
+            self._probe_v2()
+            if self.protocol == 1:
+                return None
+            try:
+                response = self.connection.request(message)
+            except (coordinatorProtocol.UnsupportedProtocol, coordinatorProtocol.HelloDropped) as e:
+                self._fall_back_to_v1(e)
+                return None
+            self.v2_backoff = 5
+            return response
+
+        def _fall_back_to_v1(self, e):
+            """
+            Use protocol v1 for a while after a failed v2 handshake, then try v2 again
+            A host that answered in v1 is only retried every 10 minutes (in case it was upgraded), a host that dropped
+            the connection may just have been restarting so it is retried sooner, backing off while it keeps failing
+            :param e: The handshake error
+            :return: None
+            """
+            if isinstance(e, coordinatorProtocol.UnsupportedProtocol):
+                retry = 600
+            else:
+                retry = self.v2_backoff
+                self.v2_backoff = min(self.v2_backoff * 2, 600)
+            log.warning(f"Coordinator did not accept protocol v2, using v1 for {retry} seconds ({e})")
+            self.protocol = 1
+            self.v2_retry_at = time.time() + retry
+
+        def _probe_v2(self):
+            if self.protocol == 1 and time.time() >= self.v2_retry_at:
+                self.protocol = 2
 
         def command_coordinator_restart(self):
             """
@@ -114,27 +377,44 @@ class CoordinatorClient:
                 raise ConnectionError("Connection failed")
             self.coordinator_available = False
 
+        def _download_state_v1(self, selected_state=None):
+            """
+            Download the state over a one shot protocol v1 connection
+            :param selected_state: The name of a single state to download, or None for all of them
+            :return: The downloaded states
+            """
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.connect((self.address, self.port))
+                if selected_state is not None:
+                    request = json.dumps({"client": self.client_name, "auth": self.auth, "type": "download_state", "state": selected_state})
+                else:
+                    request = json.dumps({"client": self.client_name, "auth": self.auth, "type": "download_state"})
+                s.sendall(request.encode())
+                chunks = []
+                while True:
+                    data = s.recv(65536)
+                    if not data:
+                        break
+                    chunks.append(data)
+                return json.loads(b''.join(chunks).decode())
+
         def download_state(self, selected_state=None):
             # print("Downloading state from coordinator webserver")
             if self.download_in_progress:
                 return self.data
             self.download_in_progress = True
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((self.address, self.port))
-                    if selected_state is not None:
-                        request = json.dumps({"client": self.client_name, "auth": self.auth, "type": "download_state", "state": selected_state})
-                    else:
-                        request = json.dumps({"client": self.client_name, "auth": self.auth, "type": "download_state"})
-                    s.sendall(request.encode())
-                    data_buff = b''
-                    while True:
-                        data = s.recv(1024)
-                        if not data:
-                            break
-                        data_buff += data
-                    data = json.loads(data_buff.decode())
-                    # print(f"Downloaded state consists as follows {json.dumps(data, indent=2)}")
+                request = {"type": "download_state"}
+                if selected_state is not None:
+                    request["state"] = selected_state
+                response = self._request(request)
+                if response is None:
+                    data = self._download_state_v1(selected_state)
+                elif response.get("status") != "ok":
+                    raise NoCoordinatorData(response.get("status"))
+                else:
+                    data = response["data"]
+                # print(f"Downloaded state consists as follows {json.dumps(data, indent=2)}")
             except Exception as e:
                 log.error(f"Error downloading state from coordinator webserver: {e}")
                 self.download_in_progress = None
@@ -156,16 +436,11 @@ class CoordinatorClient:
                 raise ConnectionError("Coordinator not available")
             self.upload_in_progress = True
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((self.address, self.port))
-                    request = json.dumps({"client": self.client_name, "auth": self.auth, "type": "upload_state"})
-                    s.sendall(request.encode())
-                    response = s.recv(1024)
-                    log.debug(f"Response from coordinator: {response.decode()}")
-                    s.sendall(json.dumps(state_data).encode())
-                    # response = s.recv(1024)
-                    # print(f"Uploaded state change to coordinator, response: {response.decode()}")
-
+                response = self._request({"type": "upload_state", "data": state_data})
+                if response is None:
+                    self._upload_state_v1(state_data)
+                elif response.get("status") != "ok":
+                    raise NoCoordinatorData(response.get("status"))
             except Exception as e:
                 log.error(f"Error uploading state change to coordinator webserver: {e}")
                 self.upload_in_progress = None
@@ -173,12 +448,30 @@ class CoordinatorClient:
             finally:
                 self.upload_in_progress = None
 
+        def _upload_state_v1(self, state_data):
+            """
+            Upload state over a one shot protocol v1 connection
+            :param state_data: The states to upload
+            :return: None
+            """
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.connect((self.address, self.port))
+                request = json.dumps({"client": self.client_name, "auth": self.auth, "type": "upload_state"})
+                s.sendall(request.encode())
+                response = s.recv(1024)
+                log.debug(f"Response from coordinator: {response.decode()}")
+                s.sendall(json.dumps(state_data).encode())
+                # response = s.recv(1024)
+                # print(f"Uploaded state change to coordinator, response: {response.decode()}")
+
     def __init__(self):
         """
         Initialize the remote thermostat
         """
         self.last_download = 0  # The time of the last download from the thermostat in seconds
         self.last_upload = 0  # The time of the last upload to the thermostat in seconds
+        self.batch_depth = 0
+        self.batch_changes = {}
         if os.path.isfile("Configs/states_template.json"):
             with open("Configs/states_template.json") as f:
                 self.data = json.load(f)
@@ -196,6 +489,7 @@ class CoordinatorClient:
                 self.tablet = tablet_ip, tablet_password
                 self.net_client = self.WebserverClient(self.coordinator_server, 47670, "test", self.coordinator_server_auth,
                                                        self.coordinator_server_password, self.tablet, self.data)
+                self.net_client.start()
         else:
             log.warning("No API file found, configuring dummy server")
             self.net_client = self.WebserverClient("", 47670, "test", None, None, None, self.data)
@@ -209,6 +503,7 @@ class CoordinatorClient:
         :return: None
         """
         self.net_client.coordinator_available = False
+        self.net_client.close()
 
     def silent_read_data(self):
         """
@@ -217,19 +512,12 @@ class CoordinatorClient:
         """
         self.read_data()
 
-    def _read_data(self):
-        """
-        Read the data from the coordinator server
-        :return: None
-        """
-        self.data = self.net_client.download_state()
-
     def read_data(self):
         """
-        Start a thread to read the data from the room coordinator and update the local data
+        Ask the sync worker to update the local data from the room coordinator, never blocks
         :return:
         """
-        threading.Thread(target=self._read_data, args=()).start()
+        self.net_client.request_refresh()
 
     def read_states(self):
         """
@@ -270,20 +558,52 @@ class CoordinatorClient:
         """
         Get the state of an object from the coordinator
         :param object_name: The name of the object
-        :param update: If True, update the data from the coordinator
-        :param dameon: If True, updating the data from the coordinator will be done in a daemon thread
+        :param update: If True, ask the sync worker to update the data from the coordinator
+        :param dameon: Unused, updates are always done by the sync worker
         :return: The state of the object
         """
         if update:
-            if dameon:
-                self.read_data()
-            else:
-                self.net_client.download_state()
-        if object_name in self.data:
-            return self.data[object_name]
+            self.read_data()
+        state = self.net_client.snapshot()
+        if object_name in state:
+            return state[object_name]
         else:
             raise UnknownObjectError(object_name)
 
+    def snapshot(self):
+        """
+        Get an immutable view of the whole room state, reading it never touches the network
+        :return: A read only mapping of the state
+        """
+        return self.net_client.snapshot()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group state changes so they are sent to the coordinator as a single upload
+        :return: A context manager
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+        if not self.batch_depth and self.batch_changes:
+            changes, self.batch_changes = self.batch_changes, {}
+            self.net_client.queue_upload(changes)
+
+    def _upload(self, changes):
+        """
+        Publish changed states locally and queue them for upload, or hold on to them until the current batch ends
+        :param changes: The changed states
+        :return: None
+        """
+        self.net_client.publish()
+        if self.batch_depth:
+            self.batch_changes.update(changes)
+            return
+        self.net_client.queue_upload(changes)
+
     def set_object_state(self, object_name, state):
         """
         Set the state of an object on the coordinator
@@ -293,10 +613,7 @@ class CoordinatorClient:
         :return:
         """
         self.data[object_name] = state
-        try:
-            self.net_client.upload_state({object_name: self.data[object_name]})
-        except Exception as e:
-            log.error("Failed to upload state: {}".format(e))
+        self._upload({object_name: state})
 
     def set_object_states(self, object_name, **kwargs):
         """
@@ -306,11 +623,11 @@ class CoordinatorClient:
         :param states: The state to set
         :return:
         """
-        if not isinstance(self.data[object_name], dict):
-            self.data[object_name] = {}
-        for key, value in kwargs.items():
-            self.data[object_name][key] = value
-        self.net_client.upload_state({object_name: self.data[object_name]})
+        # Build a new dict rather than editing in place so snapshots already handed out never change
+        state = dict(self.data[object_name]) if isinstance(self.data[object_name], dict) else {}
+        state.update(kwargs)
+        self.data[object_name] = state
+        self._upload({object_name: state})
 
     def set_big_humid_state(self, state):
         """
@@ -319,7 +636,7 @@ class CoordinatorClient:
         :return: None
         """
         self.data['big_humid_state'] = state
-        self.net_client.upload_state({'big_humid_state': state})
+        self._upload({'big_humid_state': state})
 
     def get_temperature(self):
         """
@@ -341,7 +658,7 @@ class CoordinatorClient:
         :return: The current temperature setpoint of the room in Celsius
         """
         if update:
-            self.net_client.download_state()
+            self.read_data()
         return self.data['temp_set_point']
 
     def get_humidity_setpoint(self, update=True):
@@ -350,7 +667,7 @@ class CoordinatorClient:
         :return: The current humidity setpoint of the room in relative humidity
         """
         if update:
-            self.net_client.download_state()
+            self.read_data()
         return self.data['humid_set_point']
 
     def set_temperature(self, temperature):
@@ -386,7 +703,7 @@ class CoordinatorClient:
         :return: False if the upload is rate limited, None otherwise
         """
 
-        self.net_client.upload_state(self.data)
+        self._upload(dict(self.data))
 
     def _download_data(self):
         """
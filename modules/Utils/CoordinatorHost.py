@@ -1,14 +1,20 @@
+import contextlib
 import json
 import logging
 import os
 import threading
 import time
 import traceback
+import types
 import datetime
 import socket
 
 import psutil
 
+from . import coordinatorServer
+from . import statePersistence
+from . import versionedState
+
 try:
     import Adafruit_DHT
     import RPi.GPIO as GPIO
@@ -18,6 +24,7 @@ except ImportError:
 api_file = "../APIKey.json"
 save_file = "Caches/Room_Coordination.json"
 backup_file = "Caches/Room_Coordination_Backup.json"
+journal_file = "Caches/Room_Coordination.journal"
 
 log = logging.getLogger(__name__)
 
@@ -97,10 +104,19 @@ def get_ip():
 class CoordinatorHost:
     class WebServerHost:
 
-        def __init__(self, host, port, auth, data: dict):
+        def __init__(self, host, port, auth, data: dict, override_host=True, max_connections=64):
+            """
+            Serve the room state to the coordinator clients
+            :param host: The address to host on
+            :param port: The port to host on
+            :param auth: The authentication token clients have to present
+            :param data: The initial room state
+            :param override_host: If True, host on the detected IP address when it doesn't match the given one
+            :param max_connections: The most client connections served at once
+            """
             self.host = host
             self.port = port
-            self.data = data
+            self.data = versionedState.VersionedState(data)
             self.auth = auth
             self.download_in_progress = False
             self.upload_in_progress = False
@@ -109,98 +125,124 @@ class CoordinatorHost:
             if os.path.isfile(os.path.join("Configs/approved_actions.json")):
                 with open(os.path.join("Configs/approved_actions.json"), "r") as f:
                     self.approved_actions = json.load(f)
+            self.scan_stats = None  # Returns the occupancy scan counters, served on request instead of replicated
             self.run_server = True
-            ip = get_ip()
-            if ip != self.host:
-                log.warning(f"Coordinator IP address is {ip} but {self.host} was specified in the config file")
-                self.host = ip
-                self.thread = threading.Thread(target=self.run, daemon=True).start()
-                # self.coordinator_available = False
-            else:
-                self.thread = threading.Thread(target=self.run, daemon=True).start()
+            if override_host:
+                ip = get_ip()
+                if ip != self.host:
+                    log.warning(f"Coordinator IP address is {ip} but {self.host} was specified in the config file")
+                    self.host = ip
+            self.server = coordinatorServer.Server(self.host, self.port, self, max_connections=max_connections)
+            self.data.add_listener(self.server.notify_change)
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
 
         def run(self):
             log.debug(f"Starting Coordinator Websocket on {self.host}:{self.port}")
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind((self.host, self.port))
-                log.debug(f"Coordinator Websocket on {self.host}:{self.port} started")
-                while self.run_server:
-                    s.listen()
-                    conn, addr = s.accept()
-                    threading.Thread(target=self.connect, args=(conn, addr)).start()
-
-        def connect(self, conn, addr):
-            with conn:
-                log.debug('Connected by', addr)
-                raw_request = conn.recv(1024)
-                log.debug(f"Request: {raw_request}")
-                request = json.loads(raw_request.decode())
-                if request["auth"] == self.auth:
-                    log.debug(f"Client {request['client']} has connected and been authenticated")
-                else:
-                    log.debug(f"{self.auth} != {request['auth']}")
-                    log.warning(f"Client {request['client']} has connected but has not been authenticated")
-                    conn.sendall(b'{"status": "Forbidden: 403"}')
-                    return
-
-                if request['type'] == "download_state":
-                    self.upload_in_progress = True
-                    if "state" in request.keys():
-                        if request["state"] in self.data.keys():
-                            conn.sendall(json.dumps({request["state"]: self.data[request["state"]]}).encode())
-                        else:
-                            conn.sendall(b'No state found')
-                    else:
-                        conn.sendall(json.dumps(self.data).encode())
+            try:
+                self.server.serve_forever()
+            except Exception as e:
+                log.error(f"Coordinator Websocket on {self.host}:{self.port} has stopped: {e}")
+                self.run_server = False
+
+        def close(self):
+            """
+            Shut the server down, buffered responses are flushed before the connections are closed
+            :return: None
+            """
+            self.run_server = False
+            self.server.close()
+
+        def stats(self):
+            """
+            Get the server counters
+            :return: A dict of connection, byte and latency counters
+            """
+            return self.server.stats.to_dict()
+
+        def download(self, selected_state=None):
+            """
+            Get the room state to send to a client
+            :param selected_state: The name of a single state to send, or None for all of them
+            :return: A dict of the requested states, or None if the selected state doesn't exist
+            """
+            with self.data.lock:
+                if selected_state is None:
+                    return dict(self.data)
+                if selected_state in self.data.keys():
+                    return {selected_state: self.data[selected_state]}
+                return None
+
+        def upload(self, client, data: dict):
+            """
+            Apply state uploaded by a client
+            :param client: The name of the client that uploaded the data
+            :param data: The uploaded states
+            :return: None
+            """
+            # Update values that are matching in the updated data
+            for key in data.keys():
+                self.data[key] = data[key]
+            log.debug(f"Client {client} has uploaded new room state data")
+
+        def handle_message(self, client, message: dict):
+            """
+            Handle a single protocol v2 request
+            :param client: The name of the client that sent the request
+            :param message: The request message
+            :return: The response message
+            """
+            request_type = message.get("type")
+            if request_type == "download_state":
+                self.upload_in_progress = True
+                try:
+                    data = self.download(message.get("state"))
+                finally:
                     self.upload_in_progress = None
-                elif request['type'] == "upload_state":
-                    self.download_in_progress = True
-                    log.debug(f"Client {request['client']} is uploading new state data")
-                    conn.sendall(b'up-ready')  # Let the client know that we are ready to receive data
-                    data_buff = b''
-                    try:
-                        while True:
-                            data = conn.recv(1024)
-                            if not data:
-                                break
-                            data_buff += data
-                        data: dict = json.loads(data_buff.decode())
-                        # Update values that are matching in the updated data
-                        for key in data.keys():
-                            self.data[key] = data[key]
-                        # print(self.data)
-                        log.debug(f"Client {request['client']} has uploaded new room state data")
-                        # conn.sendall(b'ack')  # Acknowledge the new state data was received and updated
-                    except Exception as e:
-                        log.warning(f"Client {request['client']} has failed to upload proper room state data")
-                        log.warning(e)
-                        # conn.sendall(b'503: ' + bytes(str(e)))  # Let the client know that the new state data was received but not understood
-                    finally:
-                        self.download_in_progress = None
-                elif request['type'] == "preform_action":
-                    self.download_in_progress = True
-                    log.debug(f"Client {request['client']} is requesting an action to be preformed")
-                    conn.sendall(b'command-ready')
-                    data_buff = b''
-                    while True:
-                        data = conn.recv(1024)
-                        if not data:
-                            break
-                        data_buff += data
-                    data: dict = json.loads(data_buff.decode())
-                    action = self.approved_actions(data['action'])
-                    if data['auth'] == action['auth']:
-                        log.debug(f"Client {request['client']} has requested action {action['name']} be preformed")
-                        if action['action_type'] == "internal_code_execution":
-                            code = ""
-                            for line in action['code']:
-                                code += line + "\n"
-                            exec(code)
-                else:
-                    log.warning(f"Client {request['client']} has requested unknown action {request['type']}")
-                    conn.sendall(b'404')  # Acknowledge the request was received but not understood
-
-            log.debug(f"Connection with client {request['client']} (action: {request['type']}) has been closed")
+                if data is None:
+                    return {"status": "No state found"}
+                return {"status": "ok", "data": data}
+            elif request_type == "download_changes":
+                self.upload_in_progress = True
+                try:
+                    return self.data.changes_since(message.get("since", 0), message.get("epoch"))
+                finally:
+                    self.upload_in_progress = None
+            elif request_type == "upload_state":
+                self.download_in_progress = True
+                try:
+                    self.upload(client, message["data"])
+                finally:
+                    self.download_in_progress = None
+                return {"status": "ok"}
+            elif request_type == "ping":
+                return {"status": "ok"}
+            elif request_type == "server_stats":
+                return {"status": "ok", "stats": self.stats()}
+            elif request_type == "scan_stats":
+                if self.scan_stats is None:
+                    return {"status": "No occupancy detector"}
+                return {"status": "ok", "stats": self.scan_stats()}
+            log.warning(f"Client {client} has requested unknown action {request_type}")
+            return {"status": "404"}
+
+        def perform_action(self, client, data: dict):
+            """
+            Run an approved action requested by a client, on its own thread since actions can take a while
+            :param client: The name of the client that requested the action
+            :param data: The action request, holding the action name and its auth
+            :return: None
+            """
+            action = self.approved_actions[data['action']]
+            if data['auth'] != action['auth']:
+                log.warning(f"Client {client} has requested action {data['action']} without the right auth")
+                return
+            log.debug(f"Client {client} has requested action {action['name']} be preformed")
+            if action['action_type'] == "internal_code_execution":
+                code = ""
+                for line in action['code']:
+                    code += line + "\n"
+                threading.Thread(target=exec, args=(code, globals(), {"self": self, "client": client}), daemon=True).start()
 
     def __init__(self, coprocessor):
         """
@@ -223,7 +265,11 @@ class CoordinatorHost:
         self.last_download = time.time()
         self.net_client = self.WebServerHost(self.coordinator_server, 47670, self.coordinator_server_password,
                                              self.data)
+        # The displayable sensor strings (uptimes and the like) are rebuilt every pass, so they aren't saved
+        self.persistence = statePersistence.StatePersistence(self.net_client.data, save_file, backup_file, journal_file,
+                                                             volatile=("room_sensor_data_displayable",))
         self._load_data()
+        self.persistence.start()
         self.coprocessor = coprocessor
         self.data = self.net_client.data
         self.data['errors'] = []
@@ -237,17 +283,23 @@ class CoordinatorHost:
         if os.path.isfile(os.path.join("Configs/occupants.json")):
             with open(os.path.join("Configs/occupants.json"), "r") as f:
                 self.occupancy_detector = occupancyDetector.OccupancyDetector(json.load(f), 24, self)
+            self.net_client.scan_stats = self.occupancy_detector.scan_stats
         try:
             import Adafruit_DHT
             self.sensor = Adafruit_DHT.DHT22
         except Exception as e:
             self.data['errors'].append(f"Init error: {str(e)}")
         self.last_save = 0
+        self.published = None
+        self.published_revision = None
+        self.thermostat_requested = threading.Event()
+        threading.Thread(target=self._thermostat_worker, daemon=True).start()
         self.read_data()
         self._save_data()
 
     def close_server(self):
-        self.net_client.run_server = False
+        self.net_client.close()
+        self.persistence.stop()
 
     def is_connected(self):
         return self.net_client.run_server
@@ -271,95 +323,92 @@ class CoordinatorHost:
         state = self.coprocessor.get_state(target_arduino=0)
         state_2 = self.coprocessor.get_state(target_arduino=1)
 
-        self.set_object_states("room_sensor_data_displayable", CSERV_uptime=time_delta_to_str(round(time.time() - self.start_time)),
-                               Pi_uptime=time_delta_to_str(int(time.time() - psutil.boot_time())), room_air_sensor_power=self.sensor_powered)
+        # Publish every sensor and occupancy update from this pass as one revision and one save
+        with self.batch():
+            self.set_object_states("room_sensor_data_displayable", CSERV_uptime=time_delta_to_str(round(time.time() - self.start_time)),
+                                   Pi_uptime=time_delta_to_str(int(time.time() - psutil.boot_time())), room_air_sensor_power=self.sensor_powered)
 
-        if self.get_object_state("tablet_battery_state") is not None \
-                and self.get_object_state("tablet_last_update") + 120 > time.time():
-            self.set_object_states("room_sensor_data_displayable",
-                                   tablet_battery=self.get_object_state("tablet_battery_state"))
-        else:
-            self.set_object_states("room_sensor_data_displayable",
-                                   tablet_battery=f"Offline- {time_delta_to_str(time.time() - self.get_object_state('tablet_last_update'))} ago")
-
-        if self.coprocessor.connected[0] and len(data) > 1:
-            self.set_object_states("room_sensor_data_displayable",
-                                   # room_air_sensor=f"T:{str(room_temp).zfill(5)}°F | H:{str(room_humidity).zfill(4)}%",
-                                   carbon_monoxide_sensor=f"{data[1].decode('utf-8')} ppm {'- High!' if float(decode_num(data, 2)) > 25 else ''}",
-                                   gas_smoke_sensor=f"{decode(data, 2)} ppm {'- High!' if float(decode_num(data, 2)) > 25 else ''}",
-                                   combustible_gas_sensor=f"{decode(data, 3)} ppm {'- High!' if float(decode_num(data, 3)) > 5 else ''}",
-                                   motion_sensor=True if data[4].decode('utf-8') == "1" else False,
-                                   light_sensor=f"{data[0].decode('utf-8')}%",
-                                   lcd_backlight="On" if state[4] != 0 else "Off")
-        else:
-            # self.set_object_state("temperature", -9999)
-            # self.set_object_state("humidity", -1)
-            self.set_object_states("room_sensor_data_displayable", room_air_sensor=None, carbon_monoxide_sensor=None,
-                                   gas_smoke_sensor=None,
-                                   buzzer_alarm=None, light_sensor=None, combustible_gas_sensor=None,
-                                   motion_sensor=None, lcd_backlight=None)
-
-        if self.coprocessor.connected[1] and len(data_2) > 1:
-            radiator_temp = c_f(data_2[0].decode('utf-8')) if data_2[0].decode('utf-8') != "Error" else None
-            wind_temp = c_f(data_2[1].decode('utf-8')) if data_2[1].decode('utf-8') != "Error" else None
-            self.set_object_states("room_sensor_data_displayable",
-                                   radiator_temperature=f"T:{radiator_temp if not isinstance(radiator_temp, float) else round(radiator_temp, 3)}°F",
-                                   window_air_sensor=f"T:{wind_temp if not isinstance(wind_temp, float) else str(round(wind_temp, 2)).zfill(5)}°F"
-                                                     f" | H:ERROR%",
-                                   infrared_sensor=f"{data_2[3].decode('utf-8')}% - Floating",
-                                   vibration_sensor=f"{False if decode_num(data_2, 4) != 0 else True} - Floating",
-                                   sound_sensor=f"{False if decode_num(data_2, 5) != 0 else True} - Floating",
-                                   voltage_sensor=f"{data_2[6].decode('utf-8')}V - Floating")
-            # {str((data_2[2].decode('utf-8')).split('.')[0])}
-        else:
-            self.set_object_states("room_sensor_data_displayable", radiator_temperature=None, window_air_sensor=None,
-                                   sensors_on_bus_b=None,
-                                   infrared_sensor=None, vibration_sensor=None, sound_sensor=None, voltage_sensor=None)
-
-        if self.coprocessor.connected[0] and len(data) > 1 and self.coprocessor.connected[1] and len(data_2) > 1:
-            self.set_object_states("room_sensor_data_displayable", arduino_connections=f"All Online")
-        elif self.coprocessor.connected[0] and len(data) > 1:
-            self.set_object_states("room_sensor_data_displayable", arduino_connections=f"Arduino B Offline")
-        elif self.coprocessor.connected[1] and len(data_2) > 1:
-            self.set_object_states("room_sensor_data_displayable", arduino_connections=f"Arduino A Offline")
-        else:
-            self.set_object_states("room_sensor_data_displayable", arduino_connections=f"All Offline")
+            if self.get_object_state("tablet_battery_state") is not None \
+                    and self.get_object_state("tablet_last_update") + 120 > time.time():
+                self.set_object_states("room_sensor_data_displayable",
+                                       tablet_battery=self.get_object_state("tablet_battery_state"))
+            else:
+                self.set_object_states("room_sensor_data_displayable",
+                                       tablet_battery=f"Offline- {time_delta_to_str(time.time() - self.get_object_state('tablet_last_update'))} ago")
+
+            if self.coprocessor.connected[0] and len(data) > 1:
+                self.set_object_states("room_sensor_data_displayable",
+                                       # room_air_sensor=f"T:{str(room_temp).zfill(5)}°F | H:{str(room_humidity).zfill(4)}%",
+                                       carbon_monoxide_sensor=f"{data[1].decode('utf-8')} ppm {'- High!' if float(decode_num(data, 2)) > 25 else ''}",
+                                       gas_smoke_sensor=f"{decode(data, 2)} ppm {'- High!' if float(decode_num(data, 2)) > 25 else ''}",
+                                       combustible_gas_sensor=f"{decode(data, 3)} ppm {'- High!' if float(decode_num(data, 3)) > 5 else ''}",
+                                       motion_sensor=True if data[4].decode('utf-8') == "1" else False,
+                                       light_sensor=f"{data[0].decode('utf-8')}%",
+                                       lcd_backlight="On" if state[4] != 0 else "Off")
+            else:
+                # self.set_object_state("temperature", -9999)
+                # self.set_object_state("humidity", -1)
+                self.set_object_states("room_sensor_data_displayable", room_air_sensor=None, carbon_monoxide_sensor=None,
+                                       gas_smoke_sensor=None,
+                                       buzzer_alarm=None, light_sensor=None, combustible_gas_sensor=None,
+                                       motion_sensor=None, lcd_backlight=None)
+
+            if self.coprocessor.connected[1] and len(data_2) > 1:
+                radiator_temp = c_f(data_2[0].decode('utf-8')) if data_2[0].decode('utf-8') != "Error" else None
+                wind_temp = c_f(data_2[1].decode('utf-8')) if data_2[1].decode('utf-8') != "Error" else None
+                self.set_object_states("room_sensor_data_displayable",
+                                       radiator_temperature=f"T:{radiator_temp if not isinstance(radiator_temp, float) else round(radiator_temp, 3)}°F",
+                                       window_air_sensor=f"T:{wind_temp if not isinstance(wind_temp, float) else str(round(wind_temp, 2)).zfill(5)}°F"
+                                                         f" | H:ERROR%",
+                                       infrared_sensor=f"{data_2[3].decode('utf-8')}% - Floating",
+                                       vibration_sensor=f"{False if decode_num(data_2, 4) != 0 else True} - Floating",
+                                       sound_sensor=f"{False if decode_num(data_2, 5) != 0 else True} - Floating",
+                                       voltage_sensor=f"{data_2[6].decode('utf-8')}V - Floating")
+                # {str((data_2[2].decode('utf-8')).split('.')[0])}
+            else:
+                self.set_object_states("room_sensor_data_displayable", radiator_temperature=None, window_air_sensor=None,
+                                       sensors_on_bus_b=None,
+                                       infrared_sensor=None, vibration_sensor=None, sound_sensor=None, voltage_sensor=None)
+
+            if self.coprocessor.connected[0] and len(data) > 1 and self.coprocessor.connected[1] and len(data_2) > 1:
+                self.set_object_states("room_sensor_data_displayable", arduino_connections=f"All Online")
+            elif self.coprocessor.connected[0] and len(data) > 1:
+                self.set_object_states("room_sensor_data_displayable", arduino_connections=f"Arduino B Offline")
+            elif self.coprocessor.connected[1] and len(data_2) > 1:
+                self.set_object_states("room_sensor_data_displayable", arduino_connections=f"Arduino A Offline")
+            else:
+                self.set_object_states("room_sensor_data_displayable", arduino_connections=f"All Offline")
 
-        motion_time_delta = time.time() - self.occupancy_detector.last_motion_time
-        # print(f"Motion time delta: {motion_time_delta}")
-        if self.occupancy_detector.last_motion_time == 0:
-            self.set_object_states("room_sensor_data_displayable", last_motion="Unknown")
-        else:
-            self.set_object_states("room_sensor_data_displayable",
-                                   last_motion=f"{time_delta_to_str(motion_time_delta)} ago")
+            motion_time_delta = time.time() - self.occupancy_detector.last_motion_time
+            # print(f"Motion time delta: {motion_time_delta}")
+            if self.occupancy_detector.last_motion_time == 0:
+                self.set_object_states("room_sensor_data_displayable", last_motion="Unknown")
+            else:
+                self.set_object_states("room_sensor_data_displayable",
+                                       last_motion=f"{time_delta_to_str(motion_time_delta)} ago")
+
+            occupied = self.occupancy_detector.is_occupied()
+            self.set_object_states("room_occupancy_info", room_occupied=occupied,
+                                   last_motion=self.occupancy_detector.last_motion_time,
+                                   bt_error=self.occupancy_detector.is_errored(),
+                                   occupants=self.occupancy_detector.occupancy_info(),
+                                   timeline=self.occupancy_detector.timeline_info(),
+                                   room_timeline=self.occupancy_detector.room_timeline_info())
 
         if motion_time_delta < 30:
             self.coprocessor.update_lcd_backlight_state(override=True, override_state=1)
         else:
             self.coprocessor.update_lcd_backlight_state()
 
-        if self.occupancy_detector.is_occupied():
-            self.set_object_states("room_occupancy_info", room_occupied=True,
-                                   last_motion=self.occupancy_detector.last_motion_time,
-                                   bt_error=self.occupancy_detector.is_errored(),
-                                   occupants=self.occupancy_detector.occupancy_info(),
-                                   logs=self.occupancy_detector.stalker.stalker_logs)
-            return True
-        else:
-            self.set_object_states("room_occupancy_info", room_occupied=False,
-                                   last_motion=self.occupancy_detector.last_motion_time,
-                                   bt_error=self.occupancy_detector.is_errored(),
-                                   occupants=self.occupancy_detector.occupancy_info(),
-                                   logs=self.occupancy_detector.stalker.stalker_logs)
-            return False
+        return occupied
 
     def read_data(self):
         """
-        Start a thread to read the data from the local thermostat
+        Ask the thermostat thread to read the data from the local thermostat
         :return:
         """
         self.last_download = time.time()
-        thread = threading.Thread(target=self._read_thermostat, args=(), daemon=True).start()
+        self.thermostat_requested.set()
         self.occupancy_detector.check_inventory()
         if time.time() - self.occupancy_detector.last_motion_time < 30 or self.occupancy_detector.last_motion_time == 0:
             self.occupancy_detector.run_stalk()
@@ -371,6 +420,16 @@ class CoordinatorHost:
         """
         self.last_download = time.time()
 
+    def _thermostat_worker(self):
+        """
+        Read the local thermostat whenever a read is requested, the sensor is slow so this keeps it off the main loop
+        :return:
+        """
+        while True:
+            self.thermostat_requested.wait()
+            self.thermostat_requested.clear()
+            self._read_thermostat()
+
     def _read_thermostat(self):
         """
         Read the data from the local thermostat
@@ -432,66 +491,34 @@ class CoordinatorHost:
 
     def _save_data(self):
         """
-        Save the thermostat data to a file to be read by remote thermostats
+        Stamp the room state with the save time, the state itself is written to disk by the persistence thread
         :return:
         """
         if not self.last_save + 30 < time.time():
             return
         self.net_client.data['last_update'] = time.time()
-        # Move the last save file to a backup folder
-        log.debug("Preforming save of room state data...")
-        if os.path.isfile(save_file):
-            try:
-                os.renames(os.path.join("/home/pi/Downloads/modules", save_file),
-                           os.path.join("/home/pi/Downloads/modules", backup_file))
-            except Exception as e:
-                log.error(f"Failed to rename {save_file} to {backup_file}: {e}")
-        else:
-            log.warning("Main coordination save file missing, cannot backup missing file")
-        try:
-            with open(save_file, "w") as f:
-                json.dump(self.net_client.data, f, indent=2)
-            os.chmod(save_file, 0o777)
-        except Exception as e:
-            log.error(f"Failed to save room state data: {e}")
         self.last_save = time.time()
 
     def _load_data(self):
         """
-        Load the room coordination data from a file for persistent state after a restart
+        Load the room coordination data from the last snapshot and journal for persistent state after a restart
         :return:
         """
-        def load_backup():
-            if os.path.isfile(backup_file):
-                try:
-                    with open(backup_file) as f2:
-                        self.net_client.data = json.load(f2)
-                        log.info("Loaded backup file")
-                except json.JSONDecodeError:
-                    log.error("Failed to load backup file, corrupt file or empty file")
-                    log.warning("Rebuilding room data from scratch")
-                except Exception as e:
-                    log.error(f"Failed to load backup file: {e}")
-                    log.warning("Rebuilding room data from scratch")
-
-        if os.path.isfile(save_file):
-            try:
-                with open(save_file) as f:
-                    try:
-                        self.net_client.data = json.load(f)
-                        log.info("Loaded data from main save file")
-                    except json.JSONDecodeError:
-                        log.warning("Failed to load data from file, corrupt file or empty file attempting to load backup")
-                        load_backup()
-            except Exception as e:
-                log.error(f"Unable to open main save file because: {e}")
-                log.info("Attempting to load backup file")
-                load_backup()
-        elif os.path.isfile(backup_file):
-            log.warning("No save file found, attempting to load backup")
-            load_backup()
-        else:
+        try:
+            data = self.persistence.load()
+        except Exception as e:
+            log.error(f"Failed to load room state: {e}")
+            log.warning("Rebuilding room data from scratch")
+            return
+        if data is None:
             log.error("No primary or backup file found, creating new file")
+            return
+        occupancy = data.get("room_occupancy_info")
+        if isinstance(occupancy, dict) and ("scan_stats" in occupancy or "logs" in occupancy):
+            # Saved before these stopped being replicated, drop them rather than serve them stale forever
+            data["room_occupancy_info"] = {key: value for key, value in occupancy.items()
+                                           if key not in ("scan_stats", "logs")}
+        self.net_client.data.replace(data)
 
     def get_object_state(self, object_name, update=True, dameon=False):
         """
@@ -506,6 +533,18 @@ class CoordinatorHost:
         else:
             return None
 
+    def snapshot(self):
+        """
+        Get an immutable view of the whole room state, only rebuilt when the state has changed
+        :return: A read only mapping of the state
+        """
+        revision = (self.data.epoch, self.data.revision)
+        if self.published_revision != revision:
+            with self.data.lock:
+                self.published_revision = (self.data.epoch, self.data.revision)
+                self.published = types.MappingProxyType(dict(self.data))
+        return self.published
+
     def set_object_state(self, object_name, object_state):
         """
         Set the state of an object on the coordinator
@@ -514,7 +553,8 @@ class CoordinatorHost:
         :return:
         """
         self.data[object_name] = object_state
-        self._save_data()
+        if not self.data.batch_depth:
+            self._save_data()
 
     def set_object_states(self, object_name, **kwargs):
         """
@@ -523,11 +563,35 @@ class CoordinatorHost:
         :param kwargs: The state of the object via keyword arguments
         :return:
         """
-        if object_name not in self.data:
-            self.data[object_name] = {}
-        for key, value in kwargs.items():
-            self.data[object_name][key] = value
-        self._save_data()
+        with self.data.lock:
+            current = self.data.get(object_name)
+            if not isinstance(current, dict):
+                current = {}
+            changed = object_name not in self.data
+            for key, value in kwargs.items():
+                # The same list or dict passed back in may have been edited in place, so it always counts as changed
+                if key not in current or current[key] != value or (current[key] is value and isinstance(value, (dict, list))):
+                    changed = True
+                    break
+            if changed:
+                # Build a new dict rather than editing in place so snapshots already handed out never change
+                state = dict(current)
+                state.update(kwargs)
+                dict.__setitem__(self.data, object_name, state)  # Skips the equality check, touch() publishes it
+                self.data.touch(object_name)
+        if not self.data.batch_depth:
+            self._save_data()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group state changes so they are committed as a single revision and a single save
+        :return: A context manager
+        """
+        with self.data.batch():
+            yield self
+        if not self.data.batch_depth:
+            self._save_data()
 
     def maintain_temperature(self):
         """
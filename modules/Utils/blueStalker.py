@@ -1,28 +1,31 @@
 import datetime
 import logging
-import random
 import threading
 import time
 import traceback
 
 import bluetooth
 
+from . import scanEngine
+
 logging.getLogger(__name__)
 
 
 class BlueStalker:
 
-    def __init__(self, target_devices: list, targets: dict):
+    def __init__(self, target_devices: list, targets: dict, workers=3, connect_timeout=8):
+        """
+        Detects occupants by trying to connect to their phones over RFCOMM
+        :param target_devices: A list of [name, mac, priority] for every device to look for
+        :param targets: The occupant states from the last run
+        :param workers: How many devices are probed at once
+        :param connect_timeout: The longest a single connect attempt may hold the radio, in seconds
+        """
         self.target_devices = target_devices
-        self.non_priority_devices = []
-        for target in self.target_devices:
-            if target[2] is False:
-                self.non_priority_devices.append(target)
+        self.connect_timeout = connect_timeout
         self.failed_attempts = 0
         self.ready = False
         self.total_devices_detected = 0
-        self.seek_offset = 0
-        self.max_seek = 2
         self.room_occupied = True
         self.targets = targets.copy()
         self.temp_targets = targets
@@ -31,23 +34,30 @@ class BlueStalker:
                 self.targets[target[1]] = {"name": target[0], "updated_at": 0, "present": None, "stable": None, "mac": target[1],
                                            "priority": target[2]}
         self.socket_connections = []
-        self.already_stalking = False
+        self.lock = threading.Lock()
         self.stalk_error = False
         self.stalker_logs = []
+        self.engine = scanEngine.ScanEngine(self.seek_device, workers=workers)
+        for target_name, target_mac, priority in self.target_devices:
+            self.engine.add_device(target_mac, target_name, priority)
 
     def check_inventory(self):
-        for sock, mac_address in self.socket_connections:
+        with self.lock:
+            connections = list(self.socket_connections)
+        for sock, mac_address in connections:
             try:
                 logging.debug(f"[*] Checking if {mac_address} is still connected")
                 sock.getpeername()  # Check if the socket is alive
                 # self.stalker_logs.append(f"[*] {mac_address} is still connected")
             except bluetooth.BluetoothError:  # If not, remove it from the connected socket list
                 logging.info(f"[!] {mac_address} is not connected anymore")
-                self.socket_connections.remove((sock, mac_address))
+                with self.lock:
+                    self.socket_connections.remove((sock, mac_address))
                 if self.targets[mac_address]['present'] is not False:
                     self.targets[mac_address]['updated_at'] = time.time()
                 self.targets[mac_address]['present'] = False
                 self.targets[mac_address]['stable'] = False
+                self.engine.probe_soon(mac_address)  # It may just have dropped the connection
 
         if len(self.socket_connections) > 0:
             self.room_occupied = True
@@ -55,28 +65,47 @@ class BlueStalker:
         else:
             self.room_occupied = False
 
-    def seek_device(self, target_name: str, target_mac: str):
+    def seek_device(self, target_mac: str, target_name: str):
+        """
+        Try to connect to a device, called from the scan engine's workers
+        :param target_mac: The device's MAC address
+        :param target_name: The device's name
+        :return: True if the device is present
+        """
+        with self.lock:
+            if any(mac_address == target_mac for _, mac_address in self.socket_connections):
+                logging.debug(f"[*] {target_mac}: {target_name} is already connected")
+                self.targets[target_mac]['present'] = True
+                self.targets[target_mac]['stable'] = True
+                return True
+        sock = None
         try:
             print("[*] Attempting to connect to " + target_name)
             logging.debug("[*] Attempting to connect to " + target_name)
             sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+            sock.settimeout(self.connect_timeout)
             sock.connect((target_mac, 1))
-            self.socket_connections.append((sock, target_mac))
+            sock.settimeout(None)
+            with self.lock:
+                self.socket_connections.append((sock, target_mac))
             print("[*] Connected to " + target_name)
             logging.info("[*] Connected to " + target_name)
             if not self.targets[target_mac]['present']:
                 self.targets[target_mac]['updated_at'] = time.time()
             self.targets[target_mac]['present'] = True
             self.targets[target_mac]['stable'] = True
-
-            self.total_devices_detected += 1
+            return True
         except bluetooth.btcommon.BluetoothError as e:
+            if sock is not None:
+                sock.close()
             if str(e) == "[Errno 111] Connection refused":
                 print(f"[!] {target_name} refused connection")
                 logging.debug(f"[*] {target_name} refused connection but is present")
+                if not self.targets[target_mac]['present']:
+                    self.targets[target_mac]['updated_at'] = time.time()
                 self.targets[target_mac]['present'] = True
                 self.targets[target_mac]['stable'] = False
-                self.total_devices_detected += 1
+                return True
             else:
                 print("[!] Failed to connect to " + target_name)
                 logging.debug(f"[!] Failed to connect to {target_name} because {e}")
@@ -84,65 +113,37 @@ class BlueStalker:
                     self.targets[target_mac]['updated_at'] = time.time()
                 self.targets[target_mac]['present'] = False
                 self.targets[target_mac]['stable'] = False
+                return False
         except OSError as e:
+            if sock is not None:
+                sock.close()
             print("[!] Failed to connect to " + target_name)
             logging.debug(f"[!] Failed to connect to {target_name} because {e}")
             if self.targets[target_mac]['present'] is not False:
                 self.targets[target_mac]['updated_at'] = time.time()
             self.targets[target_mac]['present'] = False
             self.targets[target_mac]['stable'] = False
+            return False
 
     def background_stalk(self):
-        if not self.already_stalking:
-            self.already_stalking = True
-            threading.Thread(target=self.stalk, daemon=True).start()
+        """
+        Make sure the scan engine is running and update the occupancy from what it has found so far
+        :return: None
+        """
+        self.engine.start()
+        self.stalk()
+
+    def scan_stats(self):
+        return self.engine.stats()
 
     def stalk(self):
-        self.stalker_logs = []
-        logging.debug(f"[*] Starting stalk: {datetime.datetime.now()}")
+        logging.debug(f"[*] Evaluating stalk: {datetime.datetime.now()}")
         logging.debug(f"[*] Targets: {self.targets}")
-        logging.debug(f"[*] Temp Targets: {self.temp_targets}")
         self.ready = True
         try:
             self.stalk_error = False
-            self.total_devices_detected = 0
-            search_threads = []
-            seeked_this_round = 0
-            # Find devices in self.targets that don't have a connection in self.socket_connections
-            index = 0
-            self.seek_offset += 1
-            for target_name, target_mac, priority in self.target_devices:
-                already_connected = False
-                for sock, mac_address in self.socket_connections:
-                    if mac_address == target_mac:
-                        logging.debug(f"[*] {mac_address}: {target_name} is already connected")
-                        self.targets[target_mac]['present'] = True
-                        self.targets[target_mac]['stable'] = True
-                        already_connected = True
-                        self.total_devices_detected += 1
-                        continue
-                if not already_connected:
-                    if priority:
-                        logging.debug(f"[*] {target_mac}: {target_name} is not connected, starting seek thread")
-                        search_threads.append(threading.Thread(target=self.seek_device, args=(target_name, target_mac), daemon=True))
-                        seeked_this_round += 1
-                    else:
-                        index += 1
-                        target_name, target_mac, priority = \
-                            self.non_priority_devices[(index + self.seek_offset) % len(self.non_priority_devices)]
-                        if seeked_this_round < self.max_seek:
-                            logging.debug(f"[*] {target_mac}: {target_name} is not connected, starting seek thread")
-                            search_threads.append(threading.Thread(target=self.seek_device, args=(target_name, target_mac), daemon=True))
-                            seeked_this_round += 1
-                        else:
-                            logging.debug(f"[*] {target_mac}: {target_name} is not connected, skipping seek thread due to max_seek")
-
-            for thread in search_threads:
-                thread.start()
-
-            for thread in search_threads:
-                thread.join()
-
+            self.total_devices_detected = sum(1 for _, target_mac, _ in self.target_devices
+                                              if self.targets[target_mac]['present'])
             if self.total_devices_detected > 0:
                 self.room_occupied = True
                 self.failed_attempts = 0
@@ -151,10 +152,7 @@ class BlueStalker:
                 if self.failed_attempts > 2:
                     self.room_occupied = False
             logging.debug(f"[*] {self.total_devices_detected} devices detected")
-            logging.debug(f"[*] Stalk Completed {datetime.datetime.now()}")
-            self.already_stalking = False
         except Exception as e:
             self.stalk_error = True
-            self.already_stalking = False
             self.room_occupied = True
             logging.error(f"[!] Failed to stalk because {e}\n{traceback.format_exc()}")
@@ -20,4 +20,4 @@ class Button:
         self.y = y
 
     def blit(self, screen):
-        screen.blit(self.surf, (self.x, self.y))
+        return screen.blit(self.surf, (self.x, self.y))
@@ -0,0 +1,306 @@
+import json
+import logging
+import socket
+import struct
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger(__name__)
+
+# Protocol v2 connections start with this magic so the host can tell them apart from v1 JSON requests on the same port
+MAGIC = b"HHv2"
+# Every v2 frame is prefixed with the payload length, the payload encoding and the request id it belongs to
+HEADER = struct.Struct("!IBI")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# How often the host sends a heartbeat on an idle subscription so both sides notice a dead connection
+SUBSCRIPTION_HEARTBEAT = 10
+
+ENCODING_JSON = 0
+ENCODING_MSGPACK = 1
+
+
+class ProtocolError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return f"Coordinator protocol error: {self.message}"
+
+
+class UnsupportedProtocol(ProtocolError):
+    """
+    Raised when the host answers the v2 hello with something that isn't a v2 frame, i.e. it only speaks protocol v1
+    """
+
+
+class HelloDropped(ProtocolError):
+    """
+    Raised when the host closes the connection without answering the v2 hello, a v1 host does this but so does a
+    host that is restarting or a network that dropped out
+    """
+
+
+def available_encodings():
+    """
+    Get the payload encodings this side of the connection can speak, most compact first
+    :return: A list of encoding ids
+    """
+    if msgpack is not None:
+        return [ENCODING_MSGPACK, ENCODING_JSON]
+    return [ENCODING_JSON]
+
+
+def choose_encoding(offered):
+    """
+    Pick the most compact encoding that both sides support
+    :param offered: The list of encodings the other side offered
+    :return: The chosen encoding id
+    """
+    for encoding in available_encodings():
+        if encoding in offered:
+            return encoding
+    return ENCODING_JSON
+
+
+def encode(message, encoding=ENCODING_JSON):
+    """
+    Serialize a message
+    :param message: The message to serialize
+    :param encoding: The encoding id to use
+    :return: The serialized message
+    """
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, separators=(',', ':')).encode()
+
+
+def decode(payload, encoding=ENCODING_JSON):
+    """
+    Deserialize a message
+    :param payload: The serialized message
+    :param encoding: The encoding id the message was serialized with
+    :return: The message
+    """
+    if encoding == ENCODING_MSGPACK:
+        if msgpack is None:
+            raise ProtocolError("Received a msgpack frame but msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    elif encoding == ENCODING_JSON:
+        return json.loads(payload)
+    raise ProtocolError(f"Unknown payload encoding {encoding}")
+
+
+def pack_frame(message, request_id=0, encoding=ENCODING_JSON):
+    """
+    Build a length prefixed frame
+    :param message: The message to send
+    :param request_id: The id of the request this frame belongs to, 0 for unsolicited frames
+    :param encoding: The encoding id to use for the payload
+    :return: The frame bytes
+    """
+    payload = encode(message, encoding)
+    return HEADER.pack(len(payload), encoding, request_id) + payload
+
+
+class FrameDecoder:
+
+    def __init__(self):
+        """
+        Reassembles frames from a byte stream that may split or merge them arbitrarily
+        """
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        """
+        Add received bytes to the buffer and pull out every complete frame
+        :param data: The received bytes
+        :return: A list of (request_id, message) tuples
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, encoding, request_id = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"Frame of {length} bytes is over the {MAX_FRAME_SIZE} byte limit")
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            frames.append((request_id, decode(bytes(self.buffer[offset + HEADER.size:end]), encoding)))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class Connection:
+
+    def __init__(self, address, port, client_name, auth, timeout=5):
+        """
+        A persistent protocol v2 connection to the coordinator host, reconnects on demand
+        :param address: The address of the coordinator host
+        :param port: The port of the coordinator host
+        :param client_name: The name this client identifies as
+        :param auth: The authentication token for the coordinator
+        :param timeout: The socket timeout in seconds
+        """
+        self.address = address
+        self.port = port
+        self.client_name = client_name
+        self.auth = auth
+        self.timeout = timeout
+        self.sock = None
+        self.decoder = None
+        self.encoding = ENCODING_JSON
+        self.next_request_id = 1
+        self.pending = []
+        self.lock = threading.RLock()
+
+    def is_open(self):
+        return self.sock is not None
+
+    def connect(self):
+        """
+        Open the connection and complete the hello handshake
+        :return: The handshake response from the host
+        """
+        with self.lock:
+            self.close()
+            sock = socket.create_connection((self.address, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = sock
+            self.decoder = FrameDecoder()
+            self.pending = []
+            try:
+                # The hello is always JSON, everything after it uses the negotiated encoding
+                sock.sendall(MAGIC + pack_frame({"type": "hello", "client": self.client_name, "auth": self.auth,
+                                                 "encodings": available_encodings()}, 0, ENCODING_JSON))
+                _, response = self._read_frame()
+                if not isinstance(response, dict):
+                    raise UnsupportedProtocol(f"Unexpected hello response {response!r}")
+            except (ProtocolError, ValueError) as e:
+                # Any bytes back that don't make a v2 frame are a v1 answer, no bytes at all could be anything
+                answered = isinstance(e, UnsupportedProtocol) or bool(self.decoder.buffer)
+                self.close()
+                if answered:
+                    raise UnsupportedProtocol(f"The coordinator answered the v2 hello in protocol v1 ({e})")
+                raise HelloDropped(f"The coordinator closed the connection without answering the v2 hello ({e})")
+            except Exception:
+                self.close()
+                raise
+            if response.get("status") != "ok":
+                self.close()
+                raise ConnectionRefusedError(f"Coordinator refused connection: {response.get('status')}")
+            self.encoding = response.get("encoding", ENCODING_JSON)
+            log.debug(f"Connected to coordinator {self.address}:{self.port} using encoding {self.encoding}")
+            return response
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+            self.sock = None
+            self.decoder = None
+
+    def _read_frame(self):
+        """
+        Block until the next complete frame arrives
+        :return: A (request_id, message) tuple
+        """
+        while not self.pending:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ProtocolError("Connection closed by coordinator")
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.pop(0)
+
+    def send(self, message):
+        """
+        Send a request without waiting for the response, used to start a subscription
+        :param message: The request message
+        :return: The request id the responses will carry
+        """
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+            request_id = self.next_request_id
+            self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1
+            try:
+                self.sock.sendall(pack_frame(message, request_id, self.encoding))
+            except Exception:
+                self.close()
+                raise
+            return request_id
+
+    def receive(self):
+        """
+        Block until the next frame arrives, used to read pushed subscription updates
+        :return: A (request_id, message) tuple
+        """
+        with self.lock:
+            if self.sock is None:
+                raise ProtocolError("Connection is not open")
+            try:
+                return self._read_frame()
+            except Exception:
+                self.close()
+                raise
+
+    def request(self, message):
+        """
+        Send a single request and wait for its response
+        :param message: The request message
+        :return: The response message
+        """
+        return self.pipeline([message])[0]
+
+    def pipeline(self, messages):
+        """
+        Send several requests back to back before reading any of the responses
+        :param messages: The request messages
+        :return: The response messages in the same order as the requests
+        """
+        with self.lock:
+            reused = self.sock is not None
+            if not reused:
+                self.connect()
+            try:
+                return self._exchange(messages)
+            except (OSError, ProtocolError):
+                self.close()
+                if not reused:
+                    raise
+            except Exception:
+                self.close()
+                raise
+            # The host drops idle connections, so a failure on a reused connection gets one retry on a fresh one
+            self.connect()
+            try:
+                return self._exchange(messages)
+            except Exception:
+                self.close()
+                raise
+
+    def _exchange(self, messages):
+        request_ids = []
+        frames = []
+        for message in messages:
+            request_id = self.next_request_id
+            self.next_request_id = self.next_request_id % 0xFFFFFFFF + 1
+            request_ids.append(request_id)
+            frames.append(pack_frame(message, request_id, self.encoding))
+        self.sock.sendall(b"".join(frames))
+        responses = {}
+        while len(responses) < len(request_ids):
+            request_id, response = self._read_frame()
+            if request_id in request_ids:
+                responses[request_id] = response
+        return [responses[request_id] for request_id in request_ids]
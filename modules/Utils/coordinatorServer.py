@@ -0,0 +1,476 @@
+import collections
+import json
+import logging
+import selectors
+import socket
+import threading
+import time
+
+from . import coordinatorProtocol
+
+log = logging.getLogger(__name__)
+
+# Give a burst of state changes a moment to settle so subscribers get them as one diff
+PUSH_COALESCE = 0.05
+
+
+class ServerStats:
+
+    def __init__(self, samples=4096):
+        """
+        Counters for the coordinator server
+        :param samples: How many of the most recent request latencies to keep for the percentiles
+        """
+        self.started = time.time()
+        self.connections_total = 0
+        self.connections_open = 0
+        self.connections_peak = 0
+        self.timeouts = 0
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latencies = collections.deque(maxlen=samples)
+
+    def percentile(self, percent):
+        """
+        Get a latency percentile over the recent requests
+        :param percent: The percentile to get (0-100)
+        :return: The latency in milliseconds, or None if no requests have been served
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return round(ordered[index] * 1000, 3)
+
+    def to_dict(self):
+        return {"uptime": round(time.time() - self.started), "connections_total": self.connections_total,
+                "connections_open": self.connections_open, "connections_peak": self.connections_peak,
+                "timeouts": self.timeouts, "requests": self.requests, "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out, "latency_p50_ms": self.percentile(50),
+                "latency_p99_ms": self.percentile(99)}
+
+
+class Session:
+
+    def __init__(self, sock, addr):
+        """
+        The state of a single client connection
+        :param sock: The non blocking client socket
+        :param addr: The client address
+        """
+        self.sock = sock
+        self.addr = addr
+        self.mode = "detect"  # detect -> v1 or v2 once the first bytes arrive
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.decoder = None
+        self.client = None
+        self.encoding = coordinatorProtocol.ENCODING_JSON
+        self.v1_request = None  # The v1 request header, set while its body is being received
+        self.close_after_flush = False
+        self.subscription = None  # [request_id, revision, epoch] of a subscribed client
+        self.push_due = None
+        self.last_push = 0
+        self.last_activity = time.time()
+        self.request_started = None
+        self.unanswered = []  # When each request whose response is still buffered started arriving
+        self.writing = False
+
+    def deadline(self, read_timeout, idle_timeout):
+        """
+        Get the time this connection gets dropped if nothing else arrives
+        :param read_timeout: How long a client gets to finish sending a request
+        :param idle_timeout: How long an idle persistent connection is kept open
+        :return: The unix time of the deadline, or None for subscribed connections
+        """
+        if self.subscription is not None:
+            return None
+        if self.mode == "v2" and not self.inbuf and not self.decoder.buffer and not self.outbuf:
+            return self.last_activity + idle_timeout
+        return self.last_activity + read_timeout
+
+
+class Server:
+
+    def __init__(self, host, port, handler, max_connections=64, read_timeout=10, idle_timeout=300):
+        """
+        A single threaded selector based server for both coordinator protocol versions
+        :param host: The address to bind to
+        :param port: The port to bind to
+        :param handler: The WebServerHost that owns the room state and answers requests
+        :param max_connections: The most connections served at once, new connections wait in the backlog past this
+        :param read_timeout: How long a client gets to finish sending a request before it is dropped
+        :param idle_timeout: How long an idle persistent connection is kept open
+        """
+        self.host = host
+        self.port = port
+        self.handler = handler
+        self.max_connections = max_connections
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.stats = ServerStats()
+        self.sessions = {}
+        self.running = True
+        self.ready = threading.Event()
+        self.selector = None
+        self.listener = None
+        self.accepting = False
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.state_changed = False
+
+    def wake(self):
+        """
+        Wake the event loop from another thread, safe to call from a state change listener
+        :return: None
+        """
+        try:
+            self.wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # A wakeup is already pending or the server is closed
+
+    def notify_change(self, keys):
+        """
+        State change listener that schedules pushes to subscribed clients
+        :param keys: The changed state names
+        :return: None
+        """
+        self.state_changed = True
+        self.wake()
+
+    def close(self):
+        """
+        Stop accepting connections, flush what is buffered and close every connection
+        :return: None
+        """
+        self.running = False
+        self.wake()
+
+    def serve_forever(self):
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.selector.register(self.listener, selectors.EVENT_READ, "listener")
+        self.selector.register(self.wake_r, selectors.EVENT_READ, "wake")
+        self.accepting = True
+        self.ready.set()
+        log.debug(f"Coordinator server on {self.host}:{self.port} started")
+        try:
+            while self.running:
+                for key, mask in self.selector.select(self._next_timeout()):
+                    if key.data == "listener":
+                        self._accept()
+                    elif key.data == "wake":
+                        self._drain_wake()
+                    else:
+                        session = key.data
+                        if mask & selectors.EVENT_READ:
+                            self._read(session)
+                        if mask & selectors.EVENT_WRITE and session.sock.fileno() != -1:
+                            self._write(session)
+                self._service()
+        finally:
+            self._shutdown()
+
+    def _next_timeout(self):
+        now = time.time()
+        wake_at = now + 1
+        for session in self.sessions.values():
+            if session.push_due is not None:
+                wake_at = min(wake_at, session.push_due)
+            elif session.subscription is not None:
+                wake_at = min(wake_at, session.last_push + coordinatorProtocol.SUBSCRIPTION_HEARTBEAT)
+            deadline = session.deadline(self.read_timeout, self.idle_timeout)
+            if deadline is not None:
+                wake_at = min(wake_at, deadline)
+        return max(0, wake_at - now)
+
+    def _drain_wake(self):
+        try:
+            while self.wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _accept(self):
+        while len(self.sessions) < self.max_connections:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.warning(f"Failed to accept a coordinator connection: {e}")
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(sock, addr)
+            self.sessions[sock] = session
+            self.selector.register(sock, selectors.EVENT_READ, session)
+            self.stats.connections_total += 1
+            self.stats.connections_open = len(self.sessions)
+            self.stats.connections_peak = max(self.stats.connections_peak, len(self.sessions))
+            log.debug(f"Connected by {addr}")
+        if self.accepting:
+            # Stop taking connections off the backlog until a slot frees up
+            log.warning(f"Coordinator server is at its limit of {self.max_connections} connections")
+            self.selector.unregister(self.listener)
+            self.accepting = False
+
+    def _close(self, session):
+        if self.sessions.pop(session.sock, None) is None:
+            return
+        try:
+            self.selector.unregister(session.sock)
+        except (KeyError, ValueError):
+            pass
+        session.sock.close()
+        self.stats.connections_open = len(self.sessions)
+        log.debug(f"Connection with client {session.client} ({session.addr}) has been closed")
+        if not self.accepting and self.running and len(self.sessions) < self.max_connections:
+            self.selector.register(self.listener, selectors.EVENT_READ, "listener")
+            self.accepting = True
+
+    def _service(self):
+        """
+        Drop connections past their deadline, push state changes and heartbeats to subscribers
+        :return: None
+        """
+        now = time.time()
+        state_changed, self.state_changed = self.state_changed, False
+        for session in list(self.sessions.values()):
+            deadline = session.deadline(self.read_timeout, self.idle_timeout)
+            if deadline is not None and deadline <= now:
+                log.warning(f"Connection with {session.client} ({session.addr}) timed out")
+                self.stats.timeouts += 1
+                self._close(session)
+                continue
+            if session.subscription is None:
+                continue
+            if state_changed and session.push_due is None:
+                session.push_due = now + PUSH_COALESCE
+            if session.push_due is not None and session.push_due <= now:
+                self._push(session)
+            elif session.last_push + coordinatorProtocol.SUBSCRIPTION_HEARTBEAT <= now:
+                request_id, revision, epoch = session.subscription
+                self._send(session, coordinatorProtocol.pack_frame({"status": "ok", "type": "heartbeat", "revision": revision,
+                                                                    "epoch": epoch}, request_id, session.encoding))
+                session.last_push = now
+
+    def _push(self, session):
+        request_id, revision, epoch = session.subscription
+        state = self.handler.data
+        with state.lock:
+            if state.revision != revision or state.epoch != epoch:
+                changes = state.changes_since(revision, epoch)
+                frame = coordinatorProtocol.pack_frame(changes, request_id, session.encoding)
+            else:
+                changes = frame = None
+        if frame is not None:
+            session.subscription = [request_id, changes["revision"], changes["epoch"]]
+            self._send(session, frame)
+            session.last_push = time.time()
+        session.push_due = None
+
+    def _send(self, session, data, started=None):
+        """
+        Queue data for a client and try to send it straight away
+        :param session: The client connection
+        :param data: The bytes to send
+        :param started: When the request this answers started arriving, used for the latency stats
+        :return: None
+        """
+        session.outbuf += data
+        if started is not None:
+            session.unanswered.append(started)
+        self._write(session)
+
+    def _write(self, session):
+        if session.outbuf:
+            try:
+                sent = session.sock.send(session.outbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self._close(session)
+                return
+            del session.outbuf[:sent]
+            self.stats.bytes_out += sent
+            if sent:
+                session.last_activity = time.time()
+        if session.outbuf:
+            if not session.writing:
+                self.selector.modify(session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, session)
+                session.writing = True
+            return
+        now = time.time()
+        for started in session.unanswered:
+            self.stats.latencies.append(now - started)
+        session.unanswered = []
+        if session.writing:
+            self.selector.modify(session.sock, selectors.EVENT_READ, session)
+            session.writing = False
+        if session.close_after_flush:
+            self._close(session)
+
+    def _read(self, session):
+        try:
+            data = session.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(session)
+            return
+        if not data:
+            self._end_of_stream(session)
+            return
+        now = time.time()
+        self.stats.bytes_in += len(data)
+        session.last_activity = now
+        if session.request_started is None:
+            session.request_started = now
+        try:
+            if session.mode == "detect":
+                self._detect(session, data)
+            elif session.mode == "v2":
+                self._read_v2(session, data)
+            else:
+                self._read_v1(session, data)
+        except Exception as e:
+            log.warning(f"Dropping connection with {session.client} ({session.addr}): {e}")
+            self._close(session)
+
+    def _detect(self, session, data):
+        """
+        Tell protocol v1 and v2 clients apart by whether they open with the v2 magic
+        :param session: The client connection
+        :param data: The received bytes
+        :return: None
+        """
+        session.inbuf += data
+        magic = coordinatorProtocol.MAGIC
+        if len(session.inbuf) < len(magic) and magic.startswith(session.inbuf):
+            return  # The rest of the magic hasn't arrived yet
+        buffered = bytes(session.inbuf)
+        session.inbuf = bytearray()
+        if buffered.startswith(magic):
+            session.mode = "v2"
+            session.decoder = coordinatorProtocol.FrameDecoder()
+            self._read_v2(session, buffered[len(magic):])
+        else:
+            session.mode = "v1"
+            self._read_v1(session, buffered)
+
+    def _read_v2(self, session, data):
+        frames = session.decoder.feed(data)
+        started = session.request_started
+        if not session.decoder.buffer:
+            session.request_started = None
+        for request_id, message in frames:
+            if session.client is None:
+                # The first frame on a connection has to be the hello
+                if message.get("type") != "hello" or message.get("auth") != self.handler.auth:
+                    log.warning(f"Client {message.get('client')} has connected but has not been authenticated")
+                    session.close_after_flush = True
+                    self._send(session, coordinatorProtocol.pack_frame({"status": "Forbidden: 403"}, request_id))
+                    return
+                session.client = message.get("client")
+                session.encoding = coordinatorProtocol.choose_encoding(message.get("encodings", []))
+                log.debug(f"Client {session.client} has connected over protocol v2 and been authenticated")
+                self._send(session, coordinatorProtocol.pack_frame({"status": "ok", "encoding": session.encoding}, request_id))
+                continue
+            self.stats.requests += 1
+            request_type = message.get("type")
+            if request_type == "subscribe":
+                log.debug(f"Client {session.client} has subscribed to state changes")
+                session.subscription = [request_id, message.get("since", 0), message.get("epoch")]
+                self._push(session)
+                continue
+            response = self.handler.handle_message(session.client, message)
+            # Pipelined requests are answered in the order they were sent
+            self._send(session, coordinatorProtocol.pack_frame(response, request_id, session.encoding), started)
+
+    def _read_v1(self, session, data):
+        session.inbuf += data
+        if session.v1_request is not None:
+            return  # Collecting the request body, it is complete once the client closes its end
+        try:
+            request = json.loads(session.inbuf.decode())
+        except (ValueError, UnicodeDecodeError):
+            if len(session.inbuf) > 65536:
+                raise coordinatorProtocol.ProtocolError("Protocol v1 request header is too large")
+            return  # The rest of the request hasn't arrived yet
+        session.inbuf = bytearray()
+        session.client = request.get("client")
+        self.stats.requests += 1
+        if request.get("auth") != self.handler.auth:
+            log.warning(f"Client {session.client} has connected but has not been authenticated")
+            session.close_after_flush = True
+            self._send(session, b'{"status": "Forbidden: 403"}')
+            return
+        log.debug(f"Client {session.client} has connected and been authenticated")
+        started, session.request_started = session.request_started, None
+        if request["type"] == "download_state":
+            data = self.handler.download(request.get("state"))
+            session.close_after_flush = True
+            self._send(session, json.dumps(data).encode() if data is not None else b'No state found', started)
+        elif request["type"] == "upload_state":
+            log.debug(f"Client {session.client} is uploading new state data")
+            session.v1_request = request
+            self._send(session, b'up-ready')  # Let the client know that we are ready to receive data
+        elif request["type"] == "preform_action":
+            log.debug(f"Client {session.client} is requesting an action to be preformed")
+            session.v1_request = request
+            self._send(session, b'command-ready')
+        else:
+            log.warning(f"Client {session.client} has requested unknown action {request['type']}")
+            session.close_after_flush = True
+            self._send(session, b'404', started)  # Acknowledge the request was received but not understood
+
+    def _end_of_stream(self, session):
+        """
+        Handle a client closing its end, which is how protocol v1 clients mark the end of a request body
+        :param session: The client connection
+        :return: None
+        """
+        request = session.v1_request
+        if request is not None:
+            session.v1_request = None
+            started, session.request_started = session.request_started, None
+            try:
+                data = json.loads(session.inbuf.decode())
+                if request["type"] == "upload_state":
+                    self.handler.upload(session.client, data)
+                else:
+                    self.handler.perform_action(session.client, data)
+            except Exception as e:
+                log.warning(f"Client {session.client} has failed to send a proper {request['type']} body")
+                log.warning(e)
+            if started is not None:
+                self.stats.latencies.append(time.time() - started)
+        self._close(session)
+
+    def _shutdown(self):
+        log.debug(f"Coordinator server on {self.host}:{self.port} shutting down")
+        try:
+            self.listener.close()
+        except OSError:
+            pass
+        for session in list(self.sessions.values()):
+            if session.outbuf:
+                # Give each client a moment to take what is already buffered for it
+                try:
+                    session.sock.settimeout(1)
+                    session.sock.sendall(session.outbuf)
+                except OSError:
+                    pass
+            self._close(session)
+        self.selector.close()
+        self.wake_r.close()
+        self.wake_w.close()
+        self.ready.clear()
@@ -0,0 +1,136 @@
+import logging
+import os
+import random
+import struct
+import threading
+import time
+
+from Utils import serialFraming
+
+log = logging.getLogger(__name__)
+
+try:
+    import pty
+    import tty
+except ImportError:
+    pty = None
+    log.warning("pty is not available on this platform, the coprocessor simulator can't be used")
+
+
+class CoprocessorSimulator:
+
+    def __init__(self, protocol="ascii", baudrate=9600, corruption=0.0, reply_delay=0.005):
+        """
+        A stand-in for an arduino coprocessor behind a pseudo terminal, for testing and benchmarking without hardware
+        :param protocol: "ascii" or "framed", see serialFraming
+        :param baudrate: The simulated line speed, every byte read costs as much time as it would on the wire
+        :param corruption: The chance of flipping a bit in each frame the host sends, framed protocol only
+        :param reply_delay: How long the simulated firmware takes to answer
+        """
+        if pty is None:
+            raise RuntimeError("The coprocessor simulator needs pty support")
+        self.protocol = protocol
+        self.baudrate = baudrate
+        self.corruption = corruption
+        self.reply_delay = reply_delay
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.slots = [b" "] * serialFraming.SLOT_COUNT
+        self.sensors = [b"42", b"3", b"1", b"0", b"0", b"0", b"0", b"0"]
+        self.image = bytearray()
+        self.row_remaining = 0  # Bytes of the image row still to come, ASCII protocol only
+        self.frames = {}  # Frame type (or "ascii") -> count
+        self.bytes_received = 0
+        self.wire_time = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _run(self):
+        parser = serialFraming.FrameParser()
+        buffer = bytearray()
+        while self.running:
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                return
+            wire_time = len(data) * 10 / self.baudrate  # 8N1 is ten bits a byte
+            self.wire_time += wire_time
+            self.bytes_received += len(data)
+            time.sleep(wire_time)
+            if self.protocol == "framed":
+                if self.corruption and random.random() < self.corruption:
+                    data = bytearray(data)
+                    data[random.randrange(len(data))] ^= 1 << random.randrange(8)
+                for seq, frame_type, payload in parser.feed(bytes(data)):
+                    self._frame(seq, frame_type, payload)
+            else:
+                buffer += data
+                self._ascii(buffer)
+
+    def _count(self, kind):
+        self.frames[kind] = self.frames.get(kind, 0) + 1
+
+    def _reply(self, data):
+        time.sleep(self.reply_delay)
+        try:
+            os.write(self.master, data)
+        except OSError:
+            pass
+
+    def _ascii(self, buffer):
+        while True:
+            if self.row_remaining:
+                # Receiving a row of the image, the row isn't terminated so take exactly its size
+                taken = buffer[:self.row_remaining]
+                self.image += taken
+                del buffer[:len(taken)]
+                self.row_remaining -= len(taken)
+                if self.row_remaining:
+                    return
+            end = buffer.find(b"\n")
+            if end == -1:
+                return
+            fields = bytes(buffer[:end]).split(b"\a")[:-1]
+            del buffer[:end + 1]
+            self._count("ascii")
+            if len(fields) == serialFraming.SLOT_COUNT:
+                self.slots = fields
+                if fields[2] == b"10":
+                    self.row_remaining = 8
+                    if fields[8] == b"0":
+                        self.image = bytearray()
+            self._reply(b"".join(field + b"\a" for field in self.sensors) + b"\n")
+
+    def _frame(self, seq, frame_type, payload):
+        self._count(frame_type)
+        if frame_type == serialFraming.FRAME_SLOTS:
+            self.slots = serialFraming.decode_fields(payload)
+        elif frame_type == serialFraming.FRAME_DELTA:
+            for index, value in serialFraming.decode_delta(payload).items():
+                self.slots[index] = value
+        elif frame_type == serialFraming.FRAME_IMAGE:
+            offset, total = serialFraming.IMAGE_HEADER.unpack_from(payload)
+            chunk = payload[serialFraming.IMAGE_HEADER.size:]
+            if len(self.image) != total:
+                self.image = bytearray(total)
+            self.image[offset:offset + len(chunk)] = chunk
+            self._reply(serialFraming.pack_frame(seq, serialFraming.FRAME_ACK, struct.pack("<H", offset)))
+            return
+        elif frame_type == serialFraming.FRAME_RAW:
+            self.image += payload
+            self._reply(serialFraming.pack_frame(seq, serialFraming.FRAME_ACK))
+            return
+        elif frame_type != serialFraming.FRAME_POLL:
+            return
+        self._reply(serialFraming.pack_frame(seq, serialFraming.FRAME_SENSORS,
+                                             serialFraming.encode_fields(self.sensors)))
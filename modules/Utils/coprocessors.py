@@ -1,21 +1,39 @@
+import hashlib
 import os
 import threading
 import time
-import traceback
 
-import serial
 import logging
 
+from Utils import serialFraming
+
 log = logging.getLogger(__name__)
 
 class Coprocessor:
 
-    def __init__(self, port: list, baudrate: list = 19200, should_connect=True):
+    def __init__(self, port: list, baudrate: list = 19200, should_connect=True, protocol="ascii", delta=False):
+        """
+        Drives the two arduino coprocessors, each serial port gets its own reader and writer thread
+        :param port: The serial device of each arduino
+        :param baudrate: The baud rate of each arduino
+        :param should_connect: If False the coprocessors are never opened (e.g. when not running on the pi)
+        :param protocol: "ascii" for the bell delimited messages the current firmware speaks, "framed" for checksummed
+         binary frames, see serialFraming
+        :param delta: Only send the slots that changed with a periodic keyframe, needs the framed protocol
+        """
         self.port = port
         self.baudrate = baudrate
+        self.protocol = protocol
+        self.delta = delta
+        self.lock = threading.RLock()
         self.arduino = [None, None]
         self.ready = False
         self.connected = [False, False]
+        self.returned_data = [[], []]
+        self.images = {}  # File name -> (modified time, bytes, hash)
+        self.uploaded_images = [None, None]  # Hash of the image each arduino holds
+        self.upload_lock = threading.Lock()
+        self.state_changes = [0, 0]  # Counts LCD state changes, so a late upload can tell it has been superseded
         self.enabled = False
         self.lcd_backlight_preferred_state = 0
         self.should_connect = should_connect
@@ -32,7 +50,6 @@ class Coprocessor:
             self.data_slots[1].append(None)
             self.last_data_slots[0].append(None)
             self.last_data_slots[1].append(None)
-        self.returned_data = [[], []]
         self.returned_data_slots = [[], []]
         self.data_slots[0][6] = -1
         self.set_state(0)
@@ -42,22 +59,37 @@ class Coprocessor:
     def establish_connection(self, target_arduino=0):
         if not self.should_connect:
             return
-        log.info(f"[*] Establishing connection to arduino {target_arduino} on {self.port[target_arduino]}")
-        try:
-            self.arduino[target_arduino] = serial.Serial(self.port[target_arduino], self.baudrate[target_arduino], timeout=0.25)
-            self.connected[target_arduino] = True
-            log.info(f"[*] Connection established to arduino {target_arduino} on {self.port[target_arduino]}")
-        except Exception as e:
-            log.warning(f"[!] Failed to establish connection to arduino {target_arduino} on {self.port[target_arduino]} {e}\n{traceback.format_exc()}")
-            self.connected[target_arduino] = False
+        if self.arduino[target_arduino] is not None:
+            return  # The link reopens the port by itself if it is lost
+
+        def received(fields):
+            if len(fields) == serialFraming.SENSOR_FIELDS:
+                self.returned_data[target_arduino] = fields
+
+        def connection(connected):
+            self.connected[target_arduino] = connected
+            self.uploaded_images[target_arduino] = None  # The arduino resets and loses its image
+
+        link = serialFraming.SerialLink(self.port[target_arduino], self.baudrate[target_arduino], self.protocol,
+                                        on_record=received, on_connection=connection, delta=self.delta)
+        self.arduino[target_arduino] = link
+        link.start()
 
     def close_all(self):
         self.ready = False
+        self.enabled = False
         for i in range(0, 2):
-            if self.connected[i]:
+            if self.arduino[i] is not None:
                 self.arduino[i].close()
-                self.connected[i] = False
-                self.enabled = False
+                self.arduino[i] = None
+            self.connected[i] = False
+
+    def stats(self):
+        """
+        Get the serial link statistics of each arduino
+        :return: A list with a dict of frame, error and latency counters per port (None if it was never opened)
+        """
+        return [link.to_dict() if link is not None else None for link in self.arduino]
 
     def set_data_slot_state(self, slot: int, state):
         self.data_slots[slot] = state
@@ -97,29 +129,80 @@ class Coprocessor:
             if len(self.returned_data[0]) > 3 and len(self.returned_data[1]) > 3:
                 self.ready = True
 
-    def _upload_image(self, file, target_arduino=0):
-        self.pause_refresh = True
+    def _load_image(self, file):
+        """
+        Read an image tile, kept in memory until the file changes
+        :param file: The file name in Assets/Splash Tiles
+        :return: A tuple of the image bytes and their hash, or None if the file doesn't exist
+        """
+        path = f"Assets/Splash Tiles/{file}"
+        if not os.path.exists(path):
+            return None
+        modified = os.path.getmtime(path)
+        cached = self.images.get(file)
+        if cached is None or cached[0] != modified:
+            with open(path, "rb") as f:
+                data = f.read()
+            cached = (modified, data, hashlib.sha1(data).hexdigest())
+            self.images[file] = cached
+        return cached[1], cached[2]
+
+    def _upload_image(self, file, target_arduino=0, on_uploaded=None):
+        """
+        Queue an image tile for upload unless the arduino already holds the same image, returns without waiting for it
+        :param file: The file name in Assets/Splash Tiles
+        :param target_arduino: Which arduino to upload to
+        :param on_uploaded: Called once the arduino holds the image, not called if the upload fails
+        :return: None
+        """
         if not self.connected[target_arduino]:
             return
-        if os.path.exists(f'Assets/Splash Tiles/{file}'):
-            with open(f"Assets/Splash Tiles/{file}", "rb") as f:
-                for i in range(8):
-                    self.data_slots[target_arduino][2] = 10
-                    self.data_slots[target_arduino][8] = i
-                    self._send(immediately=True, target_arduino=target_arduino)
-                    time.sleep(0.1)
-                    log.info(f"Sending image {i}")
-                    for _ in range(8):
-                        data = f.read(1)
-                        log.debug(f"-{i}: {data}")
-                        self.arduino[target_arduino].write(data)
-                    self.arduino[target_arduino].read(self.arduino[target_arduino].inWaiting())
-                    self.data_slots[target_arduino][2] = 11
-                    self._send(immediately=True, target_arduino=target_arduino)
-            self.current_uploaded_image = file
-        self.pause_refresh = False
+        image = self._load_image(file)
+        if image is None:
+            return
+        data, digest = image
+        self.current_uploaded_image = file
+        if self.uploaded_images[target_arduino] == digest:
+            if on_uploaded is not None:
+                on_uploaded()
+            return
+        self.uploaded_images[target_arduino] = digest
+        link = self.arduino[target_arduino]
+        log.info(f"Uploading image {file} to arduino {target_arduino}")
+        if self.protocol == "framed":
+            threading.Thread(target=self._transfer_image, args=(link, data, digest, target_arduino, on_uploaded),
+                             daemon=True).start()
+            return
+        # The bell delimited firmware takes a row at a time: state 10 with the row index in slot 8, the raw row,
+        # then state 11. Each step waits for the arduino to answer instead of sleeping, and the whole sequence is
+        # queued at once so no other update can land in the middle of it
+        with self.lock:
+            slots = self.data_slots[target_arduino].copy()
+        items = []
+        for row in range(0, len(data) // 8):
+            receiving = slots.copy()
+            receiving[2] = 10
+            receiving[8] = row
+            received = receiving.copy()
+            received[2] = 11
+            items += [("command", receiving), ("sync", 0.5), ("raw", data[row * 8:row * 8 + 8]),
+                      ("command", received), ("sync", 0.5)]
+        link.queue_sequence(items)
+        self._send(immediately=True, target_arduino=target_arduino)
+        if on_uploaded is not None:
+            on_uploaded()  # Anything sent now is queued behind the rows
+
+    def _transfer_image(self, link, data, digest, target_arduino, on_uploaded=None):
+        with self.upload_lock:
+            uploaded = link.transfer(data)
+            if not uploaded and self.uploaded_images[target_arduino] == digest:
+                self.uploaded_images[target_arduino] = None  # Try again next time it is shown
+        self._send(immediately=True, target_arduino=target_arduino)
+        if uploaded and on_uploaded is not None:
+            on_uploaded()
 
     def set_state(self, mode: int, target_arduino=0, immediately=False):
+        self.state_changes[target_arduino] += 1
         self.data_slots[target_arduino][2] = mode
         self._send(immediately=immediately, target_arduino=target_arduino)
 
@@ -132,15 +215,20 @@ class Coprocessor:
         self.pause_refresh = False
 
     def display_splash(self, line1: bytes = '', line2: bytes = '', file="husky.mtb", target_arduino=0):
-        if self.current_uploaded_image != file:
-            self._upload_image(file=file)
         self.data_slots[target_arduino][0] = line1[:12]
         self.data_slots[target_arduino][1] = line2[:11]
-        self.set_state(4)
+        self.state_changes[target_arduino] += 1
+        requested = self.state_changes[target_arduino]
+
+        def show():
+            # Only switch to the splash (state 4) once the image is there, and not if the LCD has moved on since
+            if self.state_changes[target_arduino] == requested:
+                self.set_state(4, target_arduino=target_arduino)
+
+        self._upload_image(file=file, target_arduino=target_arduino, on_uploaded=show)
 
     def draw_buffered_image(self, position=12, file="husky.mtb", target_arduino=0):
-        if self.current_uploaded_image != file:
-            self._upload_image(file=file)
+        self._upload_image(file=file, target_arduino=target_arduino)
         self.data_slots[target_arduino][6] = position
 
     def hide_buffered_image(self):
@@ -156,61 +244,31 @@ class Coprocessor:
             self._send()
 
     def start_refresh(self):
-        if self.connected and not self.enabled:
+        """
+        Have the writer threads resend the slots every couple of seconds, the arduinos only report their sensors
+        when written to
+        :return: None
+        """
+        if not self.enabled:
             self.enabled = True
-            threading.Thread(target=self._refresh_cycle, args=(None, 0), daemon=True).start()
-            threading.Thread(target=self._refresh_cycle, args=(None, 1), daemon=True).start()
-
-    def _refresh_cycle(self, dummy, target_arduino=0):
-        while self.enabled:
-            if not self.pause_refresh:
-                try:
-                    if self.connected[target_arduino]:
-                        self._send(target_arduino=target_arduino)
-                    else:
-                        self.establish_connection(target_arduino=target_arduino)
-                except Exception as e:
-                    log.error(f"Arduino {target_arduino} serial error: {e}\n{traceback.format_exc()}")
-                    self.connected[target_arduino] = False
-
-            time.sleep(0.25)
+            for link in self.arduino:
+                if link is not None:
+                    link.set_polling(True)
 
     def _send(self, immediately=False, target_arduino=0):
+        """
+        Hand the data slots to the arduino's writer thread, never blocks on the serial port
+        :param immediately: Send even if nothing changed, and never merge it with a queued update since state changes
+         like the image upload handshake have to reach the arduino in order
+        :param target_arduino: Which arduino to send to
+        :return: None
+        """
         if not self.connected[target_arduino]:
             return
-        data_changed = False
-        for i in range(0, 16):
-            if self.data_slots[target_arduino][i] != self.last_data_slots[target_arduino][i]:
-                data_changed = True
-        if not data_changed and not immediately and self.last_update[target_arduino] + 2 > time.time():
-            # print(f"Skipping update for {target_arduino}")
-            return
-        self.last_update[target_arduino] = time.time()
-        data = b''
-        for i in range(0, 16):
-            if self.data_slots[target_arduino][i] is not None:
-                if isinstance(self.data_slots[target_arduino][i], bytes):
-                    data += self.data_slots[target_arduino][i]
-                else:
-                    data += bytes(str(self.data_slots[target_arduino][i]), 'ascii')
-            else:
-                data += b' '
-            data += b'\a'
-        data += b'\n'
-        self.last_data_slots[target_arduino] = self.data_slots[target_arduino].copy()
-        # print(data.split(b'\a')[:-1])
-        try:
-            self.arduino[target_arduino].write(data)
-        except serial.SerialException as e:
-            log.error(f"Arduino {target_arduino} write error: {e}\n{traceback.format_exc()}")
-            self.last_update[target_arduino] = time.time() + 35
-        try:
-            returned_data = self.arduino[target_arduino].read(self.arduino[target_arduino].inWaiting()).split(b'\a')[:-1]
-            if len(returned_data) == 8:
-                self.returned_data[target_arduino] = returned_data
-        except Exception as e:
-            log.error(f"Arduino {target_arduino} read error: {e}\n{traceback.format_exc()}")
-            self.connected[target_arduino] = False
-            # for i in range(0, 8):
-            #     self.returned_data[target_arduino][i] = None
-        # print(f"Arduino[{target_arduino}]: {self.returned_data}")
+        with self.lock:
+            slots = self.data_slots[target_arduino]
+            if slots == self.last_data_slots[target_arduino] and not immediately:
+                return  # The writer resends the last slots periodically while refreshing
+            self.last_update[target_arduino] = time.time()
+            self.last_data_slots[target_arduino] = slots.copy()
+            self.arduino[target_arduino].submit(slots.copy(), coalesce=not immediately)
@@ -0,0 +1,159 @@
+import logging
+import time
+
+import pygame
+
+log = logging.getLogger(__name__)
+
+overlay_color = (255, 0, 255)
+
+
+class DirtyRegions:
+
+    def __init__(self, screen_size, full_update_ratio=0.6):
+        """
+        Tracks which parts of the screen changed between frames so only those areas get pushed to the display
+        :param screen_size: The (width, height) of the display surface
+        :param full_update_ratio: If the dirty area covers more than this fraction of the screen, flip the whole display instead
+        """
+        self.screen_rect = pygame.Rect((0, 0), screen_size)
+        self.full_update_ratio = full_update_ratio
+        self.widgets = {}  # key -> (rect, token) as of the last presented frame
+        self.seen = set()
+        self.dirty = []
+        self.full_redraw = True
+        self.show_regions = False
+        self.last_overlay = []
+        self.frames = 0
+        self.full_frames = 0
+        self.pixels_pushed = 0
+        self.stats_since = time.time()
+
+    def resize(self, screen_size):
+        """
+        Update the tracked screen size, forces a full redraw
+        :param screen_size: The new (width, height) of the display surface
+        :return: None
+        """
+        self.screen_rect = pygame.Rect((0, 0), screen_size)
+        self.invalidate_all()
+
+    def invalidate_all(self):
+        """
+        Mark the entire screen as dirty for the next presented frame
+        :return: None
+        """
+        self.full_redraw = True
+
+    def mark(self, key, rect, token=None):
+        """
+        Report where a widget was drawn this frame and what it showed
+        :param key: A unique name for the widget
+        :param rect: The screen area the widget covers, None or False if it drew nothing
+        :param token: Any comparable value that changes when the widget's content changes
+        :return: None
+        """
+        if not rect:  # Some draw methods return False when they have nothing to draw
+            return
+        rect = pygame.Rect(rect)
+        self.seen.add(key)
+        last = self.widgets.get(key)
+        if last is not None and last[0] == rect and last[1] == token:
+            return
+        if last is not None:
+            self.dirty.append(last[0])
+        self.dirty.append(rect)
+        self.widgets[key] = (rect, token)
+
+    def blit(self, screen, key, surface, dest, token=None, area=None):
+        """
+        Blit a surface to the screen and report it as a widget
+        :param screen: The screen to blit to
+        :param key: A unique name for the widget
+        :param surface: The surface to blit
+        :param dest: The position or rect to blit to
+        :param token: A value that changes when the surface content changes, defaults to the surface identity
+        :param area: An optional source area of the surface to blit
+        :return: The screen area that was drawn
+        """
+        rect = screen.blit(surface, dest, area)
+        self.mark(key, rect, id(surface) if token is None else token)
+        return rect
+
+    def _collect(self):
+        """
+        Drop widgets that were not drawn this frame and merge the dirty rects
+        :return: The list of rects that need to be pushed to the display
+        """
+        for key in list(self.widgets.keys()):
+            if key not in self.seen:
+                self.dirty.append(self.widgets.pop(key)[0])
+        self.seen = set()
+
+        merged = []
+        for rect in self.dirty:
+            rect = rect.clip(self.screen_rect)
+            if rect.width == 0 or rect.height == 0:
+                continue
+            # Fold overlapping rects together so SDL doesn't upload the same pixels twice
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        self.dirty = []
+        return merged
+
+    def present(self, screen):
+        """
+        Push the changed areas of the screen to the display, call this instead of pygame.display.flip()
+        :param screen: The screen surface that was drawn this frame
+        :return: The number of rects that were pushed, -1 for a full flip
+        """
+        rects = self._collect()
+        area = sum(rect.width * rect.height for rect in rects)
+        full = self.full_redraw or area > self.screen_rect.width * self.screen_rect.height * self.full_update_ratio
+        self.full_redraw = False
+        self.frames += 1
+
+        if self.show_regions:
+            for rect in rects:
+                pygame.draw.rect(screen, overlay_color, rect, 1)
+            # The outlines from the last frame have to be pushed again so they get erased from the display
+            overlay, self.last_overlay = self.last_overlay + rects, rects
+            rects = overlay
+
+        if full:
+            self.full_frames += 1
+            self.pixels_pushed += self.screen_rect.width * self.screen_rect.height
+            pygame.display.flip()
+            return -1
+        if rects:
+            self.pixels_pushed += area
+            pygame.display.update(rects)
+        return len(rects)
+
+    def toggle_overlay(self):
+        """
+        Toggle the debug overlay that outlines the repainted regions each frame
+        :return: The new overlay state
+        """
+        self.show_regions = not self.show_regions
+        self.invalidate_all()
+        log.info(f"Dirty region overlay {'enabled' if self.show_regions else 'disabled'}")
+        return self.show_regions
+
+    def stats(self):
+        """
+        Get the amount of the screen that has been repainted since the last call
+        :return: A tuple of (frames, full frames, average percent of the screen pushed per frame)
+        """
+        frames, full_frames = self.frames, self.full_frames
+        percent = 0
+        if frames:
+            percent = self.pixels_pushed / (frames * self.screen_rect.width * self.screen_rect.height) * 100
+        self.frames = 0
+        self.full_frames = 0
+        self.pixels_pushed = 0
+        self.stats_since = time.time()
+        return frames, full_frames, percent
@@ -0,0 +1,72 @@
+import logging
+
+import cv2
+import numpy
+import pygame
+
+log = logging.getLogger(__name__)
+
+
+class FrameConverter:
+
+    def __init__(self, slots=5):
+        """
+        Converts cv2 video frames to pygame surfaces without allocating anything per frame
+        Frames are scaled into a preallocated buffer with cv2.resize and swapped from BGR to RGB by cv2.cvtColor straight
+        into one of a ring of buffers, each wrapped once in a surface with pygame.image.frombuffer, so the surface
+        shares its pixels with the buffer and nothing is copied into it
+        :param slots: How many surfaces are in the ring, more than can be queued or on screen at once
+        """
+        self.slots = slots
+        self.size = None
+        self.resized = None  # The scaled BGR frame
+        self.ring = []  # (RGB buffer, surface sharing it)
+        self.next_slot = 0
+        self.read_buffer = None  # For VideoCapture.read to decode into
+
+    def _allocate(self, size):
+        width, height = size
+        self.resized = numpy.empty((height, width, 3), numpy.uint8)
+        self.ring = []
+        for _ in range(self.slots):
+            pixels = numpy.empty((height, width, 3), numpy.uint8)
+            self.ring.append((pixels, pygame.image.frombuffer(pixels, size, "RGB")))
+        self.next_slot = 0
+        self.size = size
+        log.debug(f"Allocated {self.slots} frame buffers of {width}x{height}")
+
+    def read(self, stream):
+        """
+        Read the next frame from a cv2.VideoCapture into the same buffer every time
+        :param stream: The cv2.VideoCapture
+        :return: A tuple of whether a frame was read and the frame
+        """
+        success, frame = stream.read(self.read_buffer)
+        if success:
+            self.read_buffer = frame
+        return success, frame
+
+    def convert(self, frame, size, anti_alias=False, busy=()):
+        """
+        Scale a frame and convert it to a surface
+        :param frame: The BGR frame from cv2
+        :param size: The (width, height) to scale it to
+        :param anti_alias: A boolean indicating whether use smooth scaling
+        :param busy: Surfaces from earlier calls that are still queued or on screen, they aren't written over
+        :return: The surface, it is reused by a later call once it isn't in busy, or None if the size is empty
+        """
+        size = (int(size[0]), int(size[1]))
+        if size[0] <= 0 or size[1] <= 0:
+            return None
+        if size != self.size:
+            self._allocate(size)
+        cv2.resize(frame, size, dst=self.resized, interpolation=cv2.INTER_AREA if anti_alias else cv2.INTER_NEAREST)
+        for offset in range(self.slots):
+            pixels, surface = self.ring[(self.next_slot + offset) % self.slots]
+            if not any(surface is used for used in busy):
+                break
+        else:
+            raise RuntimeError("Every frame buffer is busy, the ring needs more slots than frames held at once")
+        self.next_slot = (self.next_slot + offset + 1) % self.slots
+        cv2.cvtColor(self.resized, cv2.COLOR_BGR2RGB, dst=pixels)
+        return surface
@@ -0,0 +1,155 @@
+import collections
+import logging
+import threading
+
+import pygame
+
+log = logging.getLogger(__name__)
+
+
+class FramePlayer:
+
+    def __init__(self, index, ahead=10, max_bytes=64 * 1024 * 1024, scale=1.0, palettized=False):
+        """
+        Decodes radar frames on a background thread ahead of the playhead into a memory bounded ring, so playback
+        doesn't decode a frame on the render thread every frame
+        :param index: The frames to play, a sorted sequence of timestamps with load(timestamp) returning a surface
+         (e.g. a RadarArchive)
+        :param ahead: How many frames past the playhead to keep decoded
+        :param max_bytes: The most decoded pixel bytes to hold, frames behind the playhead are dropped first, the
+         frames ahead of it are always kept
+        :param scale: Scale frames by this when decoding, e.g. 0.5 to hold 4 times as many frames
+        :param palettized: Keep frames in the format the index loads them in instead of converting them for fast
+         blitting, e.g. for an index that loads 8 bit palette surfaces
+        """
+        self.index = index
+        self.ahead = ahead
+        self.max_bytes = max_bytes
+        self.scale = scale
+        self.palettized = palettized
+        self.frames = collections.OrderedDict()  # timestamp -> surface
+        self.size = 0
+        self.playhead = 0
+        self.stride = 1  # How many frames the playhead moves between draws, only the frames it lands on are decoded
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.hits = 0
+        self.misses = 0
+        self.decoded = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._decoder, daemon=True, name="FramePlayer")
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def _decode(self, timestamp):
+        surface = self.index.load(timestamp)
+        if self.scale != 1.0:
+            surface = pygame.transform.scale(surface, (int(surface.get_width() * self.scale),
+                                                       int(surface.get_height() * self.scale)))
+        if not self.palettized:
+            surface = surface.convert_alpha()
+        self.decoded += 1
+        return surface
+
+    def _store(self, timestamp, surface):
+        """
+        Add a decoded frame to the ring and drop the frames not ahead of the playhead until it fits
+        :return: None
+        """
+        with self.condition:
+            if timestamp in self.frames:
+                return
+            self.frames[timestamp] = surface
+            self.size += surface.get_pitch() * surface.get_height()
+            if self.size <= self.max_bytes:
+                return
+            wanted = set(self._wanted())
+            playhead = self._playhead_timestamp()
+            # Frames behind the playhead go first, oldest first, the frames ahead of it are never dropped
+            for victim in sorted((t for t in self.frames if t not in wanted), key=lambda t: (t >= playhead, t)):
+                if self.size <= self.max_bytes:
+                    break
+                evicted = self.frames.pop(victim)
+                self.size -= evicted.get_pitch() * evicted.get_height()
+
+    def _playhead_timestamp(self):
+        timestamps = self.index.timestamps
+        if not timestamps:
+            return 0
+        return timestamps[max(0, min(self.playhead, len(timestamps) - 1))]
+
+    def _wanted(self):
+        """
+        :return: The timestamps of the frames the playhead will land on next, wrapping round to the start
+        """
+        timestamps = self.index.timestamps
+        count = len(timestamps)
+        if not count:
+            return []
+        start = max(0, min(self.playhead, count - 1))
+        return list(dict.fromkeys(timestamps[(start + offset * self.stride) % count]
+                                  for offset in range(min(self.ahead + 1, count))))
+
+    def _decoder(self):
+        while True:
+            with self.condition:
+                missing = None
+                while self.running:
+                    missing = next((timestamp for timestamp in self._wanted() if timestamp not in self.frames), None)
+                    if missing is not None:
+                        break
+                    self.condition.wait()
+                if not self.running:
+                    return
+            try:
+                self._store(missing, self._decode(missing))
+            except (OSError, KeyError, pygame.error) as e:
+                log.warning(f"Failed to decode radar frame {missing}: {e}")
+                with self.condition:
+                    self.condition.wait(1)  # Don't spin on a frame that can't be decoded
+
+    def seek(self, position, stride=None):
+        """
+        Move the playhead, the decoder starts working ahead of the new position
+        :param position: The frame number in the index
+        :param stride: How many frames the playhead moves between draws, None to leave it as it is
+        :return: None
+        """
+        with self.condition:
+            self.playhead = position
+            if stride is not None:
+                self.stride = max(1, stride)
+            self.condition.notify_all()
+
+    def frame(self, position, stride=None):
+        """
+        Get a decoded frame, decoding it here if the background decoder hasn't got to it yet
+        :param position: The frame number in the index
+        :param stride: See seek
+        :return: A tuple of the surface and its timestamp
+        """
+        timestamp = self.index[position]
+        self.seek(position, stride)
+        with self.condition:
+            surface = self.frames.get(timestamp)
+        if surface is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            surface = self._decode(timestamp)
+            self._store(timestamp, surface)
+        return surface, timestamp
+
+    def stats(self):
+        with self.condition:
+            return {"frames": len(self.frames), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "decoded": self.decoded}
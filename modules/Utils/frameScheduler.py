@@ -0,0 +1,129 @@
+import collections
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class FrameScheduler:
+
+    def __init__(self, max_sleep=5):
+        """
+        Keeps track of when the main loop next has work to do so it can sleep until then
+        :param max_sleep: The longest time in seconds the loop is allowed to sleep without waking
+        """
+        self.max_sleep = max_sleep
+        self.jobs = {}
+        self.wakeups = collections.deque()
+        self.wake_reasons = collections.Counter()
+        self.last_report = time.time()
+
+    def add_job(self, name, interval, aligned=False, enabled=True):
+        """
+        Register a recurring job
+        :param name: The name of the job
+        :param interval: How often in seconds the job is due
+        :param aligned: If True the job is due on multiples of the interval (e.g. clock second rollover)
+        :param enabled: If the job starts enabled
+        :return: None
+        """
+        self.jobs[name] = {"interval": interval, "aligned": aligned, "enabled": enabled, "next_due": 0}
+        self.reschedule(name)
+
+    def set_enabled(self, name, enabled):
+        """
+        Enable or disable a job, a newly enabled job is due on its next interval
+        :param name: The name of the job
+        :param enabled: If the job should be enabled
+        :return: None
+        """
+        job = self.jobs[name]
+        if job["enabled"] != enabled:
+            job["enabled"] = enabled
+            if enabled:
+                self.reschedule(name)
+
+    def set_due(self, name, due_time, now=None):
+        """
+        Override when a job is next due, used for jobs whose timing is owned by another module
+        A due time already in the past is moved one interval from now, so a stale due time can't make the loop spin
+        :param name: The name of the job
+        :param due_time: The unix time the job is next due
+        :param now: The current time
+        :return: None
+        """
+        now = time.time() if now is None else now
+        job = self.jobs[name]
+        job["next_due"] = due_time if due_time > now else now + job["interval"]
+
+    def reschedule(self, name, now=None):
+        """
+        Move a job to its next due time
+        :param name: The name of the job
+        :param now: The current time
+        :return: None
+        """
+        now = time.time() if now is None else now
+        job = self.jobs[name]
+        if job["aligned"]:
+            job["next_due"] = now - (now % job["interval"]) + job["interval"]
+        else:
+            job["next_due"] = now + job["interval"]
+
+    def time_until_next(self, now=None):
+        """
+        Get how long the loop can sleep before a job is due
+        :param now: The current time
+        :return: The time in seconds until the next enabled job is due, capped at max_sleep
+        """
+        now = time.time() if now is None else now
+        due = [job["next_due"] for job in self.jobs.values() if job["enabled"]]
+        if not due:
+            return self.max_sleep
+        return min(max(min(due) - now, 0), self.max_sleep)
+
+    def due_jobs(self, now=None):
+        """
+        Get all jobs that are due and move them to their next due time
+        :param now: The current time
+        :return: A list of the names of the jobs that are due
+        """
+        now = time.time() if now is None else now
+        due = []
+        for name, job in self.jobs.items():
+            if job["enabled"] and job["next_due"] <= now:
+                due.append(name)
+                self.reschedule(name, now)
+        return due
+
+    def record_wakeup(self, reason):
+        """
+        Record that the main loop woke up and did work
+        :param reason: Why the loop woke up (a job name or "input")
+        :return: None
+        """
+        now = time.time()
+        self.wakeups.append(now)
+        self.wake_reasons[reason] += 1
+        while self.wakeups and self.wakeups[0] < now - 60:
+            self.wakeups.popleft()
+
+    def wakeups_per_minute(self):
+        """
+        Get the number of times the loop has woken up in the last minute
+        :return: The number of wakeups in the last 60 seconds
+        """
+        now = time.time()
+        while self.wakeups and self.wakeups[0] < now - 60:
+            self.wakeups.popleft()
+        return len(self.wakeups)
+
+    def report(self):
+        """
+        Log the wakeup rate once a minute
+        :return: None
+        """
+        if self.last_report < time.time() - 60:
+            log.info(f"Main loop woke {self.wakeups_per_minute()} times in the last minute, reasons: {dict(self.wake_reasons)}")
+            self.wake_reasons.clear()
+            self.last_report = time.time()
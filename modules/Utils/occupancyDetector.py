@@ -1,16 +1,30 @@
 import time
 
 from . import blueStalker
+from . import presenceTimeline
 # import RPi.GPIO as GPIO
 
 
 class OccupancyDetector:
 
-    def __init__(self, target_devices, motion_pin, coordinator):
-        self.stalker = blueStalker.BlueStalker(target_devices, coordinator.get_object_state("room_occupancy_info")['occupants'])
+    def __init__(self, target_devices, motion_pin, coordinator, leave_delay=180, room_leave_delay=120):
+        """
+        :param target_devices: A list of [name, mac, priority] for every occupant's device
+        :param motion_pin: The GPIO pin of the motion sensor
+        :param coordinator: The coordinator the room state is kept in
+        :param leave_delay: How long a device has to stay missing before its occupant counts as gone
+        :param room_leave_delay: How long the room has to look empty before it counts as unoccupied
+        """
+        occupancy_info = coordinator.get_object_state("room_occupancy_info")
+        self.stalker = blueStalker.BlueStalker(target_devices, occupancy_info['occupants'])
         self.motion_pin = motion_pin
         self.coordinator = coordinator
         self.last_motion_time = 0
+        # Debounced presence, so a phone dropping off for a scan or two doesn't fire the away routines
+        self.timeline = presenceTimeline.PresenceTimeline(leave_delay=leave_delay)
+        self.timeline.load(occupancy_info.get("timeline"))
+        self.room_timeline = presenceTimeline.PresenceTimeline(leave_delay=room_leave_delay)
+        self.room_timeline.load(occupancy_info.get("room_timeline"))
         # GPIO.setmode(GPIO.BOARD)
         # GPIO.setup(self.motion_pin, GPIO.IN)
 
@@ -21,13 +35,20 @@ class OccupancyDetector:
         return self.stalker.stalk_error
 
     def is_occupied(self):
+        """
+        Update the presence timelines from the latest scan and motion data
+        :return: The debounced room occupancy
+        """
         self.check_motion()
+        now = time.time()
+        for mac, target in list(self.stalker.targets.items()):
+            self.timeline.observe(mac, target['present'], target['name'], now)
         if self.stalker.stalk_error:
-            return True
-        elif time.time() - self.last_motion_time < 30 or self.stalker.room_occupied:
-            return True
+            occupied = True
         else:
-            return False
+            occupied = now - self.last_motion_time < 30 or len(self.timeline.present_now()) > 0
+        self.room_timeline.observe("room", occupied, "Room", now)
+        return self.room_timeline.present("room")
 
     def check_motion(self):
         if self.coordinator.get_object_state("room_sensor_data_displayable", False)['motion_sensor']:
@@ -46,5 +67,15 @@ class OccupancyDetector:
         return self.stalker.room_occupied
 
     def occupancy_info(self):
-        return self.stalker.targets
+        # Copied, the stalker edits the targets in place so the live dicts would never compare as changed
+        return {mac: dict(target) for mac, target in self.stalker.targets.items()}
+
+    def timeline_info(self):
+        return self.timeline.to_dict()
+
+    def room_timeline_info(self):
+        return self.room_timeline.to_dict()
+
+    def scan_stats(self):
+        return self.stalker.scan_stats()
 
@@ -0,0 +1,129 @@
+import bisect
+import collections
+import logging
+import time
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+class PlaybackClock:
+
+    def __init__(self, speed=600, hold=2):
+        """
+        Maps wall time to radar time, so playback runs at the same speed whatever the frame rate
+        :param speed: How many seconds of radar time pass per second of wall time
+        :param hold: How long in wall seconds to hold the newest frame before looping back to the oldest
+        """
+        self.speed = speed
+        self.hold = hold
+        self.playing = False
+        self.started_at = 0  # Wall time playback started
+        self.start_time = 0  # Radar time at started_at
+        self.paused_time = None
+
+    def play(self, radar_time, now=None):
+        """
+        Start playing from a radar time
+        :param radar_time: The radar time to start from
+        :param now: The wall time, defaults to now
+        :return: None
+        """
+        self.started_at = time.time() if now is None else now
+        self.start_time = radar_time
+        self.paused_time = None
+        self.playing = True
+
+    def pause(self, now=None):
+        self.paused_time = self.radar_time(now)
+        self.playing = False
+
+    def radar_time(self, now=None):
+        if not self.playing:
+            return self.paused_time or 0
+        now = time.time() if now is None else now
+        return self.start_time + (now - self.started_at) * self.speed
+
+    def position(self, timestamps, now=None):
+        """
+        Find where the playhead is, looping back to the oldest frame after holding the newest
+        :param timestamps: The sorted frame timestamps
+        :param now: The wall time, defaults to now
+        :return: A tuple of the index of the frame at or before the playhead and how far (0 to 1) the playhead is
+         towards the next frame
+        """
+        if not timestamps:
+            return 0, 0
+        first, last = timestamps[0], timestamps[-1]
+        radar_time = self.radar_time(now)
+        if self.playing and radar_time > last + self.hold * self.speed:
+            # Loop, carrying on from the oldest frame as if it had just been started there
+            self.play(first, now)
+            radar_time = first
+        index = max(0, bisect.bisect_right(timestamps, radar_time) - 1)
+        if index >= len(timestamps) - 1:
+            return len(timestamps) - 1, 0
+        span = timestamps[index + 1] - timestamps[index]
+        return index, min(1, max(0, (radar_time - timestamps[index]) / span)) if span else 0
+
+    def frames_per_second(self, timestamps):
+        """
+        :param timestamps: The sorted frame timestamps
+        :return: How many frames playback passes through per wall second on average
+        """
+        if len(timestamps) < 2:
+            return 0
+        return self.speed * (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
+
+
+class Crossfader:
+
+    def __init__(self, steps=4, cache_size=8):
+        """
+        Blends between two radar frames, the blend is quantized to a few steps so most draws reuse a cached blend
+        :param steps: How many blend steps there are between two frames
+        :param cache_size: How many blends to keep
+        """
+        self.steps = steps
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # (key a, key b, step) -> surface
+        self.blends = 0
+
+    def blend(self, key_a, surface_a, key_b, surface_b, fraction):
+        """
+        Blend two frames
+        :param key_a: Identifies the first frame, e.g. its timestamp
+        :param surface_a: The first frame
+        :param key_b: Identifies the second frame
+        :param surface_b: The second frame, frames that aren't both 32 bit in the same layout are cut between instead
+        :param fraction: How far from the first frame (0) to the second (1)
+        :return: The blended surface
+        """
+        step = round(fraction * self.steps)
+        if step == 0:
+            return surface_a
+        if step == self.steps:
+            return surface_b
+        if surface_a.get_size() != surface_b.get_size() or surface_a.get_pitch() != surface_b.get_pitch() or \
+                surface_a.get_masks() != surface_b.get_masks() or surface_a.get_bitsize() != 32:
+            return surface_a if step * 2 < self.steps else surface_b
+        key = (key_a, key_b, step)
+        blended = self.cache.pop(key, None)
+        if blended is None:
+            blended = surface_a.copy()
+            weight = step * 256 // self.steps
+            # Every channel gets the same weight, so the raw pixel bytes are blended as one flat array
+            a = numpy.frombuffer(blended.get_buffer(), numpy.uint8)
+            b = numpy.frombuffer(surface_b.get_buffer(), numpy.uint8)
+            mixed = a.astype(numpy.uint16)
+            mixed *= 256 - weight
+            mixed += b.astype(numpy.uint16) * numpy.uint16(weight)  # Widened first, a uint8 product would wrap
+            mixed >>= 8
+            numpy.copyto(a, mixed, casting="unsafe")
+            del a, b  # Unlock the surfaces
+            self.blends += 1
+        self.cache[key] = blended
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return blended
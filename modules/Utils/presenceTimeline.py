@@ -0,0 +1,216 @@
+import array
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TransitionRing:
+
+    def __init__(self, capacity=256):
+        """
+        A fixed size ring of (time, present) transitions backed by two flat arrays, the oldest are overwritten
+        :param capacity: How many transitions to keep
+        """
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.states = array.array('b', bytes(capacity))
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, present):
+        index = (self.start + self.count) % self.capacity
+        self.times[index] = timestamp
+        self.states[index] = 1 if present else 0
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """
+        Iterate the transitions oldest first
+        :return: An iterator of (time, present) tuples
+        """
+        for offset in range(self.count):
+            index = (self.start + offset) % self.capacity
+            yield self.times[index], bool(self.states[index])
+
+    def last(self, count):
+        """
+        Get the newest transitions
+        :param count: The most transitions to return
+        :return: A list of (time, present) tuples, oldest first
+        """
+        return list(self)[-count:] if count else []
+
+    def state_at(self, timestamp):
+        """
+        Get the state at a point in time
+        :param timestamp: The time to look up
+        :return: True or False, or None if it is older than every transition kept
+        """
+        state = None
+        for changed_at, present in self:
+            if changed_at > timestamp:
+                break
+            state = present
+        return state
+
+
+class Hysteresis:
+
+    def __init__(self, arrive_delay=0, leave_delay=180, state=None, since=0):
+        """
+        Debounces a flapping presence signal, a new value has to hold for a while before the state follows it
+        :param arrive_delay: How long the signal has to stay present before the state becomes present
+        :param leave_delay: How long the signal has to stay absent before the state becomes absent
+        :param state: The initial state, None until the first observation
+        :param since: When the initial state began
+        """
+        self.arrive_delay = arrive_delay
+        self.leave_delay = leave_delay
+        self.state = state
+        self.since = since
+        self.candidate = None
+        self.candidate_since = None
+
+    def update(self, present, now):
+        """
+        Feed in an observation of the raw signal
+        :param present: The raw signal, None (unknown) is ignored
+        :param now: The time of the observation
+        :return: True if the state changed
+        """
+        if present is None:
+            return False
+        if present == self.state:
+            self.candidate = None
+            self.candidate_since = None
+            return False
+        if self.candidate != present:
+            self.candidate = present
+            self.candidate_since = now
+        delay = self.arrive_delay if present else self.leave_delay
+        if self.state is not None and now - self.candidate_since < delay:
+            return False
+        # The change is dated to when the signal first changed, not to when the delay ran out
+        self.state = present
+        self.since = self.candidate_since
+        self.candidate = None
+        self.candidate_since = None
+        return True
+
+
+class PresenceTimeline:
+
+    def __init__(self, arrive_delay=0, leave_delay=180, capacity=256):
+        """
+        Keeps the debounced presence of each occupant and the history of when it changed
+        :param arrive_delay: See Hysteresis
+        :param leave_delay: See Hysteresis
+        :param capacity: How many transitions to keep per occupant
+        """
+        self.arrive_delay = arrive_delay
+        self.leave_delay = leave_delay
+        self.capacity = capacity
+        self.names = {}
+        self.states = {}
+        self.rings = {}
+
+    def _track(self, key, name):
+        if key not in self.states:
+            self.states[key] = Hysteresis(self.arrive_delay, self.leave_delay)
+            self.rings[key] = TransitionRing(self.capacity)
+        if name is not None:
+            self.names[key] = name
+
+    def observe(self, key, present, name=None, now=None):
+        """
+        Feed in a raw presence observation
+        :param key: The occupant's id (e.g. their device's MAC address)
+        :param present: The raw presence, True, False or None if unknown
+        :param name: The occupant's readable name
+        :param now: The time of the observation
+        :return: True if the debounced presence changed
+        """
+        now = time.time() if now is None else now
+        self._track(key, name)
+        state = self.states[key]
+        if not state.update(present, now):
+            return False
+        self.rings[key].append(state.since, state.state)
+        log.info(f"{self.names.get(key, key)} is now {'present' if state.state else 'absent'}")
+        return True
+
+    def present(self, key):
+        """
+        :param key: The occupant's id
+        :return: The debounced presence, None if unknown
+        """
+        state = self.states.get(key)
+        return state.state if state is not None else None
+
+    def since(self, key):
+        """
+        :param key: The occupant's id
+        :return: When the debounced presence last changed, 0 if never
+        """
+        state = self.states.get(key)
+        return state.since if state is not None else 0
+
+    def present_now(self):
+        return [key for key, state in self.states.items() if state.state]
+
+    def present_between(self, start, end):
+        """
+        Find who was here at any point in a time range
+        :param start: The start of the range
+        :param end: The end of the range
+        :return: A list of the ids of everyone present at some point in the range
+        """
+        found = []
+        for key, ring in self.rings.items():
+            if not len(ring) and self.present(key):
+                found.append(key)  # Present since before anything was recorded
+            elif ring.state_at(start) or any(start < changed_at <= end and present for changed_at, present in ring):
+                found.append(key)
+        return found
+
+    def transitions(self, key, start=None):
+        """
+        Get an occupant's history
+        :param key: The occupant's id
+        :param start: Only return transitions at or after this time
+        :return: A list of (time, present) tuples, oldest first
+        """
+        ring = self.rings.get(key)
+        if ring is None:
+            return []
+        return [entry for entry in ring if start is None or entry[0] >= start]
+
+    def to_dict(self, history=16):
+        """
+        Serialize the timeline to publish it in the room state
+        :param history: How many of the newest transitions to include per occupant
+        :return: A dict of id -> name, presence, since and recent transitions
+        """
+        return {key: {"name": self.names.get(key, key), "present": state.state, "since": state.since,
+                      "transitions": [[changed_at, present] for changed_at, present in self.rings[key].last(history)]}
+                for key, state in self.states.items()}
+
+    def load(self, data):
+        """
+        Restore a timeline published by to_dict, e.g. after a restart
+        :param data: The dict from to_dict
+        :return: None
+        """
+        for key, entry in (data or {}).items():
+            self._track(key, entry.get("name"))
+            for changed_at, present in entry.get("transitions", []):
+                self.rings[key].append(changed_at, present)
+            self.states[key].state = entry.get("present")
+            self.states[key].since = entry.get("since", 0)
@@ -0,0 +1,314 @@
+import bisect
+import io
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import numpy
+import pygame
+
+log = logging.getLogger(__name__)
+
+# Segment file: FILE_HEADER | capacity x SLOT | frame payloads, appended in order
+# Every frame in a segment has the same size and pixel format, 8 bit frames share the palette in the header
+# A slot is only written once its payload is on disk, so a slot with a kind of 0 is free
+MAGIC = b"HHRA"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sHHIIBxh768s")  # Magic, version, capacity, width, height, mode, colorkey, palette
+SLOT = struct.Struct("<qQIB3x")  # Timestamp, payload offset, payload length, kind
+
+MODE_RGBA = 1
+MODE_PALETTE = 2  # One palette index per pixel
+
+KIND_KEY = 1  # zlib of the pixels
+KIND_DELTA = 2  # zlib of the pixels XOR the previous frame's in the segment
+
+
+def frame_format(surface):
+    """
+    Get the pixels of a frame in the most compact format the archive can store it in
+    :param surface: The decoded frame
+    :return: A tuple of the pixel bytes and the format, (width, height, mode, colorkey index or -1, palette bytes)
+    """
+    width, height = surface.get_size()
+    if surface.get_bitsize() == 8 and surface.get_palette() is not None:
+        palette = b"".join(bytes(color[:3]) for color in surface.get_palette()).ljust(768, b"\0")
+        colorkey = surface.get_colorkey()
+        colorkey = surface.map_rgb(colorkey) if colorkey is not None else -1
+        return pygame.image.tostring(surface, "P"), (width, height, MODE_PALETTE, colorkey, palette)
+    return pygame.image.tostring(surface, "RGBA"), (width, height, MODE_RGBA, -1, bytes(768))
+
+
+class Segment:
+
+    def __init__(self, path):
+        """
+        Opens an existing segment file
+        :param path: The segment file
+        """
+        self.path = path
+        self.file = open(path, "r+b")
+        magic, version, self.capacity, *frame = FILE_HEADER.unpack(self.file.read(FILE_HEADER.size))
+        self.format = tuple(frame)
+        self.width, self.height, self.mode, self.colorkey, self.palette = self.format
+        if magic != MAGIC or version != VERSION:
+            self.file.close()
+            raise ValueError(f"{path} is not a radar archive segment")
+        table = self.file.read(SLOT.size * self.capacity)
+        self.slots = []  # (timestamp, offset, length, kind) of each written slot
+        for index in range(self.capacity):
+            slot = SLOT.unpack_from(table, index * SLOT.size)
+            if slot[3] == 0:
+                break
+            self.slots.append(slot)
+        self.end = self.file.seek(0, os.SEEK_END)
+        self.map = None
+
+    @classmethod
+    def create(cls, path, capacity, frame):
+        """
+        Create an empty segment file
+        :param path: The segment file
+        :param capacity: How many frames it can hold
+        :param frame: The format of its frames from frame_format
+        :return: The Segment
+        """
+        with open(path, "wb") as f:
+            f.write(FILE_HEADER.pack(MAGIC, VERSION, capacity, *frame))
+            f.write(bytes(SLOT.size * capacity))
+        return cls(path)
+
+    @property
+    def full(self):
+        return len(self.slots) >= self.capacity
+
+    def size(self):
+        return self.end
+
+    def append(self, timestamp, kind, payload):
+        """
+        Append a frame, the payload is flushed before the slot pointing at it is written
+        :return: The slot number
+        """
+        offset = self.end
+        self.file.seek(offset)
+        self.file.write(payload)
+        self.file.flush()
+        slot = (timestamp, offset, len(payload), kind)
+        self.file.seek(FILE_HEADER.size + SLOT.size * len(self.slots))
+        self.file.write(SLOT.pack(*slot))
+        self.file.flush()
+        self.end = offset + len(payload)
+        self.slots.append(slot)
+        return len(self.slots) - 1
+
+    def kind(self, index):
+        return self.slots[index][3]
+
+    def surface(self, pixels):
+        """
+        Wrap a frame's pixels in a surface
+        :param pixels: The pixel bytes from the archive
+        :return: A pygame surface of the frame
+        """
+        if self.mode == MODE_RGBA:
+            return pygame.image.frombuffer(pixels, (self.width, self.height), "RGBA")
+        surface = pygame.image.frombuffer(pixels, (self.width, self.height), "P")
+        surface.set_palette([tuple(self.palette[i:i + 3]) for i in range(0, 768, 3)])
+        if self.colorkey >= 0:
+            surface.set_colorkey(self.colorkey)
+        return surface
+
+    def read(self, index):
+        """
+        Read a slot's payload through a memory map of the file, remapped when the file has grown past it
+        :return: A tuple of the kind and the payload bytes
+        """
+        _, offset, length, kind = self.slots[index]
+        if self.map is None or len(self.map) < offset + length:
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return kind, self.map[offset:offset + length]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+
+class RadarArchive:
+
+    def __init__(self, directory, segment_frames=32, keyframe_interval=8, limit=376, compression=6,
+                 legacy_directory=None, legacy_prefix="KMQT"):
+        """
+        Stores radar frames as pixels in a few append-only segment files instead of a PNG per frame
+        Each frame is stored compressed either whole or XORed against the frame before it, whichever is smaller, where
+        the weather hasn't moved between scans most of the XOR is zeros. At least every keyframe_interval frames a
+        whole frame is stored so a seek decodes a bounded chain
+        :param directory: The directory to keep the segment files in
+        :param segment_frames: How many frames go in each segment file, old frames are deleted a segment at a time
+        :param keyframe_interval: Store a whole frame every this many frames
+        :param limit: Keep at least this many of the newest frames, whole segments past it are deleted
+        :param compression: The zlib level, only adding a frame pays for higher levels, decoding speed is the same
+        :param legacy_directory: A directory of <prefix>_<timestamp>.png frames to move into the archive
+        :param legacy_prefix: The frame file prefix in legacy_directory
+        """
+        self.directory = directory
+        self.segment_frames = segment_frames
+        self.keyframe_interval = keyframe_interval
+        self.limit = limit
+        self.compression = compression
+        self.lock = threading.Lock()
+        self.segments = []  # Oldest first
+        self.entries = {}  # timestamp -> (segment, slot)
+        self.timestamps = []  # Sorted, replaced rather than changed in place so readers needn't lock
+        self.next_segment = 0
+        self.last_added = None  # (segment, slot, pixels) of the newest frame, the base of the next delta
+        self.last_read = None  # (segment, slot, pixels) of the last frame decoded, playback reads in order
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+        if legacy_directory is not None and os.path.isdir(legacy_directory):
+            self._migrate(legacy_directory, legacy_prefix)
+
+    def _open(self):
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".rda"))
+        for name in names:
+            try:
+                segment = Segment(os.path.join(self.directory, name))
+            except (OSError, ValueError, struct.error) as e:
+                log.warning(f"Dropping unreadable radar archive segment {name}: {e}")
+                os.remove(os.path.join(self.directory, name))
+                continue
+            self.segments.append(segment)
+            for index, slot in enumerate(segment.slots):
+                self.entries[slot[0]] = (segment, index)
+            self.next_segment = int(name.split(".")[0].split("_")[1]) + 1
+        self.timestamps = sorted(self.entries)
+
+    def _migrate(self, legacy_directory, prefix):
+        frames = []
+        for name in os.listdir(legacy_directory):
+            stem, extension = os.path.splitext(name)
+            if extension == ".png" and stem.startswith(f"{prefix}_") and stem.split("_")[1].isdigit():
+                frames.append((int(stem.split("_")[1]), os.path.join(legacy_directory, name)))
+        if frames:
+            log.info(f"Moving {len(frames)} radar frames into the archive")
+        for timestamp, path in sorted(frames):
+            try:
+                with open(path, "rb") as f:
+                    self.add(timestamp, f.read())
+            except (OSError, pygame.error) as e:
+                log.warning(f"Skipping unreadable radar frame {path}: {e}")
+            os.remove(path)
+        legacy_index = os.path.join(os.path.dirname(os.path.normpath(legacy_directory)), f"{prefix}_index.json")
+        if os.path.isfile(legacy_index):
+            os.remove(legacy_index)
+        if not os.listdir(legacy_directory):
+            os.rmdir(legacy_directory)
+
+    def _new_segment(self, frame):
+        path = os.path.join(self.directory, f"segment_{self.next_segment:06d}.rda")
+        self.next_segment += 1
+        segment = Segment.create(path, self.segment_frames, frame)
+        self.segments.append(segment)
+        return segment
+
+    def _evict(self):
+        while len(self.segments) > 1 and len(self.timestamps) - len(self.segments[0].slots) >= self.limit:
+            segment = self.segments.pop(0)
+            for timestamp, _, _, _ in segment.slots:
+                del self.entries[timestamp]
+            self.timestamps = [timestamp for timestamp in self.timestamps if timestamp in self.entries]
+            if self.last_read is not None and self.last_read[0] is segment:
+                self.last_read = None
+            segment.close()
+            os.remove(segment.path)
+            log.debug(f"Deleted radar archive segment {segment.path}")
+
+    @staticmethod
+    def _xor(a, b):
+        return numpy.bitwise_xor(numpy.frombuffer(a, numpy.uint8), numpy.frombuffer(b, numpy.uint8)).tobytes()
+
+    def _pixels(self, segment, index):
+        """
+        Decode a frame from the nearest keyframe at or before it, or from the last frame decoded if that is closer
+        :return: The pixel bytes
+        """
+        start = index
+        while segment.kind(start) != KIND_KEY:
+            start -= 1
+        pixels = None
+        if self.last_read is not None and self.last_read[0] is segment and start <= self.last_read[1] <= index:
+            start, pixels = self.last_read[1] + 1, self.last_read[2]
+        for position in range(start, index + 1):
+            kind, payload = segment.read(position)
+            decoded = zlib.decompress(payload)
+            pixels = decoded if kind == KIND_KEY else self._xor(pixels, decoded)
+        self.last_read = (segment, index, pixels)
+        return pixels
+
+    def add(self, timestamp, data):
+        """
+        Append a frame
+        :param timestamp: The frame's timestamp
+        :param data: The frame in PNG format
+        :return: None
+        """
+        if timestamp in self.entries:
+            return
+        pixels, frame = frame_format(pygame.image.load(io.BytesIO(data)))
+        with self.lock:
+            if timestamp in self.entries:
+                return  # Another thread added the same frame while this one was decoding it
+            segment = self.segments[-1] if self.segments else None
+            if segment is None or segment.full or segment.format != frame:
+                segment = self._new_segment(frame)
+            index = len(segment.slots)
+            kind, payload = KIND_KEY, zlib.compress(pixels, self.compression)
+            key_distance = next((distance for distance in range(1, self.keyframe_interval)
+                                 if index - distance >= 0 and segment.kind(index - distance) == KIND_KEY), None)
+            if key_distance is not None:
+                if self.last_added is not None and self.last_added[0] is segment and self.last_added[1] == index - 1:
+                    previous = self.last_added[2]
+                else:
+                    previous = self._pixels(segment, index - 1)  # Appending after a restart
+                delta = zlib.compress(self._xor(pixels, previous), self.compression)
+                if len(delta) < len(payload):
+                    kind, payload = KIND_DELTA, delta
+            segment.append(timestamp, kind, payload)
+            self.last_added = (segment, index, pixels)
+            self.entries[timestamp] = (segment, index)
+            timestamps = list(self.timestamps)
+            bisect.insort(timestamps, timestamp)
+            self.timestamps = timestamps
+            self._evict()
+
+    def load(self, timestamp):
+        """
+        Decode a frame, a lookup plus at most keyframe_interval decompressions wherever it is in the archive
+        :param timestamp: The frame's timestamp
+        :return: A pygame surface of the frame
+        """
+        with self.lock:
+            segment, index = self.entries[timestamp]
+            pixels = self._pixels(segment, index)
+        return segment.surface(pixels)
+
+    def __contains__(self, timestamp):
+        return timestamp in self.entries
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, position):
+        return self.timestamps[position]
+
+    def stats(self):
+        with self.lock:
+            return {"frames": len(self.timestamps), "segments": len(self.segments),
+                    "bytes": sum(segment.size() for segment in self.segments)}
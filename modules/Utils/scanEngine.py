@@ -0,0 +1,193 @@
+import heapq
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DeviceSchedule:
+
+    def __init__(self, address, name, priority):
+        self.address = address
+        self.name = name
+        self.priority = priority
+        self.next_probe = 0
+        self.interval = 0
+        self.present = None
+        self.last_seen = 0
+        self.absent_probes = 0  # Probes in a row that didn't find the device
+        self.probes = 0
+        self.probe_time = 0
+        self.first_detection = None  # Seconds from the engine starting to the device first being seen
+
+
+class ScanEngine:
+
+    def __init__(self, probe, workers=3, present_interval=30, recent_interval=10, recent_window=600,
+                 max_interval=300, priority_max_interval=60):
+        """
+        Probes a list of devices from a fixed pool of worker threads, how often each device is probed adapts to how
+        recently it was seen
+        :param probe: Called with (address, name) from a worker thread, returns True if the device is present. It must
+         bound its own radio time (e.g. a connect timeout)
+        :param workers: How many probes can be in flight at once
+        :param present_interval: How often a present device is re-checked
+        :param recent_interval: How often a device seen within recent_window is probed once it goes missing
+        :param recent_window: How long after it was last seen a device counts as recently seen
+        :param max_interval: The longest time between probes of a long absent device, the interval doubles up to this
+        :param priority_max_interval: The longest time between probes of a priority device
+        """
+        self.probe = probe
+        self.workers = workers
+        self.present_interval = present_interval
+        self.recent_interval = recent_interval
+        self.recent_window = recent_window
+        self.max_interval = max_interval
+        self.priority_max_interval = priority_max_interval
+        self.devices = {}
+        self.schedule = []  # Heap of (next probe time, address)
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+        self.started_at = None
+        self.active_probes = 0
+        self.busy_since = None
+        self.busy_time = 0
+        self.total_probes = 0
+        self.probe_errors = 0
+
+    def add_device(self, address, name, priority=False):
+        """
+        Start probing a device, it is probed right away
+        :param address: The device's MAC address
+        :param name: A readable name for the device
+        :param priority: Priority devices are never backed off past priority_max_interval
+        :return: None
+        """
+        with self.condition:
+            if address in self.devices:
+                return
+            self.devices[address] = DeviceSchedule(address, name, priority)
+            heapq.heappush(self.schedule, (0, address))
+            self.condition.notify()
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+            self.started_at = time.time()
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def probe_soon(self, address):
+        """
+        Move a device to the front of the schedule, e.g. when its connection just dropped
+        :param address: The device's MAC address
+        :return: None
+        """
+        with self.condition:
+            device = self.devices.get(address)
+            if device is None or device.next_probe is None or device.next_probe <= time.time():
+                return  # Unknown, in flight or already due
+            device.next_probe = time.time()
+            heapq.heappush(self.schedule, (device.next_probe, address))
+            self.condition.notify()
+
+    def _next_interval(self, device, now):
+        if device.present:
+            return self.present_interval
+        if device.last_seen and now - device.last_seen < self.recent_window:
+            return self.recent_interval
+        # Back off exponentially on devices that have been gone a while
+        cap = self.priority_max_interval if device.priority else self.max_interval
+        return min(cap, self.recent_interval * 2 ** min(device.absent_probes, 16))
+
+    def _take(self):
+        """
+        Wait for the next device that is due
+        :return: The device, or None when the engine is stopping
+        """
+        with self.condition:
+            while self.running:
+                now = time.time()
+                while self.schedule:
+                    due, address = self.schedule[0]
+                    device = self.devices[address]
+                    if due != device.next_probe:
+                        heapq.heappop(self.schedule)  # Superseded by probe_soon
+                        continue
+                    break
+                if self.schedule and self.schedule[0][0] <= now:
+                    device = self.devices[heapq.heappop(self.schedule)[1]]
+                    device.next_probe = None  # In flight, so it can't be scheduled twice
+                    if not self.active_probes:
+                        self.busy_since = now
+                    self.active_probes += 1
+                    return device
+                self.condition.wait(self.schedule[0][0] - now if self.schedule else None)
+        return None
+
+    def _worker(self):
+        while True:
+            device = self._take()
+            if device is None:
+                return
+            started = time.time()
+            try:
+                present = bool(self.probe(device.address, device.name))
+            except Exception as e:
+                log.error(f"Probe of {device.name} failed: {e}")
+                self.probe_errors += 1
+                present = False
+            now = time.time()
+            with self.condition:
+                self.active_probes -= 1
+                if not self.active_probes:
+                    self.busy_time += now - self.busy_since
+                self.total_probes += 1
+                device.probes += 1
+                device.probe_time += now - started
+                device.present = present
+                if present:
+                    device.last_seen = now
+                    device.absent_probes = 0
+                    if device.first_detection is None:
+                        device.first_detection = now - self.started_at
+                else:
+                    device.absent_probes += 1
+                device.interval = self._next_interval(device, now)
+                device.next_probe = now + device.interval
+                heapq.heappush(self.schedule, (device.next_probe, device.address))
+                self.condition.notify()
+
+    def stats(self):
+        """
+        Get the scan statistics, for tuning the intervals and worker count
+        :return: A dict with the radio utilization, probe rate and per device detection times
+        """
+        with self.condition:
+            now = time.time()
+            elapsed = now - self.started_at if self.started_at else 0
+            busy = self.busy_time + (now - self.busy_since if self.active_probes else 0)
+            detections = [device.first_detection for device in self.devices.values()
+                          if device.first_detection is not None]
+            return {"device_count": len(self.devices), "workers": self.workers, "probes": self.total_probes,
+                    "probe_errors": self.probe_errors,
+                    "probes_per_minute": round(self.total_probes / elapsed * 60, 1) if elapsed else 0,
+                    "radio_utilization": round(busy / elapsed, 3) if elapsed else 0,
+                    "first_detection_max": round(max(detections), 1) if detections else None,
+                    "devices": {device.name: {"present": device.present, "interval": device.interval,
+                                              "probes": device.probes,
+                                              "mean_probe_time": round(device.probe_time / device.probes, 2)
+                                              if device.probes else None,
+                                              "first_detection": round(device.first_detection, 1)
+                                              if device.first_detection is not None else None}
+                                for device in self.devices.values()}}
@@ -0,0 +1,654 @@
+import collections
+import logging
+import struct
+import threading
+import time
+import traceback
+
+import serial
+
+log = logging.getLogger(__name__)
+
+# Framed protocol: SYNC | seq (u8) | type (u8) | payload length (u16) | payload | CRC16 of everything after SYNC
+SYNC = b"\xa5\x5a"
+HEADER = struct.Struct("<BBH")
+CRC = struct.Struct("<H")
+MAX_PAYLOAD = 1024
+
+FRAME_SLOTS = 0x01  # Host -> device, the full set of data slots
+FRAME_SENSORS = 0x02  # Device -> host, the sensor readings, carries the seq of the frame it answers
+FRAME_ACK = 0x03  # Device -> host, acknowledges the frame with the same seq
+FRAME_RAW = 0x04  # Host -> device, opaque bytes such as image rows
+FRAME_DELTA = 0x05  # Host -> device, only the slots that changed as (index, length, bytes) triples
+FRAME_POLL = 0x06  # Host -> device, asks for the sensor readings without touching the slots
+FRAME_IMAGE = 0x07  # Host -> device, a chunk of image data, acknowledged by a FRAME_ACK carrying its offset
+IMAGE_HEADER = struct.Struct("<HH")  # Chunk offset, total image size
+
+SLOT_COUNT = 16
+SENSOR_FIELDS = 8
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_crc_table = _crc16_table()
+
+
+def crc16(data, crc=0xFFFF):
+    """
+    CRC-16/CCITT-FALSE, cheap enough for an AVR to check on every frame
+    :param data: The bytes to checksum
+    :param crc: The initial value
+    :return: The checksum
+    """
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _crc_table[(crc >> 8) ^ byte]
+    return crc
+
+
+def pack_frame(seq, frame_type, payload=b""):
+    """
+    Build a framed protocol frame
+    :param seq: The sequence number (0-255)
+    :param frame_type: One of the FRAME_ constants
+    :param payload: The frame payload
+    :return: The frame bytes
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload of {len(payload)} bytes is over the {MAX_PAYLOAD} byte limit")
+    body = HEADER.pack(seq & 0xFF, frame_type, len(payload)) + payload
+    return SYNC + body + CRC.pack(crc16(body))
+
+
+def slot_bytes(value):
+    """
+    Convert a data slot value to the bytes sent to the coprocessor
+    :param value: The slot value
+    :return: The slot bytes
+    """
+    if value is None:
+        return b" "
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode("ascii", "replace")
+
+
+def encode_fields(fields):
+    """
+    Pack a list of fields as length prefixed byte strings
+    :param fields: The fields, anything slot_bytes accepts
+    :return: The payload bytes
+    """
+    parts = []
+    for field in fields:
+        data = slot_bytes(field)[:255]
+        parts.append(bytes((len(data),)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_fields(payload):
+    """
+    Unpack length prefixed byte strings
+    :param payload: The payload bytes
+    :return: A list of the fields as bytes
+    """
+    fields = []
+    offset = 0
+    while offset < len(payload):
+        length = payload[offset]
+        fields.append(bytes(payload[offset + 1:offset + 1 + length]))
+        offset += 1 + length
+    return fields
+
+
+def encode_delta(changes):
+    """
+    Pack changed slots for a FRAME_DELTA frame
+    :param changes: A dict of slot index -> value
+    :return: The payload bytes
+    """
+    parts = []
+    for index, value in changes.items():
+        data = slot_bytes(value)[:255]
+        parts.append(bytes((index, len(data))))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_delta(payload):
+    """
+    Unpack a FRAME_DELTA payload
+    :param payload: The payload bytes
+    :return: A dict of slot index -> value bytes
+    """
+    changes = {}
+    offset = 0
+    while offset + 1 < len(payload):
+        index, length = payload[offset], payload[offset + 1]
+        changes[index] = bytes(payload[offset + 2:offset + 2 + length])
+        offset += 2 + length
+    return changes
+
+
+def encode_ascii_slots(slots):
+    """
+    Build the legacy ASCII slot message, every slot terminated by a bell and the message by a newline
+    :param slots: The data slot values
+    :return: The message bytes
+    """
+    return b"".join([slot_bytes(value) + b"\a" for value in slots]) + b"\n"
+
+
+class FrameParser:
+
+    def __init__(self):
+        """
+        Reassembles framed protocol frames from a byte stream, resyncing on corruption
+        """
+        self.buffer = bytearray()
+        self.crc_errors = 0
+        self.dropped_bytes = 0
+
+    def feed(self, data, now=None):
+        """
+        Add received bytes and pull out every complete, valid frame
+        :param data: The received bytes
+        :param now: Unused, matches AsciiParser.feed
+        :return: A list of (seq, type, payload) tuples
+        """
+        self.buffer += data
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start == -1:
+                # Keep a trailing first sync byte, the second one may be in the next read
+                keep = 1 if self.buffer.endswith(SYNC[:1]) else 0
+                self.dropped_bytes += len(self.buffer) - keep
+                del self.buffer[:len(self.buffer) - keep]
+                return frames
+            if start:
+                self.dropped_bytes += start
+                del self.buffer[:start]
+            if len(self.buffer) < len(SYNC) + HEADER.size:
+                return frames
+            seq, frame_type, length = HEADER.unpack_from(self.buffer, len(SYNC))
+            if length > MAX_PAYLOAD:
+                self._resync()
+                continue
+            end = len(SYNC) + HEADER.size + length + CRC.size
+            if len(self.buffer) < end:
+                return frames
+            body = bytes(self.buffer[len(SYNC):end - CRC.size])
+            if CRC.unpack_from(self.buffer, end - CRC.size)[0] != crc16(body):
+                self.crc_errors += 1
+                self._resync()
+                continue
+            frames.append((seq, frame_type, body[HEADER.size:]))
+            del self.buffer[:end]
+
+    def _resync(self):
+        # Skip this sync marker and look for the next one
+        del self.buffer[:1]
+        self.dropped_bytes += 1
+
+
+class AsciiParser:
+
+    def __init__(self, fields=SENSOR_FIELDS, gap=0.05):
+        """
+        Reassembles the legacy bell delimited sensor records, however the reads split them
+        :param fields: The number of fields in a record
+        :param gap: A pause this long between bytes starts a new record, so one lost byte can't misalign every record after it
+        """
+        self.fields = fields
+        self.gap = gap
+        self.buffer = bytearray()
+        self.partial = []
+        self.last_byte = 0
+        self.crc_errors = 0  # The ASCII protocol has no checksum, kept so the stats look the same for both protocols
+        self.dropped_bytes = 0
+
+    def feed(self, data, now=None):
+        """
+        Add received bytes and pull out every complete record
+        :param data: The received bytes
+        :param now: The time the bytes were received
+        :return: A list of records, each a list of the fields as bytes
+        """
+        now = time.time() if now is None else now
+        if self.last_byte and now - self.last_byte > self.gap and (self.partial or self.buffer):
+            self.dropped_bytes += len(self.buffer.strip()) + sum(len(field) + 1 for field in self.partial)
+            self.buffer = bytearray()
+            self.partial = []
+        self.last_byte = now
+        self.buffer += data
+        records = []
+        while True:
+            end = self.buffer.find(b"\a")
+            if end == -1:
+                break
+            field = bytes(self.buffer[:end])
+            del self.buffer[:end + 1]
+            if b"\n" in field:
+                # A newline ends a record, whatever came before it in this field belongs to the last one
+                self.dropped_bytes += sum(len(partial) + 1 for partial in self.partial)
+                self.partial = []
+                field = field.rsplit(b"\n", 1)[1]
+            self.partial.append(field.strip(b"\r"))
+            if len(self.partial) == self.fields:
+                records.append(self.partial)
+                self.partial = []
+        return records
+
+
+class LinkStats:
+
+    def __init__(self, samples=512):
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.coalesced = 0
+        self.write_errors = 0
+        self.reconnects = 0
+        self.keyframes = 0
+        self.deltas = 0
+        self.polls = 0
+        self.lost_replies = 0
+        self.chunks_sent = 0
+        self.retransmits = 0
+        self.latencies = collections.deque(maxlen=samples)
+
+    def percentile(self, percent):
+        """
+        Get a round trip latency percentile over the recent frames
+        :param percent: The percentile to get (0-100)
+        :return: The latency in milliseconds, or None if nothing has been measured
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))] * 1000, 2)
+
+
+class SerialLink:
+
+    def __init__(self, port, baudrate, protocol="ascii", on_record=None, on_connection=None, keepalive=2,
+                 reconnect_interval=5, history=64, delta=False, keyframe_interval=30, reply_timeout=1):
+        """
+        Owns one serial port, a reader thread reassembles incoming records and a writer thread sends queued messages
+        :param port: The serial device path
+        :param baudrate: The baud rate
+        :param protocol: "ascii" for the legacy bell delimited messages, "framed" for checksummed binary frames
+        :param on_record: Called with each received sensor record (a list of the fields as bytes)
+        :param on_connection: Called with True or False when the port is opened or lost
+        :param keepalive: While polling, resend the last slots after this many seconds without a write
+        :param reconnect_interval: How long to wait between attempts to reopen a lost port
+        :param history: How many received records to keep in the ring buffer
+        :param delta: Only send the slots that changed, framed protocol only
+        :param keyframe_interval: In delta mode, send every slot at least this often so the device can't drift
+        :param reply_timeout: In delta mode, a slot frame unanswered for this long forces the next one to be a keyframe
+        """
+        if delta and protocol != "framed":
+            log.warning(f"Delta slot updates need the framed protocol, sending full slots to {port}")
+            delta = False
+        self.port = port
+        self.baudrate = baudrate
+        self.protocol = protocol
+        self.on_record = on_record
+        self.on_connection = on_connection
+        self.keepalive = keepalive
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.reply_timeout = reply_timeout
+        self.device_slots = None  # What the device was last sent, None forces a keyframe
+        self.last_keyframe = 0
+        self.reconnect_interval = reconnect_interval
+        self.serial = None
+        self.connected = False
+        self.running = False
+        self.polling = False
+        self.parser = FrameParser() if protocol == "framed" else AsciiParser()
+        self.records = collections.deque(maxlen=history)  # (time, fields) of the most recent records
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.last_slots = None
+        self.last_write = 0
+        self.last_attempt = 0
+        self.seq = 0
+        self.sent_at = {}  # seq -> send time, framed protocol only
+        self.awaiting_reply = None  # Send time of the last slots message, ASCII protocol only
+        self.replied = threading.Event()  # Set when a record arrives after the last slots message
+        self.acks = set()  # Offsets of the image chunks the device acknowledged
+        self.ack_condition = threading.Condition()
+        self.stats = LinkStats()
+        self.threads = []
+
+    def open(self):
+        """
+        Try to open the serial port
+        :return: True if the port is open
+        """
+        self.last_attempt = time.time()
+        log.info(f"[*] Establishing connection to coprocessor on {self.port}")
+        try:
+            self.serial = serial.Serial(self.port, self.baudrate, timeout=0.25)
+        except Exception as e:
+            log.warning(f"[!] Failed to establish connection to coprocessor on {self.port} {e}\n{traceback.format_exc()}")
+            self._set_connected(False)
+            return False
+        log.info(f"[*] Connection established to coprocessor on {self.port}")
+        self._set_connected(True)
+        return True
+
+    def start(self):
+        """
+        Open the port and start the reader and writer threads
+        :return: True if the port is open
+        """
+        opened = self.open()
+        self.running = True
+        self.threads = [threading.Thread(target=self._reader, daemon=True),
+                        threading.Thread(target=self._writer, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        return opened
+
+    def close(self):
+        """
+        Stop the threads and close the port
+        :return: None
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join(1)
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except Exception:
+                pass
+        self._set_connected(False)
+
+    def _set_connected(self, connected):
+        if connected:
+            self.device_slots = None  # Opening the port resets the arduino
+        if connected != self.connected:
+            with self.condition:
+                self.connected = connected
+                self.sent_at.clear()
+                self.condition.notify()
+            with self.ack_condition:
+                self.ack_condition.notify()
+            if self.on_connection is not None:
+                self.on_connection(connected)
+
+    def _lost(self, error):
+        log.error(f"Coprocessor on {self.port} serial error: {error}")
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        self.stats.reconnects += 1
+        self._set_connected(False)
+
+    def set_polling(self, polling):
+        """
+        Turn the periodic resend of the last slots on or off
+        :param polling: True to resend after keepalive seconds without a write
+        :return: None
+        """
+        with self.condition:
+            self.polling = polling
+            self.condition.notify()
+
+    def submit(self, slots, coalesce=True):
+        """
+        Queue the data slots to be sent
+        :param slots: The data slot values
+        :param coalesce: Replace a slot update still waiting at the end of the queue instead of queueing another
+        :return: None
+        """
+        with self.condition:
+            self.last_slots = slots
+            if coalesce and self.queue and self.queue[-1][0] == "slots":
+                self.queue[-1] = ("slots", slots)
+                self.stats.coalesced += 1
+            else:
+                self.queue.append(("slots", slots))
+            self.condition.notify()
+
+    def write_raw(self, data):
+        """
+        Queue opaque bytes to be sent after everything already queued
+        :param data: The bytes to send
+        :return: None
+        """
+        self.queue_sequence([("raw", data)])
+
+    def queue_sequence(self, items):
+        """
+        Queue several items back to back, nothing submitted meanwhile can end up between them
+        :param items: A list of ("command", slots) to send slots once without making them the slots the keepalive
+         resends, ("raw", bytes), or ("sync", timeout) to hold the queue until the device answers the last slots
+        :return: None
+        """
+        with self.condition:
+            self.queue.extend(items)
+            self.condition.notify()
+
+    def transfer(self, data, chunk_size=64, window=4, timeout=0.5, retries=5):
+        """
+        Send a blob as FRAME_IMAGE chunks, keeping up to window chunks unacknowledged and resending any that time out
+        Framed protocol only, blocks the calling thread until the device has acknowledged every chunk
+        :param data: The bytes to send
+        :param chunk_size: The most bytes per frame
+        :param window: The most chunks in flight
+        :param timeout: How long to wait for a chunk's acknowledgement before resending it
+        :param retries: How many times a chunk is sent before giving up
+        :return: True if every chunk was acknowledged
+        """
+        if self.protocol != "framed":
+            raise ValueError("Acknowledged transfers need the framed protocol")
+        offsets = collections.deque(range(0, len(data), chunk_size))
+        in_flight = {}  # offset -> (send time, attempts)
+        with self.ack_condition:
+            self.acks.clear()
+            while offsets or in_flight:
+                if not self.running or not self.connected:
+                    return False
+                for offset in [offset for offset in in_flight if offset in self.acks]:
+                    del in_flight[offset]
+                now = time.time()
+                for offset, (sent, attempts) in list(in_flight.items()):
+                    if sent + timeout > now:
+                        continue
+                    if attempts >= retries:
+                        log.warning(f"Gave up on a transfer to {self.port}, chunk {offset} was never acknowledged")
+                        return False
+                    in_flight[offset] = (now, attempts + 1)
+                    self._queue_chunk(data, offset, chunk_size)
+                    self.stats.retransmits += 1
+                while offsets and len(in_flight) < window:
+                    offset = offsets.popleft()
+                    in_flight[offset] = (now, 1)
+                    self._queue_chunk(data, offset, chunk_size)
+                if in_flight:
+                    oldest = min(sent for sent, _ in in_flight.values())
+                    self.ack_condition.wait(max(0.01, oldest + timeout - time.time()))
+        return True
+
+    def _queue_chunk(self, data, offset, chunk_size):
+        payload = IMAGE_HEADER.pack(offset, len(data)) + data[offset:offset + chunk_size]
+        self.stats.chunks_sent += 1
+        self.queue_sequence([("image", payload)])
+
+    def latest(self):
+        """
+        Get the most recently received record
+        :return: A (time, fields) tuple, or None if nothing has been received
+        """
+        return self.records[-1] if self.records else None
+
+    def to_dict(self):
+        stats = self.stats
+        return {"port": self.port, "protocol": self.protocol, "connected": self.connected,
+                "frames_sent": stats.frames_sent, "frames_received": stats.frames_received,
+                "bytes_sent": stats.bytes_sent, "bytes_received": stats.bytes_received,
+                "coalesced": stats.coalesced, "crc_errors": self.parser.crc_errors,
+                "dropped_bytes": self.parser.dropped_bytes, "write_errors": stats.write_errors,
+                "reconnects": stats.reconnects, "keyframes": stats.keyframes, "deltas": stats.deltas,
+                "polls": stats.polls, "lost_replies": stats.lost_replies, "chunks_sent": stats.chunks_sent,
+                "retransmits": stats.retransmits, "latency_p50_ms": stats.percentile(50),
+                "latency_p99_ms": stats.percentile(99)}
+
+    def _encode(self, item):
+        kind, value = item
+        if self.protocol != "framed":
+            return encode_ascii_slots(value) if kind in ("slots", "command") else value
+        self.seq = (self.seq + 1) & 0xFF
+        if kind == "image":
+            return pack_frame(self.seq, FRAME_IMAGE, value)
+        if kind in ("slots", "command"):
+            now = time.time()
+            self._expire_replies(now)
+            self.sent_at[self.seq] = now
+            return pack_frame(self.seq, *self._slot_frame(value, now))
+        return pack_frame(self.seq, FRAME_RAW, value)
+
+    def _slot_frame(self, slots, now):
+        """
+        Pick the cheapest frame that brings the device up to date
+        :param slots: The data slot values
+        :param now: The current time
+        :return: A tuple of the frame type and payload
+        """
+        previous, self.device_slots = self.device_slots, list(slots)
+        if not self.delta or previous is None or len(previous) != len(slots) \
+                or self.last_keyframe + self.keyframe_interval <= now:
+            self.last_keyframe = now
+            self.stats.keyframes += 1
+            return FRAME_SLOTS, encode_fields(slots)
+        changes = {index: value for index, value in enumerate(slots)
+                   if slot_bytes(value) != slot_bytes(previous[index])}
+        if not changes:
+            self.stats.polls += 1
+            return FRAME_POLL, b""
+        self.stats.deltas += 1
+        return FRAME_DELTA, encode_delta(changes)
+
+    def _expire_replies(self, now):
+        # A frame the device never answered may never have arrived, so it can't be diffed against any more
+        expired = [seq for seq, sent in list(self.sent_at.items()) if sent + self.reply_timeout < now]
+        for seq in expired:
+            self.sent_at.pop(seq, None)
+        if expired:
+            self.stats.lost_replies += len(expired)
+            self.device_slots = None
+
+    def _writer(self):
+        while True:
+            with self.condition:
+                if self.running and not self.queue:
+                    self.condition.wait(self._idle_timeout())
+                if not self.running:
+                    return
+                item = self.queue.popleft() if self.queue else None
+                if item is None and self.last_slots is not None and self._resend_due(time.time()):
+                    item = ("slots", self.last_slots)
+            if item is None or not self.connected:
+                continue
+            if item[0] == "sync":
+                self.replied.wait(item[1])
+                continue
+            data = self._encode(item)
+            if item[0] in ("slots", "command"):
+                self.replied.clear()
+            try:
+                self.serial.write(data)
+            except Exception as e:
+                self.stats.write_errors += 1
+                self._lost(e)
+                continue
+            self.last_write = time.time()
+            if item[0] in ("slots", "command") and self.protocol != "framed":
+                self.awaiting_reply = self.last_write
+            self.stats.frames_sent += 1
+            self.stats.bytes_sent += len(data)
+
+    def _idle_timeout(self):
+        """
+        How long the writer can sleep before a keepalive or a resync is due
+        :return: The timeout in seconds, or None to wait for the next submit
+        """
+        if self.last_slots is None or not self.connected:
+            return None  # Reconnecting wakes the writer
+        deadlines = []
+        if self.polling:
+            deadlines.append(self.last_write + self.keepalive)
+        if self.delta and self.sent_at:
+            deadlines.append(min(list(self.sent_at.values())) + self.reply_timeout)
+        return max(0, min(deadlines) - time.time()) if deadlines else None
+
+    def _resend_due(self, now):
+        if not self.connected:
+            return False
+        # The coprocessor only reports its sensors when written to
+        if self.polling and self.last_write + self.keepalive <= now:
+            return True
+        # A delta frame the device never answered may have been lost, resync it with a keyframe right away
+        if self.delta and any(sent + self.reply_timeout < now for sent in list(self.sent_at.values())):
+            return True
+        return False
+
+    def _reader(self):
+        while self.running:
+            if not self.connected:
+                if self.last_attempt + self.reconnect_interval > time.time() or not self.open():
+                    time.sleep(0.25)
+                continue
+            try:
+                data = self.serial.read(max(1, self.serial.in_waiting))
+            except Exception as e:
+                self._lost(e)
+                continue
+            if not data:
+                continue
+            now = time.time()
+            self.stats.bytes_received += len(data)
+            for received in self.parser.feed(data, now):
+                self._received(received, now)
+
+    def _received(self, received, now):
+        if self.protocol == "framed":
+            seq, frame_type, payload = received
+            sent = self.sent_at.pop(seq, None)
+            if sent is not None:
+                self.stats.latencies.append(now - sent)
+            if frame_type == FRAME_ACK and len(payload) >= 2:
+                with self.ack_condition:
+                    self.acks.add(struct.unpack_from("<H", payload)[0])
+                    self.ack_condition.notify()
+            if frame_type != FRAME_SENSORS:
+                return
+            fields = decode_fields(payload)
+        else:
+            fields = received
+            if self.awaiting_reply is not None:
+                self.stats.latencies.append(now - self.awaiting_reply)
+                self.awaiting_reply = None
+        self.stats.frames_received += 1
+        self.records.append((now, fields))
+        self.replied.set()
+        if self.on_record is not None:
+            self.on_record(fields)
@@ -0,0 +1,81 @@
+import hashlib
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class CameraHistory:
+
+    def __init__(self, now):
+        self.digest = None
+        self.last_changed = now  # Until its first image a camera counts from when tracking started
+        self.change_period = None  # Running average of the time between changes
+        self.observed = 0
+        self.changes = 0
+
+
+class StaleTracker:
+
+    def __init__(self, stale_after=65):
+        """
+        Tracks when each camera's image last changed by hashing the image bytes as they arrive, so an unchanged image
+        can be dropped before it is decoded and scaled
+        :param stale_after: How long in seconds a camera's image can go unchanged before it is stale
+        """
+        self.stale_after = stale_after
+        self.cameras = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def _history(self, key, now):
+        history = self.cameras.get(key)
+        if history is None:
+            history = self.cameras[key] = CameraHistory(self.started if now >= self.started else now)
+        return history
+
+    def observe(self, key, data, now=None):
+        """
+        Record a fetched image
+        :param key: Identifies the camera
+        :param data: The encoded image bytes
+        :param now: The time it was fetched, defaults to now
+        :return: True if the image is different from the camera's last one
+        """
+        now = time.time() if now is None else now
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with self.lock:
+            history = self._history(key, now)
+            history.observed += 1
+            if digest == history.digest:
+                return False
+            if history.digest is not None:
+                period = now - history.last_changed
+                history.change_period = period if history.change_period is None else \
+                    history.change_period * 0.7 + period * 0.3
+                history.changes += 1
+            history.digest = digest
+            history.last_changed = now
+            return True
+
+    def unchanged_for(self, key, now=None):
+        """
+        :param key: Identifies the camera
+        :param now: The time to measure to, defaults to now
+        :return: How many seconds since the camera's image last changed
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            return now - self._history(key, now).last_changed
+
+    def is_stale(self, key, now=None):
+        return self.unchanged_for(key, now) > self.stale_after
+
+    def stats(self):
+        with self.lock:
+            return {key: {"observed": history.observed, "changes": history.changes,
+                          "change_period": round(history.change_period, 1)
+                          if history.change_period is not None else None,
+                          "unchanged_for": round(time.time() - history.last_changed, 1)}
+                    for key, history in self.cameras.items()}
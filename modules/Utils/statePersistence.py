@@ -0,0 +1,215 @@
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class StatePersistence:
+
+    def __init__(self, state, save_file, backup_file, journal_file, snapshot_interval=30, journal_limit=256 * 1024,
+                 commit_interval=2, volatile=()):
+        """
+        Persists a VersionedState from a background thread, changes are gathered for a moment and appended to a
+        journal together and the full state is rewritten as a snapshot every so often
+        :param state: The VersionedState to persist
+        :param save_file: The path of the snapshot file
+        :param backup_file: The path the previous snapshot is kept at
+        :param journal_file: The path of the append only change journal
+        :param snapshot_interval: The least time in seconds between snapshots
+        :param journal_limit: Take a snapshot early once the journal grows past this many bytes
+        :param commit_interval: How long in seconds to gather changes for before writing and syncing them, a state
+         that changes several times in that time is only written once
+        :param volatile: State names that are rebuilt at runtime (e.g. uptimes) and never written to disk
+        """
+        self.state = state
+        self.save_file = save_file
+        self.backup_file = backup_file
+        self.journal_file = journal_file
+        self.snapshot_interval = snapshot_interval
+        self.journal_limit = journal_limit
+        self.commit_interval = commit_interval
+        self.volatile = frozenset(volatile)
+        self.pending = set()
+        self.pending_replace = False
+        self.wakeup = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.journal = None
+        self.last_snapshot = 0
+        self.journal_writes = 0
+        self.snapshots = 0
+
+    def load(self):
+        """
+        Load the last snapshot (or the backup if it is unreadable) and replay the journal on top of it
+        :return: The loaded state, or None if nothing was saved
+        """
+        data = None
+        for path in (self.save_file, self.backup_file):
+            if not os.path.isfile(path):
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+                log.info(f"Loaded room state snapshot from {path}")
+                break
+            except Exception as e:
+                log.error(f"Failed to load room state snapshot from {path}: {e}")
+        replayed = 0
+        if os.path.isfile(self.journal_file):
+            with open(self.journal_file) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        log.warning("Room state journal ends in a partial entry, it was cut off by a power loss")
+                        break
+                    if data is None:
+                        data = {}
+                    if "replace" in entry:
+                        data = entry["replace"]
+                    data.update(entry.get("set", {}))
+                    for key in entry.get("deleted", []):
+                        data.pop(key, None)
+                    replayed += 1
+        if replayed:
+            log.info(f"Replayed {replayed} room state changes from the journal")
+        return data
+
+    def start(self):
+        """
+        Start persisting every change to the state
+        :return: None
+        """
+        if self.running:
+            return
+        directory = os.path.dirname(self.journal_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.running = True
+        self.journal = open(self.journal_file, "a")
+        self.state.add_listener(self.on_change)
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Write out anything pending and stop the writer thread
+        :return: None
+        """
+        with self.wakeup:
+            self.running = False
+            self.wakeup.notify()
+        if self.thread is not None:
+            self.thread.join(5)
+
+    def on_change(self, keys):
+        """
+        State change listener, only records what changed so the caller never waits on the disk
+        :param keys: The changed state names, or None if every state was replaced
+        :return: None
+        """
+        with self.wakeup:
+            if keys is None:
+                self.pending_replace = True
+            else:
+                keys = [key for key in keys if key not in self.volatile]
+                if not keys:
+                    return
+                self.pending.update(keys)
+            self.wakeup.notify()
+
+    def _collect(self):
+        """
+        Serialize the pending changes, and the whole state when a snapshot is due, at one consistent point
+        :return: A tuple of the journal line (or None) and the snapshot (or None)
+        """
+        with self.wakeup:
+            keys, self.pending = self.pending, set()
+            replace, self.pending_replace = self.pending_replace, False
+        snapshot_due = self.last_snapshot + self.snapshot_interval < time.time() or replace \
+            or self.journal.tell() > self.journal_limit
+        with self.state.lock:
+            line = None
+            if replace:
+                line = json.dumps({"replace": self._persisted()})
+            elif keys:
+                line = json.dumps({"set": {key: self.state[key] for key in keys if key in self.state},
+                                   "deleted": [key for key in keys if key not in self.state]})
+            snapshot = json.dumps(self._persisted(), indent=2) if snapshot_due and (line or self.journal.tell()) else None
+        return line, snapshot
+
+    def _persisted(self):
+        if not self.volatile:
+            return self.state
+        return {key: value for key, value in self.state.items() if key not in self.volatile}
+
+    def _writer(self):
+        while True:
+            with self.wakeup:
+                if self.running and not self.pending and not self.pending_replace:
+                    self.wakeup.wait(self.snapshot_interval)
+                if self.pending or self.pending_replace:
+                    # Let changes gather so a burst of them costs one write and one fsync
+                    deadline = time.time() + self.commit_interval
+                    while self.running and time.time() < deadline:
+                        self.wakeup.wait(deadline - time.time())
+                running = self.running
+            try:
+                line, snapshot = self._collect()
+                if line is not None:
+                    self._append(line)
+                if snapshot is not None:
+                    self._write_snapshot(snapshot)
+            except Exception as e:
+                log.error(f"Failed to persist room state: {e}")
+                time.sleep(1)
+            if not running:
+                self.journal.close()
+                return
+
+    def _append(self, line):
+        self.journal.write(line + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_writes += 1
+
+    def _write_snapshot(self, snapshot):
+        """
+        Atomically replace the snapshot, then start a new journal since everything in it is now in the snapshot
+        :param snapshot: The serialized state
+        :return: None
+        """
+        tmp_file = self.save_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_file, 0o777)
+        if os.path.isfile(self.save_file):
+            os.replace(self.save_file, self.backup_file)
+        os.replace(tmp_file, self.save_file)
+        self._sync_directory()
+        # A crash before the journal is cleared is harmless, replaying it over the new snapshot changes nothing
+        self.journal.truncate(0)
+        self.journal.seek(0)
+        os.fsync(self.journal.fileno())
+        self.last_snapshot = time.time()
+        self.snapshots += 1
+        log.debug("Saved room state snapshot")
+
+    def _sync_directory(self):
+        directory = os.path.dirname(os.path.abspath(self.save_file))
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return  # Not supported on this platform
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
@@ -0,0 +1,31 @@
+import io
+import logging
+
+import pygame
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+def decode_thumbnail(data, size):
+    """
+    Decode an image straight to the size it is drawn at
+    JPEGs are decoded with libjpeg's DCT scaling at the smallest of 1/1, 1/2, 1/4 or 1/8 scale that is still at least
+    the target size, so a full size campus camera image is never decoded in full just to be shrunk to a grid cell.
+    Pillow's pixels are handed to pygame as they are, without re-encoding them
+    :param data: The encoded image bytes
+    :param size: The (width, height) to decode to
+    :return: A pygame surface of the image, call convert() on it before blitting it often
+    """
+    size = (max(1, int(size[0])), max(1, int(size[1])))
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.draft("RGB", size)  # Only has an effect on JPEGs
+        image = image.convert("RGB")
+    except OSError as e:  # Formats Pillow can't read, fall back to decoding at full size in pygame
+        log.debug(f"Pillow couldn't decode thumbnail ({e}), decoding it with pygame")
+        return pygame.transform.scale(pygame.image.load(io.BytesIO(data)), size)
+    surface = pygame.image.frombuffer(image.tobytes(), image.size, "RGB")
+    if image.size != size:  # The rest of the way, smoothscale is quicker than Pillow's resize for the last step
+        surface = pygame.transform.smoothscale(surface, size)
+    return surface
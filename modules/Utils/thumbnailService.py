@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class CameraSchedule:
+
+    def __init__(self, key, url, name):
+        self.key = key
+        self.url = url
+        self.name = name
+        self.visible = False
+        self.next_poll = 0  # None while a fetch is in flight
+        self.interval = 0
+        self.etag = None
+        self.last_modified = None
+        self.last_changed = None
+        self.change_period = None  # Running average of the time between changes
+        self.polls = 0
+        self.not_modified = 0
+        self.bytes = 0
+
+
+class ThumbnailService:
+
+    def __init__(self, on_thumbnail, on_unchanged=None, on_error=None, workers=3, timeout=10, min_interval=15,
+                 visible_interval=45, max_interval=300, hidden_interval=600):
+        """
+        Polls camera thumbnails from a fixed pool of worker threads sharing one keep-alive connection pool
+        Requests are conditional, so an unchanged image costs a 304 instead of the whole JPEG, and each camera is
+        polled about as often as its image actually changes. Cameras on the visible page are fetched first.
+        :param on_thumbnail: Called from a worker with (key, JPEG bytes) for a new image, returns True if the image
+         actually changed (some cameras resend the same image without caching headers)
+        :param on_unchanged: Called from a worker with (key) when the server says the image hasn't changed
+        :param on_error: Called from a worker with (key, exception) when a fetch fails
+        :param workers: How many fetches can be in flight at once
+        :param timeout: The connect and read timeout for each fetch in seconds
+        :param min_interval: The shortest time between polls of a camera
+        :param visible_interval: The longest time between polls of a camera on the visible page
+        :param max_interval: The longest time between polls of a visible camera that hasn't changed in a while
+        :param hidden_interval: How often cameras on other pages are polled, to have them ready when the page changes
+        """
+        self.on_thumbnail = on_thumbnail
+        self.on_unchanged = on_unchanged
+        self.on_error = on_error
+        self.workers = workers
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.visible_interval = visible_interval
+        self.max_interval = max_interval
+        self.hidden_interval = hidden_interval
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.cameras = {}
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+        self.fetches = 0
+        self.errors = 0
+
+    def add_camera(self, key, url, name):
+        """
+        Start polling a camera, it is fetched right away
+        :param key: Identifies the camera, e.g. (page, camera id)
+        :param url: The thumbnail URL
+        :param name: A readable name for the camera
+        :return: None
+        """
+        with self.condition:
+            if key not in self.cameras:
+                self.cameras[key] = CameraSchedule(key, url, name)
+                self.condition.notify()
+
+    def start(self):
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+        self.threads = [threading.Thread(target=self._worker, daemon=True, name=f"ThumbnailService-{index}")
+                        for index in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+    def set_visible(self, keys):
+        """
+        Set which cameras are on screen, they are fetched before any other camera and polled more often
+        :param keys: The keys of the cameras on screen
+        :return: None
+        """
+        keys = set(keys)
+        with self.condition:
+            for camera in self.cameras.values():
+                visible = camera.key in keys
+                if visible and not camera.visible and camera.next_poll is not None:
+                    camera.next_poll = min(camera.next_poll, time.time())  # Coming into view, refresh it now
+                camera.visible = visible
+            self.condition.notify_all()
+
+    def poll_soon(self, key=None):
+        """
+        Move a camera, or every visible camera, to the front of the schedule
+        :param key: The camera to poll, None for every visible camera
+        :return: None
+        """
+        with self.condition:
+            for camera in self.cameras.values():
+                if (camera.key == key or key is None and camera.visible) and camera.next_poll is not None:
+                    camera.next_poll = min(camera.next_poll, time.time())
+            self.condition.notify_all()
+
+    def _interval(self, camera, now):
+        if not camera.visible:
+            return self.hidden_interval
+        usual = camera.change_period or self.visible_interval
+        if camera.last_changed is not None and now - camera.last_changed > 2 * usual:
+            # It has gone quiet for longer than usual, back off up to max_interval
+            return min(self.max_interval, max(self.visible_interval, camera.interval * 1.5))
+        return min(self.visible_interval, max(self.min_interval, usual))
+
+    def _take(self):
+        """
+        Wait for the next camera that is due, visible cameras first
+        :return: The camera, or None when the service is stopping
+        """
+        with self.condition:
+            while self.running:
+                now = time.time()
+                scheduled = [camera for camera in self.cameras.values() if camera.next_poll is not None]
+                due = [camera for camera in scheduled if camera.next_poll <= now]
+                if due:
+                    camera = min(due, key=lambda c: (not c.visible, c.next_poll))
+                    camera.next_poll = None  # In flight, so it can't be fetched twice
+                    return camera
+                self.condition.wait(min(camera.next_poll for camera in scheduled) - now if scheduled else None)
+        return None
+
+    def _fetch(self, camera):
+        """
+        Fetch a camera's thumbnail
+        :return: True if the image changed
+        """
+        headers = {}
+        if camera.etag:
+            headers["If-None-Match"] = camera.etag
+        if camera.last_modified:
+            headers["If-Modified-Since"] = camera.last_modified
+        response = self.session.get(camera.url, headers=headers, timeout=self.timeout)
+        if response.status_code == 304:
+            camera.not_modified += 1
+            if self.on_unchanged is not None:
+                self.on_unchanged(camera.key)
+            return False
+        response.raise_for_status()
+        camera.etag = response.headers.get("ETag")
+        camera.last_modified = response.headers.get("Last-Modified")
+        camera.bytes += len(response.content)
+        return bool(self.on_thumbnail(camera.key, response.content))
+
+    def _worker(self):
+        while True:
+            camera = self._take()
+            if camera is None:
+                return
+            changed = False
+            try:
+                changed = self._fetch(camera)
+            except Exception as e:
+                self.errors += 1
+                log.debug(f"Thumbnail fetch for {camera.name} failed: {e}")
+                if self.on_error is not None:
+                    self.on_error(camera.key, e)
+            now = time.time()
+            with self.condition:
+                self.fetches += 1
+                camera.polls += 1
+                if changed:
+                    if camera.last_changed is not None:
+                        period = now - camera.last_changed
+                        camera.change_period = period if camera.change_period is None else \
+                            camera.change_period * 0.7 + period * 0.3
+                    camera.last_changed = now
+                camera.interval = self._interval(camera, now)
+                camera.next_poll = now + camera.interval
+                self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"fetches": self.fetches, "errors": self.errors,
+                    "cameras": {camera.name: {"visible": camera.visible, "interval": round(camera.interval, 1),
+                                              "change_period": round(camera.change_period, 1)
+                                              if camera.change_period is not None else None,
+                                              "polls": camera.polls, "not_modified": camera.not_modified,
+                                              "bytes": camera.bytes}
+                                for camera in self.cameras.values()}}
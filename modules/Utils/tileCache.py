@@ -0,0 +1,107 @@
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TileEntry:
+
+    def __init__(self, data, fetched_at, expires_at):
+        self.data = data
+        self.fetched_at = fetched_at
+        self.expires_at = expires_at
+
+
+class TileCache:
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=30 * 60):
+        """
+        An in memory map tile cache keyed by (layer, zoom, x, y, time offset, options), least recently used tiles are
+        evicted once the cache grows past max_bytes
+        :param max_bytes: The most tile bytes to hold
+        :param ttl: The default time in seconds a tile stays fresh
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(layer, zoom, x, y, time_offset=0, options=""):
+        return layer, zoom, x, y, time_offset, options
+
+    def get(self, key, allow_stale=False):
+        """
+        Look up a tile
+        :param key: The tile key from TileCache.key
+        :param allow_stale: Return the tile even if its TTL has run out, e.g. to draw something while it is refetched
+        :return: The tile bytes, or None
+        """
+        with self.lock:
+            entry = self.tiles.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry.expires_at < time.time() and not allow_stale:
+                self.expired += 1
+                return None
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            return entry.data
+
+    def is_fresh(self, key):
+        """
+        :param key: The tile key from TileCache.key
+        :return: True if the tile is cached and its TTL hasn't run out, doesn't count as a hit or a miss
+        """
+        with self.lock:
+            entry = self.tiles.get(key)
+            return entry is not None and entry.expires_at >= time.time()
+
+    def put(self, key, data, fetched_at=None, ttl=None):
+        """
+        Add or replace a tile
+        :param key: The tile key from TileCache.key
+        :param data: The tile bytes
+        :param fetched_at: When the tile was downloaded, defaults to now
+        :param ttl: How long the tile stays fresh, defaults to the cache's ttl
+        :return: None
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        entry = TileEntry(data, fetched_at, fetched_at + (self.ttl if ttl is None else ttl))
+        with self.lock:
+            previous = self.tiles.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous.data)
+            self.tiles[key] = entry
+            self.size += len(data)
+            while self.size > self.max_bytes and len(self.tiles) > 1:
+                _, evicted = self.tiles.popitem(last=False)
+                self.size -= len(evicted.data)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.tiles.pop(key, None)
+            if entry is not None:
+                self.size -= len(entry.data)
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def __contains__(self, key):
+        return key in self.tiles
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.expired
+            return {"tiles": len(self.tiles), "bytes": self.size, "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "expired": self.expired, "evictions": self.evictions,
+                    "hit_rate": round(self.hits / lookups, 3) if lookups else None}
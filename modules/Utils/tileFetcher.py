@@ -0,0 +1,158 @@
+import itertools
+import logging
+import queue
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class TileRequest:
+
+    def __init__(self, key, url, priority, group):
+        self.key = key
+        self.url = url
+        self.priority = priority
+        self.group = group
+        self.callbacks = []
+        self.in_flight = False
+
+
+class TileFetcher:
+
+    def __init__(self, workers=4, timeout=10):
+        """
+        Downloads map tiles from a fixed pool of worker threads sharing one keep-alive connection pool
+        Lower priority numbers are fetched first, a tile that is already queued or downloading is only fetched once
+        :param workers: How many tiles can be downloading at once
+        :param timeout: The connect and read timeout for each tile in seconds
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.queue = queue.PriorityQueue()  # (priority, sequence, key), stale entries are skipped when taken
+        self.sequence = itertools.count()
+        self.requests = {}  # key -> TileRequest for every queued or downloading tile
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.threads = []
+        self.requested = 0
+        self.deduplicated = 0
+        self.fetched = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.bytes = 0
+
+    def _start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._worker, daemon=True, name=f"TileFetcher-{len(self.threads)}")
+            self.threads.append(thread)
+            thread.start()
+
+    def fetch(self, key, url, callback, priority=10, group=None):
+        """
+        Queue a tile download
+        :param key: Identifies the tile, requests for a key already queued or downloading are merged
+        :param url: The URL to download
+        :param callback: Called from a worker thread with (key, data, fetched_at) once the tile is downloaded
+        :param priority: Lower is fetched sooner, re-requesting a queued tile with a lower priority moves it up
+        :param group: A tag to cancel the request by, e.g. the screen that needs it
+        :return: True if a new download was queued, False if it was merged into one already queued or downloading
+        """
+        with self.lock:
+            self._start()
+            self.requested += 1
+            request = self.requests.get(key)
+            if request is not None:
+                self.deduplicated += 1
+                request.callbacks.append(callback)
+                if priority < request.priority and not request.in_flight:
+                    request.priority = priority
+                    self.queue.put((priority, next(self.sequence), key))
+                return False
+            request = TileRequest(key, url, priority, group)
+            request.callbacks.append(callback)
+            self.requests[key] = request
+            self.queue.put((priority, next(self.sequence), key))
+            return True
+
+    def cancel(self, group=None):
+        """
+        Drop queued downloads, tiles already downloading are left to finish
+        :param group: Only drop requests with this group, None drops everything
+        :return: How many downloads were dropped
+        """
+        with self.lock:
+            dropped = [key for key, request in self.requests.items()
+                       if not request.in_flight and (group is None or request.group == group)]
+            for key in dropped:
+                del self.requests[key]
+            self.cancelled += len(dropped)
+            if not any(request.in_flight for request in self.requests.values()):
+                self.idle.notify_all()
+        if dropped:
+            log.debug(f"Cancelled {len(dropped)} queued tile downloads")
+        return len(dropped)
+
+    def pending(self):
+        with self.lock:
+            return len(self.requests)
+
+    def wait(self, timeout=None):
+        """
+        Block until every queued tile has been downloaded, failed or been cancelled
+        :param timeout: The longest time to wait in seconds
+        :return: True if nothing is left pending
+        """
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.requests, timeout)
+
+    def _take(self):
+        while True:
+            priority, _, key = self.queue.get()
+            with self.lock:
+                request = self.requests.get(key)
+                # Skip entries for cancelled tiles and the old entry of a tile that was moved up
+                if request is None or request.in_flight or request.priority != priority:
+                    continue
+                request.in_flight = True
+                return request
+
+    def _worker(self):
+        while True:
+            request = self._take()
+            data = None
+            try:
+                response = self.session.get(request.url, timeout=self.timeout)
+                response.raise_for_status()
+                data = response.content
+            except requests.RequestException as e:
+                log.warning(f"Failed to download tile {request.key}: {e}")
+            with self.lock:
+                del self.requests[request.key]
+                if data is None:
+                    self.failed += 1
+                else:
+                    self.fetched += 1
+                    self.bytes += len(data)
+                if not self.requests:
+                    self.idle.notify_all()
+            if data is None:
+                continue
+            fetched_at = time.time()
+            for callback in request.callbacks:
+                try:
+                    callback(request.key, data, fetched_at)
+                except Exception as e:
+                    log.error(f"Tile callback for {request.key} failed: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {"pending": len(self.requests), "requested": self.requested, "deduplicated": self.deduplicated,
+                    "fetched": self.fetched, "failed": self.failed, "cancelled": self.cancelled, "bytes": self.bytes}
@@ -0,0 +1,177 @@
+import contextlib
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class VersionedState(dict):
+
+    def __init__(self, data=None):
+        """
+        A dict that keeps a revision number for every key so clients can ask for only what changed
+        :param data: The initial states
+        """
+        super().__init__(data or {})
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.epoch = self._new_epoch()
+        self.revision = 0
+        self.revisions = {key: 0 for key in self.keys()}
+        self.deleted = {}  # key -> revision it was deleted at
+        self.listeners = []
+        self.batch_depth = 0
+        self.batch_keys = set()
+        self.batch_deleted = set()
+
+    def add_listener(self, callback):
+        """
+        Register a function to be called after every change, it must not block since it runs under the state lock
+        :param callback: Called with a tuple of the changed state names, or None when every state was replaced
+        :return: None
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, keys):
+        self.changed.notify_all()
+        for callback in self.listeners:
+            try:
+                callback(keys)
+            except Exception as e:
+                log.error(f"State change listener {callback} failed: {e}")
+
+    @staticmethod
+    def _new_epoch():
+        return int(time.time() * 1000)
+
+    def touch(self, *keys):
+        """
+        Mark states as changed, needed when a mutable state was modified in place
+        :param keys: The names of the changed states
+        :return: The new revision
+        """
+        with self.lock:
+            if self.batch_depth:
+                self.batch_keys.update(keys)
+                self.batch_deleted.difference_update(keys)
+                return self.revision
+            self.revision += 1
+            for key in keys:
+                self.revisions[key] = self.revision
+                self.deleted.pop(key, None)
+            self._notify(keys)
+            return self.revision
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group changes so they get a single revision and a single notification when the outermost batch exits
+        The values are visible to plain reads as soon as they are set, only the revision and the notification wait.
+        The lock isn't held while the body runs, so changes other threads make meanwhile join the same revision
+        :return: A context manager
+        """
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batch_depth -= 1
+                if not self.batch_depth and (self.batch_keys or self.batch_deleted):
+                    keys, self.batch_keys = self.batch_keys, set()
+                    deleted, self.batch_deleted = self.batch_deleted, set()
+                    self.revision += 1
+                    for key in keys:
+                        self.revisions[key] = self.revision
+                        self.deleted.pop(key, None)
+                    for key in deleted:
+                        self.revisions.pop(key, None)
+                        self.deleted[key] = self.revision
+                    self._notify(tuple(keys | deleted))
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            current = self.get(key, _missing)
+            # Assigning the same container back is how in place edits get published, so that always counts as a change
+            if current == value and not (current is value and isinstance(value, (dict, list))):
+                return
+            super().__setitem__(key, value)
+            self.touch(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+            if self.batch_depth:
+                self.batch_keys.discard(key)
+                self.batch_deleted.add(key)
+                return
+            self.revisions.pop(key, None)
+            self.revision += 1
+            self.deleted[key] = self.revision
+            self._notify((key,))
+
+    def pop(self, key, *default):
+        with self.lock:
+            if key not in self:
+                return super().pop(key, *default)
+            value = self[key]
+            del self[key]
+            return value
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                self[key] = default
+            return self[key]
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            for key, value in dict(*args, **kwargs).items():
+                self[key] = value
+
+    def replace(self, data):
+        """
+        Swap out every state at once (e.g. after loading from disk), clients are forced to do a full resync
+        :param data: The new states
+        :return: None
+        """
+        with self.lock:
+            super().clear()
+            super().update(data)
+            self.epoch = self._new_epoch()
+            self.revision = 0
+            self.revisions = {key: 0 for key in self.keys()}
+            self.deleted = {}
+            self._notify(None)
+
+    def changes_since(self, revision=0, epoch=None):
+        """
+        Get the states that changed after a revision
+        :param revision: The last revision the client has seen
+        :param epoch: The epoch the client's revision belongs to, if it doesn't match every state is sent
+        :return: A dict with the changed states, the deleted state names and the current revision
+        """
+        with self.lock:
+            full = epoch != self.epoch or revision > self.revision
+            if full:
+                data = dict(self)
+                deleted = []
+            else:
+                data = {key: self[key] for key, changed in self.revisions.items() if changed > revision}
+                deleted = [key for key, changed in self.deleted.items() if changed > revision]
+            return {"status": "ok", "epoch": self.epoch, "revision": self.revision, "full": full,
+                    "data": data, "deleted": deleted}
+
+    def wait_for_change(self, revision, epoch, timeout=None):
+        """
+        Block until the state moves past a revision
+        :param revision: The last revision the caller has seen
+        :param epoch: The epoch the caller's revision belongs to
+        :param timeout: The longest time to wait in seconds
+        :return: True if the state changed, False if the wait timed out
+        """
+        with self.lock:
+            return self.changed.wait_for(lambda: self.revision > revision or self.epoch != epoch, timeout)
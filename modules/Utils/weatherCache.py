@@ -0,0 +1,247 @@
+import collections
+import hashlib
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+from pyowm.weatherapi25.one_call import OneCall
+from pyowm.weatherapi25.weather import Weather
+
+log = logging.getLogger(__name__)
+
+
+def _write_atomic(path, data):
+    """
+    Write a file so readers only ever see the old or the new contents
+    :param path: The file to write
+    :param data: The bytes to write
+    :return: None
+    """
+    tmp_file = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+    os.replace(tmp_file, path)
+
+
+def weather_to_dict(weather):
+    """
+    Convert a pyowm Weather to plain JSON types
+    :param weather: The Weather
+    :return: A dict of its constructor arguments
+    """
+    data = weather.to_dict()
+    # to_dict misses some constructor arguments (e.g. extra_status_info), pick them up by name
+    for name in inspect.signature(Weather.__init__).parameters:
+        if name not in data and name != "self" and hasattr(weather, name):
+            data[name] = getattr(weather, name)
+    return data
+
+
+def weather_from_dict(data):
+    """
+    Rebuild a pyowm Weather from weather_to_dict, arguments the installed pyowm doesn't know are dropped and ones
+    the cache doesn't have are None, so a cache written by another pyowm version still loads
+    :param data: The dict from weather_to_dict
+    :return: The Weather
+    """
+    parameters = inspect.signature(Weather.__init__).parameters
+    return Weather(**{name: data.get(name) for name in parameters if name != "self"})
+
+
+def one_call_to_dict(one_call):
+    def weathers(items):
+        return [weather_to_dict(item) for item in items] if items is not None else None
+
+    return {"lat": one_call.lat, "lon": one_call.lon, "timezone": one_call.timezone,
+            "current": weather_to_dict(one_call.current), "forecast_minutely": weathers(one_call.forecast_minutely),
+            "forecast_hourly": weathers(one_call.forecast_hourly), "forecast_daily": weathers(one_call.forecast_daily),
+            "alerts": one_call.alerts}
+
+
+def one_call_from_dict(data):
+    def weathers(items):
+        return [weather_from_dict(item) for item in items] if items is not None else None
+
+    return OneCall(lat=data["lat"], lon=data["lon"], timezone=data["timezone"],
+                   current=weather_from_dict(data["current"]),
+                   forecast_minutely=weathers(data.get("forecast_minutely")),
+                   forecast_hourly=weathers(data.get("forecast_hourly")),
+                   forecast_daily=weathers(data.get("forecast_daily")), alerts=data.get("alerts"))
+
+
+class WeatherCache:
+
+    def __init__(self, directory="Caches/weather"):
+        """
+        Keeps each piece of weather data in its own JSON file, so an update only rewrites what changed
+        :param directory: The directory to keep the files in
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.json")
+
+    def save(self, name, data):
+        """
+        Atomically replace an entry
+        :param name: The entry name
+        :param data: JSON serializable data
+        :return: None
+        """
+        encoded = json.dumps({"saved_at": time.time(), "data": data}).encode()
+        with self.lock:
+            _write_atomic(self._path(name), encoded)
+
+    def load(self, name):
+        """
+        Read an entry
+        :param name: The entry name
+        :return: A tuple of the time it was saved and the data, or None if it is missing or unreadable
+        """
+        try:
+            with open(self._path(name), "rb") as f:
+                entry = json.load(f)
+            return entry["saved_at"], entry["data"]
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"Weather cache entry {name} is unreadable, ignoring it: {e}")
+            return None
+
+
+class TileStore:
+
+    def __init__(self, directory="Caches/radar_tiles", max_age=6 * 3600):
+        """
+        Keeps radar tiles on disk by the hash of their contents, with an index of which tile key maps to which file
+        Identical tiles (e.g. empty ocean) are only stored once
+        :param directory: The directory to keep the tiles and the index in
+        :param max_age: Tiles older than this are dropped when the store is opened
+        """
+        self.directory = directory
+        self.objects = os.path.join(directory, "objects")
+        self.index_file = os.path.join(directory, "index.json")
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.index = {}  # key -> {"digest", "fetched_at", ...}
+        self.references = collections.Counter()  # digest -> how many index entries point at it
+        self.dirty = False
+        os.makedirs(self.objects, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def key(layer, zoom, x, y, time_offset, options):
+        return f"{layer}|{zoom}|{x}|{y}|{time_offset}|{options}"
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], f"{digest}.png")
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            log.warning(f"Radar tile index is unreadable, starting over: {e}")
+            self.index = {}
+        cutoff = time.time() - self.max_age
+        expired = [key for key, entry in self.index.items() if entry["fetched_at"] < cutoff]
+        for key in expired:
+            del self.index[key]
+        self.references = collections.Counter(entry["digest"] for entry in self.index.values())
+        if expired:
+            self.dirty = True
+            self.flush()
+            self.collect_garbage()
+
+    def put(self, key, data, fetched_at=None, **metadata):
+        """
+        Store a tile, the index isn't written until flush
+        The file of the tile it replaces is deleted once no other tile points at it
+        :param key: The tile key from TileStore.key
+        :param data: The PNG bytes
+        :param fetched_at: When the tile was downloaded
+        :param metadata: Anything else to keep with the tile
+        :return: The content hash
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._object_path(digest)
+        # Under the lock, so a file can't be deleted between another put finding it and pointing at it
+        with self.lock:
+            if not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _write_atomic(path, data)
+            replaced = self.index.get(key)
+            self.index[key] = dict(metadata, digest=digest, fetched_at=fetched_at or time.time())
+            self.references[digest] += 1
+            if replaced is not None:
+                self._release(replaced["digest"])
+            self.dirty = True
+        return digest
+
+    def _release(self, digest):
+        self.references[digest] -= 1
+        if self.references[digest] > 0:
+            return
+        del self.references[digest]
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """
+        Read a tile
+        :param key: The tile key from TileStore.key
+        :return: A tuple of the index entry and the PNG bytes, or None if the tile isn't stored
+        """
+        with self.lock:
+            entry = self.index.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(self._object_path(entry["digest"]), "rb") as f:
+                return entry, f.read()
+        except OSError:
+            return None
+
+    def items(self):
+        """
+        :return: A list of (key, index entry) for every stored tile
+        """
+        with self.lock:
+            return list(self.index.items())
+
+    def flush(self):
+        """
+        Write the index if any tile was added since the last flush
+        :return: None
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            encoded = json.dumps(self.index).encode()
+            self.dirty = False
+            _write_atomic(self.index_file, encoded)
+
+    def collect_garbage(self):
+        """
+        Delete tile files no index entry points at
+        :return: How many files were deleted
+        """
+        with self.lock:
+            referenced = {entry["digest"] for entry in self.index.values()}
+        removed = 0
+        for prefix in os.listdir(self.objects):
+            folder = os.path.join(self.objects, prefix)
+            for name in os.listdir(folder):
+                if name.endswith(".png") and name[:-4] not in referenced:
+                    os.remove(os.path.join(folder, name))
+                    removed += 1
+        return removed
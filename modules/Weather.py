@@ -14,6 +14,8 @@ from Radar import Radar
 from Utils import buttonGenerator
 from Utils import dataLogger
 from Utils import coprocessors
+from Utils import dirtyRegions
+from Utils import frameScheduler
 from WebcamStream import CampusCams as WebcamStream
 from AlexaIntegration import AlexaIntegration
 from CurrentWeather import CurrentWeather
@@ -63,10 +65,14 @@ log.info("Initializing application, and all modules")
 
 arguments = sys.argv
 headless = False
+show_regions = False
 if len(arguments) > 1:
     if arguments[1] == 'headless':
         log.info("Running in headless mode")
         headless = True
+    if 'show_regions' in arguments[1:]:
+        log.info("Showing repainted screen regions")
+        show_regions = True
 
 screen = None
 pygame.init()
@@ -149,6 +155,8 @@ if not headless:
     net_status: pygame.Surface = None
     blue_status: pygame.Surface = None
     pygame.display.set_icon(icon)
+    regions = dirtyRegions.DirtyRegions(screen.get_size())
+    regions.show_regions = show_regions
 log.getLogger().addHandler(log.StreamHandler(sys.stdout))
 log.captureWarnings(True)
 
@@ -176,6 +184,7 @@ was_focused = True
 low_refresh = time.time()
 weather_alert_number = 0
 display_mode = "init"
+drawn_mode = None
 alerts = []
 active_alerts = []
 
@@ -203,6 +212,7 @@ last_forecast_update = 0
 last_current_update = 0
 failed_current_updates = 0
 fps = 0
+wake_rate = None
 
 # This is where all the support modules are loaded
 weatherAPI = OpenWeatherWrapper(log)
@@ -288,6 +298,7 @@ sys.excepthook = uncaught
 def resize(screen):
     global alert_collider, radar_collider, occupancy_collider
     # This function is called when the screen is resized.
+    regions.resize(screen.get_size())
     room_button_render.move(120, screen.get_height() - 35)
     forecast_button_render.move(120, screen.get_height() - 35)
     webcam_button_render.move(10, screen.get_height() - 35)
@@ -457,7 +468,7 @@ def process_click(mouse_pos):
 
 
 # noinspection PyGlobalUndefined
-def update(dt, screen):
+def update(dt, screen, events):
     global display_mode, selected_loading_hour, loading_hour, refresh_forecast, forecast, weather_alert_display
     global weather_alert_number, slot_position, focused_forecast, fps, low_refresh, screen_dimmed
     global room_button, room_button_text, webcam_button, webcam_button_text, home_button, home_button_text, forecast_button
@@ -468,8 +479,9 @@ def update(dt, screen):
         log.info("Shutting off big wind due to rain")
         room_control.run_routine("f", "big-wind-off")
         room_control.raincheck = True
-        coordinator.coordinator.set_object_state("big_wind_state", -1)
-        coordinator.coordinator.set_object_state("fan_auto_enable", False)
+        with coordinator.coordinator.batch():
+            coordinator.coordinator.set_object_state("big_wind_state", -1)
+            coordinator.coordinator.set_object_state("fan_auto_enable", False)
 
     if py:
         try:
@@ -483,27 +495,28 @@ def update(dt, screen):
 
         sunset_time = weatherAPI.current_weather.sunset_time(timeformat='date')
         sunrise_time = weatherAPI.current_weather.sunrise_time(timeformat='date')
+        room_state = coordinator.coordinator.snapshot()
 
-        if not coordinator.coordinator.get_object_state("room_occupancy_info", False)['room_occupied'] and screen_dimmed != 14:
+        if not room_state.get("room_occupancy_info")['room_occupied'] and screen_dimmed != 14:
             os.system(f"sudo sh -c 'echo \"14\" > /sys/class/backlight/rpi_backlight/brightness'")
             coprocessor.lcd_backlight(0)
             screen_dimmed = 14
 
         elif datetime.datetime.now(tz=datetime.timezone.utc) > sunset_time or datetime.datetime.now(tz=datetime.timezone.utc) < sunrise_time:
             # print("After sunset")
-            if coordinator.coordinator.get_object_state("room_occupancy_info", False)['room_occupied']:
-                if py and coordinator.coordinator.get_object_state("room_lights_state", False)['b'] <= 1 and screen_dimmed != 30:
+            if room_state.get("room_occupancy_info")['room_occupied']:
+                if py and room_state.get("room_lights_state")['b'] <= 1 and screen_dimmed != 30:
                     os.system(f"sudo sh -c 'echo \"30\" > /sys/class/backlight/rpi_backlight/brightness'")
                     coprocessor.lcd_backlight(0)
                     screen_dimmed = 30
-                elif py and coordinator.coordinator.get_object_state("room_lights_state", False)['b'] > 1 and screen_dimmed != 124:
+                elif py and room_state.get("room_lights_state")['b'] > 1 and screen_dimmed != 124:
                     os.system(f"sudo sh -c 'echo \"124\" > /sys/class/backlight/rpi_backlight/brightness'")
                     coprocessor.lcd_backlight(1)
                     screen_dimmed = 124
 
         elif datetime.datetime.now(tz=datetime.timezone.utc) > sunrise_time:
             # print("After sunrise")
-            if coordinator.coordinator.get_object_state("room_occupancy_info", False)['room_occupied']:
+            if room_state.get("room_occupancy_info")['room_occupied']:
                 if py and screen_dimmed != 255:
                     coprocessor.lcd_backlight(1)
                     os.system(f"sudo sh -c 'echo \"255\" > /sys/class/backlight/rpi_backlight/brightness'")
@@ -539,7 +552,7 @@ def update(dt, screen):
                 process_click(pygame.mouse.get_pos())  # If it is not, then process the click.
                 pygame.mouse.set_pos((0, 0))  # And set the mouse back to its parking position.
 
-        for event in pygame.event.get():
+        for event in events:
             # This is the event handler.
             if event.type == QUIT:
                 # If the user tries to close the window, close the window.
@@ -555,6 +568,9 @@ def update(dt, screen):
                 if event.key == pygame.K_ESCAPE:
                     # If escape is pressed, quit the program.
                     graceful_exit()
+                if event.key == pygame.K_F3:
+                    # Outline the regions that get repainted each frame
+                    regions.toggle_overlay()
                 if display_mode == 'webcams':
                     if event.key == pygame.K_l:
                         if webcams.multi_cast:
@@ -603,11 +619,9 @@ def update_weather_data():
         if tablet:
             coordinator.coordinator.set_object_state("tablet_last_update", time.time())
             if not psutil.sensors_battery().power_plugged:
-                threading.Thread(target=coordinator.coordinator.set_object_state, args=("tablet_battery_state", f"{psutil.sensors_battery()[0]}%"),
-                                 daemon=True).start()
+                coordinator.coordinator.set_object_state("tablet_battery_state", f"{psutil.sensors_battery()[0]}%")
             else:
-                threading.Thread(target=coordinator.coordinator.set_object_state,
-                                 args=("tablet_battery_state", f"Charging - {psutil.sensors_battery()[0]}%"), daemon=True).start()
+                coordinator.coordinator.set_object_state("tablet_battery_state", f"Charging - {psutil.sensors_battery()[0]}%")
         if weatherAPI.update_current_weather():
             radar.update_radar()
             failed_current_updates = 0
@@ -660,10 +674,10 @@ def draw_forecast(screen):
         for hour in forecast[::-1]:
             if hour.focused:
                 focused_forecast = hour
-            hour.draw(screen)
+            regions.mark(("forecast", hour.serial), hour.draw(screen), hour.focused)
     else:
         if focused_forecast.focused:
-            focused_forecast.draw(screen)
+            regions.mark(("forecast", focused_forecast.serial), focused_forecast.draw(screen), True)
         else:
             focused_forecast = None
             forecast = []
@@ -676,12 +690,20 @@ def draw(screen, dt):
     """
     global refresh_forecast, last_current_update, current_icon, forecast, loading_hour, fps, selected_loading_hour
     global failed_current_updates, screen_dimmed, display_mode, weather_alert_display, overheat_halt, loading_screen
-    global radar, net_status, alerts, active_alerts
+    global radar, net_status, alerts, active_alerts, drawn_mode
     screen.fill((0, 0, 0))  # Fill the screen with black.
+    if drawn_mode != display_mode:
+        # Switching screens repaints everything
+        regions.invalidate_all()
+        if drawn_mode == "radar":
+            # Tiles nobody is looking at can wait until the radar is opened again
+            weatherAPI.cancel_radar_tiles()
+        drawn_mode = display_mode
 
     def draw_clock(pallet):
-        clock = clock_font.render(datetime.datetime.now().strftime("%I:%M:%S%p"), True, pallet)
-        screen.blit(clock, clock.get_rect(topright=(screen.get_width() - 6, 40)))
+        clock_text = datetime.datetime.now().strftime("%I:%M:%S%p")
+        clock = clock_font.render(clock_text, True, pallet)
+        regions.blit(screen, "clock", clock, clock.get_rect(topright=(screen.get_width() - 6, 40)), token=(clock_text, pallet))
 
     total = psutil.virtual_memory()[0]
     avail = psutil.virtual_memory()[1]
@@ -696,6 +718,7 @@ def draw(screen, dt):
 
     if display_mode == "init":
         # This the loading screen method
+        regions.invalidate_all()
         loading_screen.draw_progress(screen, (100, 300), 600)
         occupancy_icon = unoccupied_green
         coprocessor.display_splash(line1="Dorminator", line2="Ver: 1.0")
@@ -740,7 +763,7 @@ def draw(screen, dt):
     elif display_mode == "home":
         # This is where the home screen is drawn
         pygame.display.set_caption("Weather")
-        current_weather.draw_current(screen, (0, 0))
+        regions.mark("current_weather", current_weather.draw_current(screen, (0, 0)), current_weather.revision)
         draw_forecast(screen)
         build_forecast(screen, (-80, 125))
         # coprocessor.display_loading_bar("Test loading bar", time.time() % 100)
@@ -750,12 +773,12 @@ def draw(screen, dt):
         # radar_image = pygame.image.load(io.BytesIO(radar[0]))
         # screen.blit(radar_image, (200, 200))
 
-        webcam_button_render.blit(screen)
-        webcams.draw_buttons(screen)
-        room_button_render.blit(screen)
+        regions.mark("webcam_button", webcam_button_render.blit(screen))
+        regions.mark("cycle_buttons", webcams.draw_buttons(screen))
+        regions.mark("room_button", room_button_render.blit(screen))
         # screen.blit(room_button_render, room_button_render.get_rect(midbottom=room_button.center))
     elif display_mode == "webcams":
-
+        regions.invalidate_all()
         pygame.display.set_caption(("Streaming " if webcams.multi_cast else "Viewing ") +
                                    f"Campus Webcams-Page: {webcams.page + 1}/{len(webcams.cameras)}")
         webcams.draw(screen)
@@ -766,6 +789,7 @@ def draw(screen, dt):
         # fps = webcams.requested_fps
     elif display_mode == "room_control":
         # This is where the room control screen is drawn
+        regions.invalidate_all()
         room_control.draw_routine(screen, -10)
         pygame.display.set_caption("Room Control")
         # pygame.draw.rect(screen, [255, 206, 0], home_button)
@@ -776,42 +800,46 @@ def draw(screen, dt):
     elif display_mode == "weather_alert":
         # This is where the weather alert screen is drawn
         draw_clock(pallet_one)
-        weather_alert_display.draw(screen, (10, 100))
-        current_weather.draw_current(screen, (0, 0))
+        regions.mark("weather_alert", weather_alert_display.draw(screen, (10, 100)),
+                     (weather_alert_display.number, weather_alert_display.scroll, len(weather_alert_display.description_lines)))
+        regions.mark("current_weather", current_weather.draw_current(screen, (0, 0)), current_weather.revision)
         # pygame.draw.rect(screen, [255, 206, 0], home_button)
-        webcams.draw_buttons(screen)
+        regions.mark("cycle_buttons", webcams.draw_buttons(screen))
         pygame.display.set_caption("Weather Alert")
     elif display_mode == "occupancy_info":
         draw_clock(pallet_one)
-        occupancy_info_display.draw(screen, (10, 100))
-        current_weather.draw_current(screen, (0, 0))
+        regions.mark("occupancy_info", occupancy_info_display.draw(screen, (10, 100)),
+                     (occupancy_info_display.last_update, occupancy_info_display.maximize_state))
+        regions.mark("current_weather", current_weather.draw_current(screen, (0, 0)), current_weather.revision)
         # pygame.draw.rect(screen, [255, 206, 0], home_button)
-        webcams.draw_buttons(screen)
+        regions.mark("cycle_buttons", webcams.draw_buttons(screen))
         pygame.display.set_caption("Occupancy Info")
     elif display_mode == "radar":
         # This is where the radar screen is drawn
+        regions.invalidate_all()
         radar.draw(screen)
         home_button_render.blit(screen)
         webcams.draw_buttons(screen)
         pygame.display.set_caption("Radar")
         forecast_button_render.blit(screen)
 
+    room_state = coordinator.coordinator.snapshot()  # Read the whole frame from one consistent copy of the state
     if display_mode != "init":
         try:
-            temperature = round(float(coordinator.coordinator.get_object_state('temperature', False)) * (9 / 5) + 32)
-            set_point = round(float(coordinator.coordinator.get_object_state('temp_set_point', False)))
-            humidity = round(coordinator.coordinator.get_object_state('humidity', False))
-            humidity_set_point = round(coordinator.coordinator.get_object_state('humid_set_point', False))
+            temperature = round(float(room_state.get('temperature')) * (9 / 5) + 32)
+            set_point = round(float(room_state.get('temp_set_point')))
+            humidity = round(room_state.get('humidity'))
+            humidity_set_point = round(room_state.get('humid_set_point'))
         except TypeError:
             temperature, set_point, humidity, humidity_set_point = (0, 0, 0, 0)
-        auto_mode = coordinator.coordinator.get_object_state('fan_auto_enable', False)
+        auto_mode = room_state.get('fan_auto_enable')
         if not auto_mode and humidity_set_point == 0:
             current_set = "OFF"
         else:
             current_set = f"{str(set_point).zfill(2)}F" if auto_mode else f"{str(humidity_set_point).zfill(2)}%"
         try:
             radiator = float(dataLogger.strip(
-                coordinator.coordinator.get_object_state('room_sensor_data_displayable', False)['radiator_temperature'])[0])
+                room_state.get('room_sensor_data_displayable')['radiator_temperature'])[0])
             radiator = f"{str(round(radiator))}F"
         except ValueError:
             radiator = "EROR"
@@ -825,12 +853,12 @@ def draw(screen, dt):
 
     if py:
         temp = round(psutil.sensors_temperatures()['cpu_thermal'][0].current, 2)
-    sys_info = sys_info_font.render(
-        f"CPU:{str(round(cpu_average, 2)).zfill(5)}%, Mem:{str(round(mem, 2)).zfill(5)}%"
-        + (f", Temp:{temp}°C" if py else "")
-        + f", {dt}FPS" + (f", Battery:{psutil.sensors_battery()[0]}%" if psutil.sensors_battery() else ""), True,
-        pallet_one, pallet_four)
-    screen.blit(sys_info, (sys_info.get_rect(midtop=(screen.get_width() / 2, screen.get_height() - 30))))
+    sys_info_text = f"CPU:{str(round(cpu_average, 2)).zfill(5)}%, Mem:{str(round(mem, 2)).zfill(5)}%" \
+                    + (f", Temp:{temp}°C" if py else "") \
+                    + (f", {wake_rate}Wakes/min" if wake_rate is not None else f", {dt}FPS") + (f", Battery:{psutil.sensors_battery()[0]}%" if psutil.sensors_battery() else "")
+    sys_info = sys_info_font.render(sys_info_text, True, pallet_one, pallet_four)
+    regions.blit(screen, "sys_info", sys_info, sys_info.get_rect(midtop=(screen.get_width() / 2, screen.get_height() - 30)),
+                 token=sys_info_text)
 
     if not coordinator.coordinator.net_client.coordinator_available:
         net_status = net_error_icon
@@ -842,7 +870,7 @@ def draw(screen, dt):
         net_status = up_only_icon
     else:
         net_status = net_normal_icon
-    occupancy_info = coordinator.coordinator.get_object_state('room_occupancy_info', False)
+    occupancy_info = room_state.get('room_occupancy_info')
 
     if display_mode != 'init':
         if occupancy_info['room_occupied'] is None or not coordinator.coordinator.net_client.coordinator_available:
@@ -867,25 +895,25 @@ def draw(screen, dt):
         coordinator.coordinator.net_client.download_in_progress = False
 
     if display_mode != "webcams" and display_mode != "radar":
-        screen.blit(net_status, net_status.get_rect(topright=(screen.get_width() - 5, 2)))
+        regions.blit(screen, "net_status", net_status, net_status.get_rect(topright=(screen.get_width() - 5, 2)))
         if display_mode != "room_control":
-            screen.blit(occupancy_icon, occupancy_icon.get_rect(topright=(screen.get_width() - 35, 2)))
+            regions.blit(screen, "occupancy_icon", occupancy_icon, occupancy_icon.get_rect(topright=(screen.get_width() - 35, 2)))
         else:
-            screen.blit(occupancy_icon, occupancy_icon.get_rect(topleft=(5, 2)))
+            regions.blit(screen, "occupancy_icon", occupancy_icon, occupancy_icon.get_rect(topleft=(5, 2)))
     if display_mode == "home":
         if active_alerts:
-            screen.blit(weather_alert, weather_alert.get_rect(topleft=(25, 65)))
+            regions.blit(screen, "alert_icon", weather_alert, weather_alert.get_rect(topleft=(25, 65)))
         elif alerts:
             # If a weather alert is active, draw the alert icon
-            screen.blit(weather_warning, weather_alert.get_rect(topleft=(25, 65)))
+            regions.blit(screen, "alert_icon", weather_warning, weather_alert.get_rect(topleft=(25, 65)))
         else:
-            screen.blit(weather_clear, weather_alert.get_rect(topleft=(25, 65)))
+            regions.blit(screen, "alert_icon", weather_clear, weather_alert.get_rect(topleft=(25, 65)))
         if room_control.raincheck:
             # If a raincheck is active, draw the raincheck icon
-            screen.blit(no_fan_icon, no_fan_icon.get_rect(topright=(723 - 40, 2)))
+            regions.blit(screen, "raincheck_icon", no_fan_icon, no_fan_icon.get_rect(topright=(723 - 40, 2)))
         if (py and temp > 70) or overheat_halt:
             # If the CPU is too hot, draw the overheat icon
-            screen.blit(overheat_icon, overheat_icon.get_rect(topright=(763, 2)))
+            regions.blit(screen, "overheat_icon", overheat_icon, overheat_icon.get_rect(topright=(763, 2)))
             overheat_halt = True
             fps = 7
             if temp < 60:
@@ -895,12 +923,12 @@ def draw(screen, dt):
                 # webcams.focus(None)
                 fps = 0.5
 
-    # Flip the display so that the things we drew actually show up.
-    pygame.display.flip()
+    # Push only the parts of the display that changed so that the things we drew actually show up.
+    regions.present(screen)
 
 
 def run():
-    global base_fps, fps, no_mouse, was_focused
+    global base_fps, fps, no_mouse, was_focused, wake_rate
     # Initialise PyGame.
 
     # weatherAPI.update_weather_map()
@@ -913,13 +941,46 @@ def run():
     log.info(f"Starting piWeather, Platform: {platform.platform()}; OnTablet:{tablet}, OnPi:{py}")
     log.info(f"Extended images supported: {pygame.image.get_extended()}")
 
+    # Work the idle loop has to wake up for, anything else only happens when input arrives.
+    scheduler = frameScheduler.FrameScheduler()
+    scheduler.add_job("clock", 1, aligned=True)
+    scheduler.add_job("weather", 30)
+    scheduler.add_job("coordinator", 1 if py else 10)
+    scheduler.add_job("alert_scroll", 5, enabled=False)
+    scheduler.add_job("radar_playback", 1, enabled=False)
+
     # Main game loop.
     fps = base_fps
     dt = 1 / fps  # dt is the time since last frame.
     if not headless:
         resize(screen)
     while True:  # Loop forever!
-        update(dt, screen)  # You can update/draw here, I've just moved the code for neatness.
+        idle = fps <= 1 and not headless and display_mode != "init"
+        if idle:
+            # Nothing is animating, so sleep until a job is due or input arrives instead of rendering every second
+            if display_mode in ("home", "occupancy_info"):
+                # Only these modes update the weather, in the others the job keeps its own schedule
+                scheduler.set_due("weather", last_current_update + 30)
+            scheduler.set_enabled("clock", display_mode in ("home", "weather_alert", "occupancy_info") and pygame.display.get_active())
+            scheduler.set_enabled("alert_scroll", display_mode == "weather_alert" and weather_alert_display is not None)
+            if display_mode == "weather_alert" and weather_alert_display is not None:
+                scheduler.set_due("alert_scroll", weather_alert_display.scroll_time + 5)
+            scheduler.set_enabled("radar_playback", display_mode == "radar" and radar.playing)
+            event = pygame.event.wait(max(1, int(scheduler.time_until_next() * 1000)))
+            events = [] if event.type == pygame.NOEVENT else [event]
+            events += pygame.event.get()
+            due = scheduler.due_jobs()
+            if not events and not due:
+                continue
+            scheduler.record_wakeup(due[0] if due else "input")
+            wake_rate = scheduler.wakeups_per_minute()
+        else:
+            events = pygame.event.get() if not headless else []
+            scheduler.record_wakeup("frame")
+            wake_rate = None
+        scheduler.report()
+
+        update(dt, screen, events)  # You can update/draw here, I've just moved the code for neatness.
         if pygame.display.get_active() and not headless:
             draw(screen, dt)
             was_focused = True
@@ -927,12 +988,14 @@ def run():
             was_focused = False
         elif pygame.display.get_active() and not was_focused and tablet:
             make_screen()
+            regions.invalidate_all()
             update_weather_data()
         elif pygame.display.get_active() and not was_focused and not tablet:
             update_weather_data()
 
-        fps_clock.tick(fps)
-        dt = round(fps_clock.get_fps())
+        if not idle:
+            fps_clock.tick(fps)
+            dt = round(fps_clock.get_fps())
 
 
 run()
@@ -92,13 +92,13 @@ class WeatherAlert:
         Draw the alert to the screen
         :param screen: The screen to draw to
         :param location: The X,Y location to draw to
-        :return: False if not initialized, None if initialized
+        :return: False if not initialized, the screen area that was drawn if initialized
         """
         x, y = location
         if not self.initialized:
             return False
-        screen.blit(self.event_text, (x, y+10))
-        screen.blit(self.sender_text, (x, y + 45))
+        area = screen.blit(self.event_text, (x, y+10))
+        area.union_ip(screen.blit(self.sender_text, (x, y + 45)))
         # screen.blit(self.time_range_text, (x, y + 49))
         count = 0  # 17
         for value in range(self.scroll, self.scroll + 16):
@@ -108,7 +108,7 @@ class WeatherAlert:
                 line = self.description_lines[value]
             else:
                 break
-            screen.blit(line, (x, y + 72 + (17 * count)))
+            area.union_ip(screen.blit(line, (x, y + 72 + (17 * count))))
             count += 1
 
             if len(self.description_lines) > 17 and time.time() > self.scroll_time + 5:
@@ -116,3 +116,4 @@ class WeatherAlert:
                 self.scroll_time = time.time()
                 if self.scroll > len(self.description_lines) - 5:
                     self.scroll = 0
+        return area
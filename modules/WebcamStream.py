@@ -1,20 +1,19 @@
 import concurrent
 import datetime
-import http.client
 import json
 import logging
 import math
 import os
-import socket
 import threading
-import urllib.error
 
-import numpy
 import pygame
 import time
-import io
-from PIL import Image
-from urllib.request import urlopen
+
+import requests
+
+from Utils.staleTracker import StaleTracker
+from Utils.thumbnailDecoder import decode_thumbnail
+from Utils.thumbnailService import ThumbnailService
 
 camera_path = "Configs/Cameras.json"
 pallet_one = (255, 206, 0)
@@ -60,13 +59,12 @@ class CampusCams:
         self.linux = linux
         self.name_buffer = []
         self.time_buffer = []
-        self.updated_buffer = []
+        self.staleness = StaleTracker(stale_after=65)
         self.stream_buffer = [None, None, None, None]
         self.clear_buffers()
         for x in range(len(self.cameras)):
             self.name_buffer.append([self.text("None"), self.text("None"), self.text("None"), self.text("None")])
             self.time_buffer.append([self.text("None"), self.text("None"), self.text("None"), self.text("None")])
-            self.updated_buffer.append([time.time(), time.time(), time.time(), time.time()])
         self.page = 0
         self.current_focus = None
         self.last_update = 0
@@ -85,7 +83,12 @@ class CampusCams:
         self.high_performance_enabled = live_mode_enable
         self.requested_fps = 30
         self.stream_cooldown_timer = 0
-        self.active_requests = []
+        self.thumbnail_bytes = {}  # (page, cam id) -> the last JPEG fetched, to rescale from without refetching
+        self.thumbnails = ThumbnailService(self._thumbnail_loaded, self._thumbnail_unchanged, self._thumbnail_failed)
+        for page_num, page in enumerate(self.cameras):
+            for camera in page:
+                self.thumbnails.add_camera((page_num, camera[0]), camera[1], camera[3])
+        self.thumbnails.set_visible((self.page, camera[0]) for camera in self.cameras[self.page])
         self.stream_info_text = self.text("Info: N/A")
         self.screen = None
         self.multi_cast = multi_stream
@@ -105,6 +108,7 @@ class CampusCams:
             self.page = len(self.cameras) - 1
         self.focus(None)
         self.last_update = time.time() - self.update_rate + 1
+        self.thumbnails.set_visible((self.page, camera[0]) for camera in self.cameras[self.page])
         # self.buffers[self.page] = [self.husky, self.husky, self.husky, self.husky]
         self.overlay_buffers[self.page] = [self.no_image, self.no_image, self.no_image, self.no_image]
         self.close_multicast()
@@ -129,6 +133,9 @@ class CampusCams:
             self.log.info("Closed Stream/Focus")
         self.requested_fps = 30
         self.current_focus = cam_id
+        if self.screen is not None:
+            # Thumbnails fetched while a camera was focused weren't drawn, redraw the page from the last images
+            threading.Thread(target=self._rescale, args=([(self.page, camera[0]) for camera in self.cameras[self.page]],)).start()
         self.last_update = time.time() - self.update_rate + 1
         if cam_id is not None and time.time() > self.stream_cooldown_timer + 10:
             self.close_multicast()
@@ -230,76 +237,97 @@ class CampusCams:
             # self.multi_cast_threads.append(thread)
             self.stream = stream
 
-    def load_thumb(self, ob, camera, select_buffer=None):
+    def _thumbnail_loaded(self, key, image_str):
         """
-        This loads the thumbnail images from the webcams
-        :param ob: T
-        :param camera: The camera to load the image for
-        :param select_buffer: An optional indicator to select the buffer to load the image into
-        :return: None
+        Called by the thumbnail service when a camera has a new image
+        :param key: The (page, cam id) of the camera
+        :param image_str: The JPEG bytes
+        :return: True if the image changed
         """
-        cam_id, url, stream_url, name = camera
-        if select_buffer is not None:
-            page = select_buffer
-        else:
-            page = self.page
+        page, cam_id = key
+        if not self.staleness.observe(key, image_str):
+            # The camera sent the same image again, so skip decoding and scaling it
+            self._thumbnail_unchanged(key)
+            return False
+        self.thumbnail_bytes[key] = image_str
+        self.load_thumb(self.cameras[page][cam_id], image_str, page)
+        return True
 
-        try:
-            self.name_buffer[page][cam_id] = self.text(name).convert()  # Set the cameras name buffer to the name of the camera
-            image_str = urlopen(url, timeout=10).read()  # Load jpg image from source
-            try:
-                image_file = io.BytesIO(image_str)  # Load byte string into a bytesIO file
-                raw_frame = pygame.image.load(image_file, "JPG")  # Load into pygame
-            except pygame.error:
-                self.log.warning(f"JPG image failed to load for cam {name} converting to PNG")
-                image_file = io.BytesIO(image_str)  # Load byte string into a bytesIO file
-                image = Image.open(image_file)  # Open in Pillow
-                with io.BytesIO() as f:  # This is a really jank way around pygame 32bit not being able to read jpgs
-                    image.save(f, format='PNG')  # Save Pillow file to type PNG
-                    f.seek(0)  # Move seek head
-                    im = f.getvalue()  # Get file bytes
-                    image = io.BytesIO(im)  # load new file into image bytes file
-                self.log.info(f"Converted JPG to PNG for cam {name}")
-                raw_frame = pygame.image.load(image)  # Load into pygame
-
-            if self.current_focus is None:  # If there is no current focus, then resize the image to fit 2x2 grid
-                temp: pygame.Surface = self.buffers[page][cam_id]
-                self.buffers[page][cam_id]: pygame.Surface = \
-                    pygame.transform.scale(raw_frame, (int((self.screen.get_width() / 2)), int((self.screen.get_height() - 35) / 2))).convert()
-                try:
-                    # Here we check if the new frame is the same as the old frame. If it is, then we keep track of how long its been stale
-                    if not numpy.array_equal(pygame.surfarray.pixels2d(temp), pygame.surfarray.pixels2d(self.buffers[page][cam_id].copy())):
-                        self.updated_buffer[page][cam_id] = time.time()
-                        # print(f"New frame {page}-{cam_id}")
-                except Exception as e:  # In the event of an error, log it and continue
-                    self.log.warning(f"Failed to compare old and new frame for cam {name} because ({e})")
+    def _thumbnail_unchanged(self, key):
+        """
+        Called by the thumbnail service when the server says a camera's image hasn't changed
+        :param key: The (page, cam id) of the camera
+        :return: None
+        """
+        page, cam_id = key
+        self.overlay_buffers[page][cam_id] = self.empty_image
+        self.check_stale(page, cam_id, self.cameras[page][cam_id][3])
 
-                self.overlay_buffers[page][cam_id] = self.empty_image  # Set the overlay buffer to the empty image
-                self.log.debug(f"Updated cam {name} ({page}-{cam_id})")
-                if self.updated_buffer[page][cam_id] < time.time() - 65 and (page != 3 and cam_id != 3):
-                    self.name_buffer[page][cam_id] = self.text(f"{name}: Unavailable").convert()
-                    self.log.warning(f"Cam {name}: Unavailable")
-            elif self.current_focus == cam_id:  # If the current focus is the camera, then resize the image to fit the screen
-                self.buffers[page][cam_id] = pygame.transform.scale(raw_frame, (int((self.screen.get_width())),
-                                                                                int((self.screen.get_height() - 35)))).convert()
-                # self.overlay_buffers[page][cam_id] = self.empty_image
-                self.log.debug(f"Cam {page}-{cam_id}: Updated and focused")
-        except http.client.IncompleteRead:  # If image reading was interrupted, then set overlay to error image and log it
+    def _thumbnail_failed(self, key, e):
+        """
+        Called by the thumbnail service when fetching a camera's image failed
+        :param key: The (page, cam id) of the camera
+        :param e: The exception
+        :return: None
+        """
+        page, cam_id = key
+        name = self.cameras[page][cam_id][3]
+        if isinstance(e, requests.Timeout):  # If the image reading timed out, then set the overlay to error image and log it
             self.overlay_buffers[page][cam_id] = self.no_image
-            self.log.warning(f"Cam {name}: Incomplete read")
-        except urllib.error.URLError as e:  # In the event of a url error, check if its a network error
-            if str(e) == "<urlopen error [Errno 11001] getaddrinfo failed>":
+            self.log.warning(f"Cam {name}: Timeout")
+        elif isinstance(e, requests.ConnectionError):  # In the event of a connection error, check if its a network error
+            if "getaddrinfo failed" in str(e) or "Name or service not known" in str(e):
                 self.log.info(f"Cam {name}: No network")
                 return
             self.overlay_buffers[page][cam_id] = self.no_image  # If not, then set write the error to the name buffer, log it, and continue
-            self.log.warning(f"Cam {name}: URLError ({e})")
+            self.log.warning(f"Cam {name}: ConnectionError ({e})")
             self.name_buffer[page][cam_id] = self.text(str(f"{name}: {str(e)[:36]}")).convert()
-        except socket.timeout:  # If the image reading timed out, then set the overlay to error image and log it
+        else:  # If the image reading failed for some other reason, then set the overlay to error image and log it
             self.overlay_buffers[page][cam_id] = self.no_image
-            self.log.warning(f"Cam {name}: Timeout")
-        except Exception as e:  # If the image reading failed for some other reason, then set the overlay to error image and log it
             self.name_buffer[page][cam_id] = self.text(str(f"{name}: {str(e)[:36]}")).convert()
-            print(f"Cam {name} error: {e}")
+            self.log.error(f"Cam {name} error: {e}")
+
+    def check_stale(self, page, cam_id, name):
+        """
+        Marks a camera as unavailable if its image hasn't changed in a while
+        :param page: The page of the camera
+        :param cam_id: The id of the camera on its page
+        :param name: The name of the camera
+        :return: None
+        """
+        if self.staleness.is_stale((page, cam_id)) and (page != 3 and cam_id != 3):
+            self.name_buffer[page][cam_id] = self.text(f"{name}: Unavailable").convert()
+            self.log.warning(f"Cam {name}: Unavailable")
+        else:
+            self.name_buffer[page][cam_id] = self.text(name).convert()
+
+    def load_thumb(self, camera, image_str, page):
+        """
+        This loads a thumbnail image into the camera's buffer
+        :param camera: The camera to load the image for
+        :param image_str: The JPEG bytes of the image
+        :param page: The page of the camera
+        :return: None
+        """
+        cam_id, url, stream_url, name = camera
+        if self.current_focus is None:  # If there is no current focus, then the image fits a 2x2 grid
+            size = (self.screen.get_width() / 2, (self.screen.get_height() - 35) / 2)
+        elif self.current_focus == cam_id and page == self.page:  # If the current focus is the camera, then it fills the screen
+            size = (self.screen.get_width(), self.screen.get_height() - 35)
+        else:  # Not on screen, it is drawn from the stored image when it is
+            return
+        try:
+            self.buffers[page][cam_id] = decode_thumbnail(image_str, size).convert()
+            if self.current_focus is None:
+                self.overlay_buffers[page][cam_id] = self.empty_image  # Set the overlay buffer to the empty image
+                self.log.debug(f"Updated cam {name} ({page}-{cam_id})")
+                self.check_stale(page, cam_id, name)
+            else:
+                self.log.debug(f"Cam {page}-{cam_id}: Updated and focused")
+        except Exception as e:  # If the image failed to decode, then set the overlay to error image and log it
+            self.overlay_buffers[page][cam_id] = self.no_image
+            self.name_buffer[page][cam_id] = self.text(str(f"{name}: {str(e)[:36]}")).convert()
+            self.log.error(f"Cam {name} error: {e}")
 
     def resize(self, screen):
         """
@@ -318,6 +346,7 @@ class CampusCams:
             self.text_font = pygame.font.Font("Assets/Fonts/Jetbrains/JetBrainsMono-Regular.ttf", 13)
         else:
             self.text_font = pygame.font.Font("Assets/Fonts/Jetbrains/JetBrainsMono-Regular.ttf", 11)
+        self.thumbnails.start()  # The thumbnails are scaled to the screen, so they can't load until there is one
         self.update_all()
         if self.stream is not None or self.multi_cast:
             # self.stream = None
@@ -339,47 +368,47 @@ class CampusCams:
         if self.last_update == 0:
             self.last_update = time.time() - self.update_rate
         elif self.last_update < time.time() - self.update_rate:
-            self.log.debug("Queueing camera updates")
+            # The thumbnail service polls the thumbnails by itself, only the multicast streams are started here
             for camera in self.cameras[self.page]:
-                thread = threading.Thread(target=self.load_thumb, args=(self, camera))
-                thread.start()
-                self.active_requests.append(thread)
                 if self.multi_cast and self.stream_buffer[camera[0]] is None and self.current_focus is None:
                     thread = threading.Thread(target=self.create_stream, args=(self, camera))
                     thread.start()
-            self.log.debug("Cameras updates queued")
             self.last_update = time.time()
 
     def update_all(self):
         """
-        Update all thumbnails on all pages
+        Rescale all thumbnails on all pages from the last images fetched, e.g. after the screen is resized
         :return: None
         """
-        self.log.info("Updating all camera thumbnails")
-        page_num = 0
+        self.log.info("Rescaling all camera thumbnails")
         self.name_buffer = []
-        for _ in self.cameras:
-            # This is used to set all camera names to None.
-            self.name_buffer.append([self.text("None"), self.text("None"), self.text("None"), self.text("None")])
         for page in self.cameras:
-            # Iterate through all pages of cameras
-            for camera in page:
-                # Iterate through all cameras on a page and load thumbnails
-                thread = threading.Thread(target=self.load_thumb, args=(self, camera, page_num))
-                thread.start()
-                self.active_requests.append(thread)
-            page_num += 1
+            # Show each camera's name until its thumbnail is loaded
+            self.name_buffer.append([self.text(camera[3]) for camera in page])
+        threading.Thread(target=self._rescale).start()
+
+    def _rescale(self, keys=None):
+        """
+        Redraw thumbnails from the last images fetched, then check the visible cameras for newer ones
+        :param keys: The (page, cam id) of the cameras to redraw, None for every camera
+        :return: None
+        """
+        for key, image_str in list(self.thumbnail_bytes.items()):
+            if keys is None or key in keys:
+                self.load_thumb(self.cameras[key[0]][key[1]], image_str, key[0])
+        self.thumbnails.poll_soon()
 
     def draw_buttons(self, screen):  # Draw the buttons
         """
         Draw the buttons on the screen
         :param screen: The screen to draw the buttons on
-        :return: None
+        :return: The screen area that was drawn
         """
-        pygame.draw.rect(screen, [255, 206, 0], self.cycle_forward)
+        area = pygame.draw.rect(screen, [255, 206, 0], self.cycle_forward)
         screen.blit(self.cycle_forward_render, self.cycle_forward_render.get_rect(center=self.cycle_forward.center))
-        pygame.draw.rect(screen, [255, 206, 0], self.cycle_backward)
+        area.union_ip(pygame.draw.rect(screen, [255, 206, 0], self.cycle_backward))
         screen.blit(self.cycle_backward_render, self.cycle_backward_render.get_rect(center=self.cycle_backward.center))
+        return area
 
     def draw(self, screen):
         """
@@ -388,11 +417,6 @@ class CampusCams:
         :return: None
         """
 
-        for thread in self.active_requests:
-            if not thread.is_alive():
-                thread.join()
-                del thread
-
         center_w = self.screen.get_width() / 2
         height = self.screen.get_height()
 
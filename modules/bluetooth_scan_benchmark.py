@@ -0,0 +1,77 @@
+# Simulate the bluetooth scan engine against a set of fake devices to tune the worker count and intervals
+# Usage: python bluetooth_scan_benchmark.py [devices] [workers] [simulated minutes] [speedup]
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+from Utils.scanEngine import ScanEngine
+
+devices = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+minutes = float(sys.argv[3]) if len(sys.argv) > 3 else 30
+speedup = float(sys.argv[4]) if len(sys.argv) > 4 else 100
+connect_timeout = 8
+
+logging.basicConfig(level=logging.WARNING)
+random.seed(1)
+
+# A third of the devices are home, they come and go every few simulated minutes
+present = {f"00:00:00:00:00:{i:02X}": i % 3 == 0 for i in range(devices)}
+arrivals = {}
+
+
+def probe(address, name):
+    # A phone in range answers within a couple of seconds, one out of range holds the radio until the page timeout
+    duration = random.uniform(0.5, 2.5) if present[address] else connect_timeout
+    time.sleep(duration / speedup)
+    return present[address]
+
+
+def churn(stop_at):
+    while time.time() < stop_at:
+        time.sleep(random.uniform(60, 300) / speedup)
+        address = random.choice(list(present))
+        present[address] = not present[address]
+        if present[address]:
+            arrivals[address] = time.time()
+
+
+def scaled(seconds):
+    return seconds / speedup
+
+
+engine = ScanEngine(probe, workers=workers, present_interval=scaled(30), recent_interval=scaled(10),
+                    recent_window=scaled(600), max_interval=scaled(300), priority_max_interval=scaled(60))
+for index, address in enumerate(present):
+    engine.add_device(address, f"device_{index}", priority=index < 2)
+
+stop_at = time.time() + minutes * 60 / speedup
+threading.Thread(target=churn, args=(stop_at,), daemon=True).start()
+engine.start()
+
+# Time from a device arriving to the engine seeing it, sampled every simulated second
+detection_delays = []
+while time.time() < stop_at:
+    time.sleep(scaled(1))
+    for address, arrived in list(arrivals.items()):
+        device = engine.devices[address]
+        if not present[address]:
+            del arrivals[address]
+        elif device.present and device.last_seen >= arrived:
+            detection_delays.append((device.last_seen - arrived) * speedup)
+            del arrivals[address]
+stats = engine.stats()
+engine.stop()
+
+print(f"{devices} devices, {workers} workers, {minutes} simulated minutes")
+print(f"Radio utilization: {stats['radio_utilization']} ({stats['probes_per_minute'] / speedup:.1f} probes per simulated minute)")
+print(f"Time to first detection (simulated s): max {stats['first_detection_max'] * speedup:.1f}"
+      if stats['first_detection_max'] is not None else "Nothing detected")
+if detection_delays:
+    detection_delays.sort()
+    print(f"Arrival to detection (simulated s): p50 {detection_delays[len(detection_delays) // 2]:.1f} "
+          f"max {detection_delays[-1]:.1f} over {len(detection_delays)} arrivals")
+print(json.dumps({name: info for name, info in list(stats["devices"].items())[:6]}, indent=2))
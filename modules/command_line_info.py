@@ -6,6 +6,8 @@ import os
 import time
 import socket
 
+from Utils.presenceTimeline import PresenceTimeline
+
 
 def c_f(celsius):
     return (float(celsius) * (9 / 5)) + 32
@@ -79,6 +81,7 @@ sys.wk_dir = os.path.dirname(os.path.realpath(__file__))
 
 if len(sys.argv) < 2:
     print("Usage: python3 command_line_info.py <requested_mode> [arguments]")
+    print("Modes: all, history [hours]")
     sys.exit(1)
 
 requested_info = sys.argv[1]
@@ -107,8 +110,15 @@ except Exception as e:
 if requested_info == "all":
     occupancy = room_info['room_occupancy_info']
     room_state = room_info['room_sensor_data_displayable']
-    present = [occupant for occupant in occupancy['occupants'].values() if occupant['present'] is True]
-    absent = [occupant for occupant in occupancy['occupants'].values() if occupant['present'] is False]
+    timeline = occupancy.get('timeline')
+    if timeline:
+        # The debounced presence from the coordinator's presence timeline
+        occupants = [{"name": entry['name'], "present": entry['present'], "updated_at": entry['since']}
+                     for entry in timeline.values()]
+    else:
+        occupants = list(occupancy['occupants'].values())
+    present = [occupant for occupant in occupants if occupant['present'] is True]
+    absent = [occupant for occupant in occupants if occupant['present'] is False]
     # max_present_rjust = max([len(occupant['name']) for occupant in present] if len(present) > 0 else [0])
     # max_absent_rjust = max([len(occupant['name']) for occupant in absent] if len(absent) > 0 else [0])
     print("-" * 10 + "Room Data" + "-" * 10)
@@ -130,3 +140,14 @@ if requested_info == "all":
               f"{datetime.datetime.fromtimestamp(occupant['updated_at']).strftime('%I:%M:%S%p-%m/%d/%y')}")
     print("")
     print("Last updated:", datetime.datetime.fromtimestamp(room_info['last_update']).strftime('%I:%M:%S%p-%m/%d/%y'), end="")
+elif requested_info == "history":
+    hours = float(sys.argv[2]) if len(sys.argv) > 2 else 24
+    timeline = PresenceTimeline()
+    timeline.load(room_info['room_occupancy_info'].get('timeline'))
+    start = time.time() - hours * 3600
+    print("-" * 10 + f"Occupants in the last {hours:g} hours" + "-" * 10)
+    for key in timeline.present_between(start, time.time()):
+        print(f"{timeline.names.get(key, key)}:")
+        for changed_at, present in timeline.transitions(key, start):
+            print(f"  {'Arrived' if present else 'Left'} at "
+                  f"{datetime.datetime.fromtimestamp(changed_at).strftime('%I:%M:%S%p-%m/%d/%y')}")
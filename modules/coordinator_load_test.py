@@ -0,0 +1,101 @@
+# Hammer a local coordinator server with simulated clients and report throughput and latency
+# Usage: python coordinator_load_test.py [clients] [seconds] [protocol v1/v2]
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+from Utils.CoordinatorHost import CoordinatorHost
+from Utils import coordinatorProtocol
+
+clients = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+protocol = sys.argv[3] if len(sys.argv) > 3 else "v2"
+auth = "load-test"
+
+logging.basicConfig(level=logging.WARNING)
+
+
+def build_state():
+    """
+    Build a room state roughly the size of the real one
+    :return: The room state
+    """
+    if os.path.isfile("Configs/states_template.json"):
+        with open("Configs/states_template.json") as f:
+            state = json.load(f)
+    else:
+        state = {"temperature": 21.5, "humidity": 40, "temp_set_point": 70, "humid_set_point": 0, "big_wind_state": 0}
+    state["room_occupancy_info"] = {"room_occupied": True, "last_motion": time.time(), "bt_error": False,
+                                    "occupants": {f"occupant_{i}": {"present": i % 2 == 0, "last_seen": time.time()}
+                                                  for i in range(8)}}
+    return state
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))] * 1000
+
+
+def v1_request(port):
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as s:
+        s.sendall(json.dumps({"client": "load-test", "auth": auth, "type": "download_state"}).encode())
+        chunks = []
+        while True:
+            data = s.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+        json.loads(b''.join(chunks).decode())
+
+
+def run_client(index, port, stop_at, results):
+    latencies = []
+    errors = 0
+    connection = coordinatorProtocol.Connection("127.0.0.1", port, f"load-test-{index}", auth, timeout=10)
+    while time.time() < stop_at:
+        started = time.perf_counter()
+        try:
+            if protocol == "v1":
+                v1_request(port)
+            elif index % 4 == 0:
+                connection.request({"type": "upload_state", "data": {"tablet_last_update": time.time()}})
+            else:
+                connection.request({"type": "download_changes", "since": 0, "epoch": None})
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(time.perf_counter() - started)
+    connection.close()
+    results[index] = (latencies, errors)
+
+
+host = CoordinatorHost.WebServerHost("127.0.0.1", 0, auth, build_state(), override_host=False,
+                                     max_connections=max(64, clients + 1))
+host.server.ready.wait(5)
+port = host.server.port
+print(f"Load testing coordinator on port {port} with {clients} {protocol} clients for {duration} seconds")
+
+results = {}
+stop_at = time.time() + duration
+threads = [threading.Thread(target=run_client, args=(i, port, stop_at, results)) for i in range(clients)]
+start = time.time()
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+elapsed = time.time() - start
+
+latencies = [latency for samples, _ in results.values() for latency in samples]
+errors = sum(errors for _, errors in results.values())
+if latencies:
+    print(f"Requests: {len(latencies)} ({errors} errors) in {elapsed:.1f}s -> {len(latencies) / elapsed:.0f} req/s")
+    print(f"Client latency p50: {percentile(latencies, 50):.2f}ms p99: {percentile(latencies, 99):.2f}ms "
+          f"max: {max(latencies) * 1000:.2f}ms")
+else:
+    print(f"No requests completed ({errors} errors)")
+print(f"Server stats: {json.dumps(host.stats(), indent=2)}")
+host.close()
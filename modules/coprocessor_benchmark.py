@@ -0,0 +1,44 @@
+# Drive simulated arduino coprocessors like the weather display does and report the serial traffic and latency
+# Usage: python coprocessor_benchmark.py [seconds] [mode ascii/framed/delta] [baudrate] [corruption 0-1]
+import json
+import logging
+import sys
+import time
+
+from Utils import coprocessors, serialFraming
+from Utils.coprocessorSimulator import CoprocessorSimulator
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 20
+mode = sys.argv[2] if len(sys.argv) > 2 else "delta"
+baudrate = int(sys.argv[3]) if len(sys.argv) > 3 else 9600
+corruption = float(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+logging.basicConfig(level=logging.WARNING)
+
+protocol = "ascii" if mode == "ascii" else "framed"
+simulators = [CoprocessorSimulator(protocol, baudrate, corruption) for _ in range(2)]
+coprocessor = coprocessors.Coprocessor([sim.port for sim in simulators], [baudrate, baudrate], True,
+                                       protocol=protocol, delta=mode == "delta")
+print(f"Benchmarking {mode} coprocessor updates at {baudrate} baud for {duration} seconds (ready: {coprocessor.ready})")
+coprocessor.start_refresh()
+
+updates = 0
+start = time.time()
+while time.time() < start + duration:
+    # The clock line changes every second, the weather line far less often, same as Weather.py
+    now = time.localtime()
+    coprocessor.display(time.strftime("%I:%M:%S %p", now), f"T:{20 + now.tm_min % 5}F H:40%")
+    coprocessor._send(target_arduino=0)
+    updates += 1
+    time.sleep(0.1)
+elapsed = time.time() - start
+stats = coprocessor.stats()
+coprocessor.close_all()
+
+for index, (sim, link) in enumerate(zip(simulators, stats)):
+    sim.close()
+    print(f"Arduino {index}: {sim.bytes_received} bytes ({sim.bytes_received / elapsed:.1f} B/s), "
+          f"{sim.wire_time / elapsed * 100:.1f}% of the line busy, frames by type {sim.frames}, "
+          f"slots in sync: {sim.slots[:2] == [serialFraming.slot_bytes(v) for v in coprocessor.data_slots[index][:2]]}")
+print(f"Display updates: {updates}")
+print(f"Link stats: {json.dumps(stats, indent=2)}")
@@ -0,0 +1,118 @@
+# Compare loading the radar tiles with a thread per layer and a connection per tile against the pooled tile fetcher,
+# using a local stand-in for the tile server
+# Usage: python radar_tile_benchmark.py [layers] [workers] [latency ms] [connection setup ms]
+import http.server
+import sys
+import threading
+import time
+from urllib.request import urlopen
+
+from Utils.tileFetcher import TileFetcher
+
+layers = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+latency = (float(sys.argv[3]) if len(sys.argv) > 3 else 40) / 1000
+setup = (float(sys.argv[4]) if len(sys.argv) > 4 else 60) / 1000
+
+viewport = [(16, 22), (15, 22), (17, 22), (16, 23), (15, 23), (17, 23)]
+tile = bytes(range(256)) * 64  # About the size of a real tile
+
+
+class TileHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+    connections = 0
+    requests = 0
+
+    def setup(self):
+        # Stands in for the TCP and TLS handshakes of a new connection
+        TileHandler.connections += 1
+        time.sleep(setup)
+        super().setup()
+
+    def do_GET(self):
+        TileHandler.requests += 1
+        time.sleep(latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(tile)))
+        self.end_headers()
+        self.wfile.write(tile)
+
+    def log_message(self, *args):
+        pass
+
+
+server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+server.daemon_threads = True
+threading.Thread(target=server.serve_forever, daemon=True).start()
+base = f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def url(layer, location):
+    return f"{base}/{layer}/6/{location[0]}/{location[1]}"
+
+
+def reset():
+    TileHandler.connections = 0
+    TileHandler.requests = 0
+
+
+def legacy():
+    # One thread per layer, each downloading its tiles one after another over a new connection
+    visible = set()
+    started = time.perf_counter()
+    finished = {}
+
+    def load_layer(layer):
+        for location in [(15, 22), (16, 22), (17, 22), (15, 23), (16, 23), (17, 23)]:
+            urlopen(url(layer, location)).read()
+            if layer == 0:
+                visible.add(location)
+                if len(visible) == len(viewport):
+                    finished["viewport"] = time.perf_counter() - started
+
+    threads = [threading.Thread(target=load_layer, args=(layer,)) for layer in range(layers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return finished["viewport"], time.perf_counter() - started
+
+
+def pooled():
+    fetcher = TileFetcher(workers=workers)
+    visible = set()
+    finished = {}
+    started = time.perf_counter()
+
+    def loaded(key, data, fetched_at):
+        layer, location = key
+        if layer == 0:
+            visible.add(location)
+            if len(visible) == len(viewport):
+                finished["viewport"] = time.perf_counter() - started
+
+    # Queued in the order the radar screen does, the visible frame's tiles first and nearest the middle first
+    for index, location in enumerate(viewport):
+        for layer in range(layers):
+            rank = 0 if layer == 0 else 1
+            fetcher.fetch((layer, location), url(layer, location), loaded, priority=rank * len(viewport) + index)
+    # Asking again for tiles already queued shouldn't download them twice
+    for location in viewport:
+        fetcher.fetch((0, location), url(0, location), loaded, priority=0)
+    fetcher.wait()
+    total = time.perf_counter() - started
+    return finished["viewport"], total, fetcher.stats()
+
+
+print(f"{layers} layers x {len(viewport)} tiles, {latency * 1000:.0f} ms latency, {setup * 1000:.0f} ms connection setup")
+reset()
+viewport_time, total = legacy()
+print(f"Thread per layer:   viewport {viewport_time:.3f} s, all tiles {total:.3f} s, "
+      f"{TileHandler.connections} connections for {TileHandler.requests} requests")
+reset()
+viewport_time, total, stats = pooled()
+print(f"Pooled ({workers} workers): viewport {viewport_time:.3f} s, all tiles {total:.3f} s, "
+      f"{TileHandler.connections} connections for {TileHandler.requests} requests, "
+      f"{stats['deduplicated']} duplicate requests merged")
+server.shutdown()
@@ -0,0 +1,56 @@
+# Compare decoding webcam thumbnails at full size and scaling them (and the Pillow to PNG fallback) against decoding
+# them at the grid cell size with the thumbnail decoder, over a folder of sample JPEGs (e.g. saved campus cam images)
+# Usage: python thumbnail_decode_benchmark.py [folder] [width] [height] [repeats]
+import io
+import os
+import sys
+import time
+
+import pygame
+from PIL import Image
+
+from Utils.thumbnailDecoder import decode_thumbnail
+
+folder = sys.argv[1] if len(sys.argv) > 1 else "Assets/Images"
+size = (int(sys.argv[2]) if len(sys.argv) > 2 else 400, int(sys.argv[3]) if len(sys.argv) > 3 else 222)
+repeats = int(sys.argv[4]) if len(sys.argv) > 4 else 10
+
+samples = []
+for name in sorted(os.listdir(folder)):
+    if name.lower().endswith((".jpg", ".jpeg")):
+        with open(os.path.join(folder, name), "rb") as f:
+            samples.append((name, f.read()))
+if not samples:
+    sys.exit(f"No JPEGs in {folder}")
+
+
+def legacy(data):
+    # What load_thumb used to do, decode at full size then scale
+    return pygame.transform.scale(pygame.image.load(io.BytesIO(data), "JPG"), size)
+
+
+def legacy_png(data):
+    # load_thumb's fallback when pygame couldn't read the JPEG, re-encoded to PNG through Pillow
+    with io.BytesIO() as f:
+        Image.open(io.BytesIO(data)).save(f, format="PNG")
+        f.seek(0)
+        return pygame.transform.scale(pygame.image.load(f), size)
+
+
+def timed(decode, data):
+    started = time.perf_counter()
+    for _ in range(repeats):
+        decode(data)
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+print(f"{len(samples)} images decoded to {size[0]}x{size[1]}, average of {repeats} runs")
+print(f"{'image':32} {'source':>11} {'legacy':>9} {'via PNG':>9} {'at size':>9} {'speedup':>8}")
+totals = [0, 0, 0]
+for name, data in samples:
+    with Image.open(io.BytesIO(data)) as image:
+        source = f"{image.size[0]}x{image.size[1]}"
+    times = [timed(legacy, data), timed(legacy_png, data), timed(lambda d: decode_thumbnail(d, size), data)]
+    totals = [total + t for total, t in zip(totals, times)]
+    print(f"{name[:32]:32} {source:>11} {times[0]:7.1f}ms {times[1]:7.1f}ms {times[2]:7.1f}ms {times[0] / times[2]:7.1f}x")
+print(f"{'total':32} {'':>11} {totals[0]:7.1f}ms {totals[1]:7.1f}ms {totals[2]:7.1f}ms {totals[0] / totals[2]:7.1f}x")
@@ -0,0 +1,66 @@
+# Compare converting video frames to surfaces the old way (resize, flip and rotate, array_to_surface) against the
+# preallocated frame converter, counting the memory allocated per frame with tracemalloc
+# Usage: python video_conversion_benchmark.py [width] [height] [source width] [source height] [frames]
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy
+import pygame
+
+from Utils.frameConverter import FrameConverter
+
+size = (int(sys.argv[1]) if len(sys.argv) > 1 else 800, int(sys.argv[2]) if len(sys.argv) > 2 else 445)
+source = (int(sys.argv[3]) if len(sys.argv) > 3 else 1280, int(sys.argv[4]) if len(sys.argv) > 4 else 720)
+frames = int(sys.argv[5]) if len(sys.argv) > 5 else 200
+
+rng = numpy.random.default_rng(0)
+samples = [rng.integers(0, 256, (source[1], source[0], 3), dtype=numpy.uint8) for _ in range(4)]
+
+
+def legacy():
+    surface = pygame.Surface(size)
+
+    def convert(frame):
+        resized = cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)
+        pygame.pixelcopy.array_to_surface(surface, numpy.flip(numpy.rot90(resized[::-1])))
+        return surface
+    return convert
+
+
+def converter():
+    frame_converter = FrameConverter(slots=5)
+    on_screen = []
+
+    def convert(frame):
+        surface = frame_converter.convert(frame, size, busy=on_screen)
+        on_screen[:] = [surface]
+        return surface
+    return convert
+
+
+def measure(convert):
+    convert(samples[0])  # Allocate anything that is allocated once
+    tracemalloc.start()
+    allocated = 0
+    started = time.perf_counter()
+    for index in range(frames):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        convert(samples[index % len(samples)])
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    elapsed = time.perf_counter() - started
+    tracemalloc.stop()
+    return elapsed / frames * 1000, allocated / frames
+
+
+print(f"{frames} frames of {source[0]}x{source[1]} converted to {size[0]}x{size[1]}")
+for name, convert in (("array_to_surface", legacy()), ("frame converter", converter())):
+    per_frame, allocated = measure(convert)
+    print(f"{name:17} {per_frame:6.2f} ms/frame, {allocated / 1024:9.1f} KiB allocated/frame")
+
+# The two paths should produce the same picture
+frame = samples[0]
+a, b = legacy()(frame), converter()(frame)
+print("Same pixels:", numpy.array_equal(pygame.surfarray.array3d(a), pygame.surfarray.array3d(b)))